@@ -4,15 +4,20 @@
 Data importing tools for WhensMyTransport - import TfL's data into an easier format for us to use
 """
 # Standard Python libraries
+import argparse
 import csv
+import glob
+import hashlib
+import json
 import os
 import cPickle as pickle
 import re
+import sqlite3
 import sys
-import subprocess
-import tempfile
+import time
 from math import sqrt
 from pprint import pprint
+from xml.etree.cElementTree import iterparse
 
 # Library available from http://code.google.com/p/python-graph/
 from pygraph.classes.digraph import digraph
@@ -22,46 +27,33 @@ import nltk
 # Local files
 from lib.browser import WMTBrowser
 from lib.database import WMTDatabase
-from lib.geo import convertWGS84toOSGB36, LatLongToOSGrid
+from lib.geo import convertWGS84toOSEastingNorthingArrays, convertOSEastingNorthingtoWGS84
 from lib.listutils import unique_values
+from lib.network import save_network
+from lib.locations import RailStationLocations
+from lib.models import BusStop, RailStation
 from whensmytrain import get_line_code, LINE_NAMES
 
 
-def import_bus_csv_to_db():
+def import_bus_csv_to_db(output_path="./db/whensmybus.geodata.db"):
     """
-    Utility script that produces the script for converting TfL's bus data CSV into sqlite
+    Utility script that converts TfL's bus data CSV into sqlite
 
     If you are updating the database, you first have to download the CSV file
     from the TfL website. Signup as a developer here: http://www.tfl.gov.uk/businessandpartners/syndication/
 
     Save the the routes as ./sourcedata/bus-routes.csv
 
-    It takes the original file from TfL, fixes them to use semicolons (because sqlite's
-    CSV parser is really dumb and can't deal with quoted values) and then converts it to
+    It takes the original file from TfL, strips out the fields and virtual bus stops we don't need and then loads it into
     the database file ./db/whensmybus.geodata.db
     """
-    # Fix CSV - replace commas with semi-colons, allow sqlite to import without cocking it all up
-    inputpath = './sourcedata/bus-routes.csv'
-    inputfile = open(inputpath)
+    inputfile = open('./sourcedata/bus-routes.csv')
     reader = csv.DictReader(inputfile)
-    fieldnames = reader.fieldnames
     fields_to_delete = ('Stop_Code_LBSL', 'Naptan_Atco')
+    output_fieldnames = [field for field in reader.fieldnames if field not in fields_to_delete]
 
-    outputpath = inputpath.replace('.csv', '.ssv')
-    outputfile = open(outputpath, 'w')
-    output_fieldnames = [field for field in fieldnames if field not in fields_to_delete]
-    writer = csv.DictWriter(outputfile, output_fieldnames, delimiter=";")
-
-    for line in reader:
-        if not line:
-            continue
-        for field in fields_to_delete:
-            del line[field]
-        writer.writerow(line)
-    outputfile.flush()
-    outputfile.close()
-
-    tablename = 'locations'
+    # Virtual bus stops are just points on the route, not places you can catch a bus from, so are not worth importing
+    rows = [[line[field] for field in output_fieldnames] for line in reader if line and line['Virtual_Bus_Stop'] in ('', '0')]
 
     integer_values = ('Location_Easting',
                       'Location_Northing',
@@ -72,25 +64,20 @@ def import_bus_csv_to_db():
     output_fieldnames[output_fieldnames.index('Stop_Name')] = 'Name'
     output_fieldnames = ['%s%s' % (f.lower(), f in integer_values and ' INT' or '') for f in output_fieldnames]
 
-    # Produce SQL for this table
-    sql = "drop table if exists %s;\r\n" % tablename
-    sql += "drop table if exists routes;\r\n"
-    sql += "create table %s(%s);\r\n" % (tablename, ", ".join(output_fieldnames))
-    sql += '.separator ";"\r\n'
-    sql += ".import %s %s\r\n" % (outputpath, tablename)
-    sql += "delete from %s WHERE virtual_bus_stop;\r\n" % tablename
-    sql += "\r\n"
+    indices = ('route', ('route', 'run'), ('route', 'bus_stop_code'))
+    export_rows_to_db(output_path, "locations", output_fieldnames, rows, indices, delete_existing=True)
 
-    sql += "CREATE INDEX route_index ON locations (route);\r\n"
-    sql += "CREATE INDEX route_run_index ON locations (route, run);\r\n"
-    sql += "CREATE INDEX route_stop_index ON locations (route, bus_stop_code);\r\n"
+    # Catalogue of each route's number of runs and stops, so the bot can check a route exists without looking through its stops
+    (route_index, run_index) = (output_fieldnames.index('route'), output_fieldnames.index('run INT'))
+    routes = {}
+    for row in rows:
+        (runs, stops) = routes.get(row[route_index], (0, 0))
+        routes[row[route_index]] = (max(runs, int(row[run_index])), stops + 1)
+    route_rows = [(route, runs, stops) for (route, (runs, stops)) in sorted(routes.items())]
+    export_rows_to_db(output_path, "routes", ('route PRIMARY KEY', 'runs INT', 'stops INT'), route_rows, delete_existing=True)
 
-    export_sql_to_db("./db/whensmybus.geodata.db", sql)
-    # Drop SSV file now we don't need it
-    os.unlink(outputpath)
 
-
-def import_dlr_xml_to_db():
+def import_dlr_xml_to_db(output_path="./db/whensmytrain.geodata.db"):
     """
     Utility script that produces the script for converting TfL's DLR data KML into a sqlite database
 
@@ -125,10 +112,10 @@ def import_dlr_xml_to_db():
             print "Cannot find %s from geodata in dlr-references!" % name
 
     rows = [[station[fieldname.split(' ')[0]] for fieldname in fieldnames] for station in stations.values()]
-    export_rows_to_db("./db/whensmytrain.geodata.db", "locations", fieldnames, rows)
+    export_rows_to_db(output_path, "locations", fieldnames, rows)
 
 
-def import_tube_xml_to_db():
+def import_tube_xml_to_db(output_path="./db/whensmytrain.geodata.db"):
     """
     Utility script that produces the script for converting TfL's Tube data KML into a sqlite database
 
@@ -194,12 +181,13 @@ def import_tube_xml_to_db():
                               station['inner'], station['outer'])
                 rows.append(field_data)
 
-    export_rows_to_db("./db/whensmytrain.geodata.db", "locations", fieldnames, rows, ('name', 'line'), delete_existing=True)
+    export_rows_to_db(output_path, "locations", fieldnames, rows, ('name', 'line'), delete_existing=True)
 
 
-def import_network_data_to_graph():
+def import_network_data_to_graph(output_path="./db/whensmytrain.network.bin"):
     """
-    Import data from a file describing the edges of the Tube network and turn it into a graph object which we pickle and save
+    Import data from a file describing the edges of the Tube network and turn it into graph objects, which we save in the
+    binary format used by WMTNetwork (see lib/network.py)
     """
     database = WMTDatabase("whensmytrain.geodata.db")
 
@@ -260,7 +248,77 @@ def import_network_data_to_graph():
         graphs[get_line_code(line)] = create_graph_from_dict(this_line_only, database, interchanges_by_foot)
     graphs['All'] = create_graph_from_dict(stations_neighbours, database, interchanges_by_foot)
 
-    pickle.dump(graphs, open("./db/whensmytrain.network.gr", "w"))
+    save_network(graphs, output_path)
+
+
+def import_direct_lines_to_db(output_path="./db/whensmytrain.directlines.db"):
+    """
+    Work out the quickest line that goes directly between every pair of Tube or DLR stations and save them into a sqlite database,
+    so that RailStationLocations.get_lines_serving() can look them up instead of working them out each time
+    """
+    geodata = RailStationLocations()
+    rows = []
+    for origin_code in unique_values(sorted([row['code'] for row in geodata.database.get_rows("SELECT code FROM locations")])):
+        origin = RailStation(code=origin_code)
+        # A direct route can only go to stations on one of the lines at the origin
+        sql = "SELECT * FROM locations WHERE line IN (SELECT line FROM locations WHERE code=?) GROUP BY name"
+        for row in geodata.database.get_rows(sql, (origin_code,)):
+            destination = RailStation(**row)
+            line_codes = geodata.find_lines_serving(origin, destination)
+            if line_codes:
+                rows.append((origin_code, destination.name, line_codes[0]))
+
+    fieldnames = ('origin_code', 'destination_name', 'line')
+    export_rows_to_db(output_path, "direct_lines", fieldnames, rows, (('origin_code', 'destination_name'),), delete_existing=True)
+
+
+def import_gazetteer_to_db(output_path="./db/whensmytransport.gazetteer.db"):
+    """
+    Utility script that builds the gazetteer used by the local geocoder (see LocalGeocoder in lib/locations.py) into a sqlite database
+
+    Pulls together place names and their locations from three files:
+
+    1. The names of every bus stop in TfL's bus data, saved as bus-routes.csv (see import_bus_csv_to_db() above)
+
+    2. The data for Tube & DLR station locations, saved as tube-locations.kml - each station goes in under its own name, and
+    with " Station" on the end
+
+    3. Optionally, a list of any other places or streets you want to be able to find, saved as places.csv with the columns
+    Name, Location_Easting, Location_Northing
+
+    Places with the same name less than 500m from each other are treated as the same place
+    """
+    places = {}
+
+    def add_place(name, easting, northing):
+        """
+        Add the place with name at (easting, northing) to the gazetteer, unless it is a duplicate
+        """
+        normalised_name = BusStop(name).get_normalised_name()
+        key = (normalised_name, int(easting) // 500, int(northing) // 500)
+        if normalised_name and key not in places:
+            places[key] = (name, int(easting), int(northing))
+
+    reader = csv.DictReader(open('./sourcedata/bus-routes.csv'))
+    for line in reader:
+        if line and line['Virtual_Bus_Stop'] in ('', '0') and line['Location_Easting']:
+            add_place(line['Stop_Name'], line['Location_Easting'], line['Location_Northing'])
+
+    for station in parse_stations_from_kml().values():
+        add_place(station['name'], station['location_easting'], station['location_northing'])
+        add_place(station['name'] + " Station", station['location_easting'], station['location_northing'])
+
+    if os.path.exists('./sourcedata/places.csv'):
+        reader = csv.DictReader(open('./sourcedata/places.csv'))
+        for line in reader:
+            add_place(line['Name'], line['Location_Easting'], line['Location_Northing'])
+
+    fieldnames = ('name', 'normalised_name', 'latitude REAL', 'longitude REAL')
+    rows = []
+    for ((normalised_name, _easting_key, _northing_key), (name, easting, northing)) in sorted(places.items()):
+        (latitude, longitude) = convertOSEastingNorthingtoWGS84(easting, northing)
+        rows.append((name, normalised_name, str(latitude), str(longitude)))
+    export_rows_to_db(output_path, "gazetteer", fieldnames, rows, ('normalised_name',), delete_existing=True)
 
 
 def parse_stations_from_kml(filter_function=lambda a, b: True):
@@ -268,46 +326,68 @@ def parse_stations_from_kml(filter_function=lambda a, b: True):
     Parses KML file of stations & associated data, and returns them as a dictionary
     """
     stations = {}
-    kml = WMTBrowser().fetch_xml_tree('file:///%s/sourcedata/tube-locations.kml' % os.getcwd())
-    for station in kml.findall('.//Placemark'):
-        name = station.find('name').text.strip().replace(' Station', '')
-        style = station.find('styleUrl').text
-        if filter_function(name, style):
-            coordinates = station.find('Point/coordinates').text
-            (lon, lat) = tuple([float(c) for c in coordinates.split(',')[0:2]])
-            (lat, lon) = convertWGS84toOSGB36(lat, lon)[:2]
-            (easting, northing) = LatLongToOSGrid(lat, lon)
-            stations[name.lower()] = {'name': name, 'location_easting': str(easting), 'location_northing': str(northing),
-                                      'code': '', 'lines': '', 'inner': '', 'outer': ''}
+    (names, lats, lons) = ([], [], [])
+    for placemark in read_kml_placemarks('./sourcedata/tube-locations.kml'):
+        name = placemark['name'].replace(' Station', '')
+        if filter_function(name, placemark['styleUrl']):
+            (lon, lat) = tuple([float(c) for c in placemark['coordinates'].split(',')[0:2]])
+            names.append(name)
+            lats.append(lat)
+            lons.append(lon)
+
+    # Convert all the stations' positions to eastings & northings in one go
+    (eastings, northings) = convertWGS84toOSEastingNorthingArrays(lats, lons)
+    for (name, easting, northing) in zip(names, eastings, northings):
+        stations[name.lower()] = {'name': name, 'location_easting': str(easting), 'location_northing': str(northing),
+                                  'code': '', 'lines': '', 'inner': '', 'outer': ''}
     return stations
 
 
-def export_rows_to_db(db_filename, tablename, fieldnames, rows, indices=(), delete_existing=False):
+def read_kml_placemarks(path):
     """
-    Generic database SQL composing & export function
+    Read the KML file at path one Placemark at a time, yielding each one as a dictionary of the (stripped) text of every element
+    in it, keyed by tag name - e.g. name, styleUrl and coordinates
     """
-    sql = ""
-    if delete_existing:
-        sql += "drop table if exists %s;\r\n" % tablename
-        sql += "create table %s(%s);\r\n" % (tablename, ", ".join(fieldnames))
-        for index in indices:
-            sql += "CREATE INDEX %s_index ON %s (%s);\r\n" % (index, tablename, index)
+    for (_event, element) in iterparse(path):
+        # Remove horrible namespace functionality
+        if element.tag.rpartition('}')[2] == 'Placemark':
+            yield dict([(child.tag.rpartition('}')[2], (child.text or '').strip()) for child in element.iter()])
+            # Throw away the Placemark once we're done with it, so we don't keep the whole file in memory
+            element.clear()
 
-    for field_data in rows:
-        sql += "insert into locations values "
-        sql += "(\"%s\");\r\n" % '", "'.join(field_data)
 
-    export_sql_to_db(db_filename, sql)
+def export_rows_to_db(db_filename, tablename, fieldnames, rows, indices=(), delete_existing=False):
+    """
+    Generic database export function - loads rows into the table tablename in one transaction, and then creates indices, which
+    are each either a column name or a tuple of column names. Prints out how long it took
+    """
+    start_time = time.time()
+    connection = sqlite3.connect(db_filename)
+    # If an import goes wrong we can always run it again, so there is no need for a journal or to wait for every write to hit disk
+    connection.execute("PRAGMA journal_mode=OFF")
+    connection.execute("PRAGMA synchronous=OFF")
+    with connection:
+        if delete_existing:
+            connection.execute("drop table if exists %s" % tablename)
+            connection.execute("create table %s(%s)" % (tablename, ", ".join(fieldnames)))
+        # Creating indices after the rows have gone in is quicker than updating them for every row
+        for index in indices:
+            connection.execute("drop index if exists %s" % get_index_name(index))
+        cursor = connection.executemany("insert into %s values (%s)" % (tablename, ", ".join(["?"] * len(fieldnames))),
+                                        ([isinstance(field, str) and field.decode('utf-8') or field for field in field_data]
+                                         for field_data in rows))
+        for index in indices:
+            columns = isinstance(index, tuple) and index or (index,)
+            connection.execute("CREATE INDEX %s ON %s (%s)" % (get_index_name(index), tablename, ", ".join(columns)))
+    connection.close()
+    print "Imported %s rows into %s in %s in %0.2f seconds" % (cursor.rowcount, tablename, db_filename, time.time() - start_time)
 
 
-def export_sql_to_db(db_filename, sql):
+def get_index_name(index):
     """
-    Generic database SQL export function
+    Return the name of the index on the column name or tuple of column names index
     """
-    tempf = tempfile.NamedTemporaryFile('w')
-    tempf.write(sql)
-    tempf.flush()
-    print subprocess.check_output(["sqlite3", db_filename], stdin=open(tempf.name))
+    return "%s_index" % (isinstance(index, tuple) and '_'.join(index) or index)
 
 
 def create_graph_from_dict(stations, database, interchanges_by_foot):
@@ -460,7 +540,7 @@ def get_tfl_prediction_summaries():
     return all_train_data
 
 
-def import_tube_xml_to_text_corpus():
+def import_tube_xml_to_text_corpus(output_path="./db/whensmytrain.tagger.obj"):
     """
     Creates a corpus of text data for our parser to understand requests with
     """
@@ -499,13 +579,98 @@ def import_tube_xml_to_text_corpus():
     regex_tagger = nltk.RegexpTagger(tagging_regexes)
     unigram_tagger = nltk.UnigramTagger(unigram_tokens, backoff=regex_tagger)
     bigram_tagger = nltk.BigramTagger(bigram_tokens, backoff=unigram_tagger)
-    pickle.dump(bigram_tagger, open("./db/whensmytrain.tagger.obj", "w"))
+    pickle.dump(bigram_tagger, open(output_path, "w"))
+
+
+# Every file we build, with the files it is built from and the functions (run in order) that build it. Targets are listed so that
+# a target comes after any other targets it is built from
+BUILD_TARGETS = (
+    ('db/whensmybus.geodata.db', ('sourcedata/bus-routes.csv',),
+     (import_bus_csv_to_db,)),
+    ('db/whensmytrain.geodata.db', ('sourcedata/tube-locations.kml', 'sourcedata/tube-references.csv',
+                                    'sourcedata/circle_platform_data.csv', 'sourcedata/dlr-references.csv'),
+     (import_tube_xml_to_db, import_dlr_xml_to_db)),
+    ('db/whensmytrain.network.bin', ('sourcedata/tube-connections.csv', 'db/whensmytrain.geodata.db'),
+     (import_network_data_to_graph,)),
+    ('db/whensmytrain.directlines.db', ('db/whensmytrain.geodata.db', 'db/whensmytrain.network.bin'),
+     (import_direct_lines_to_db,)),
+    ('db/whensmytransport.gazetteer.db', ('sourcedata/bus-routes.csv', 'sourcedata/tube-locations.kml', 'sourcedata/places.csv'),
+     (import_gazetteer_to_db,)),
+    ('db/whensmytrain.tagger.obj', ('sourcedata/tube-references.csv', 'sourcedata/dlr-references.csv'),
+     (import_tube_xml_to_text_corpus,)),
+)
+BUILD_MANIFEST_PATH = './db/datatools.manifest.json'
+
+
+def get_file_hash(path):
+    """
+    Return the SHA-1 hash of the contents of the file at path, or None if it does not exist
+    """
+    if not os.path.exists(path):
+        return None
+    file_hash = hashlib.sha1()
+    with open(path, 'rb') as input_file:
+        for chunk in iter(lambda: input_file.read(65536), ''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def get_code_hash():
+    """
+    Return the SHA-1 hash of the code that builds our files (this file and everything in lib/), so that changing how a file is
+    built means it gets built again, even if the files it is built from have not changed
+    """
+    code_hash = hashlib.sha1()
+    for path in ['./datatools.py'] + sorted(glob.glob('./lib/*.py')):
+        code_hash.update("%s %s\n" % (path, get_file_hash(path)))
+    return code_hash.hexdigest()
+
+
+def build_atomically(output_path, build_functions):
+    """
+    Build the file at output_path by running build_functions on a temporary file, and only replace output_path with it once they
+    have all finished - so anything reading output_path (like a running bot) never sees a half-written file
+    """
+    temporary_path = output_path + '.tmp'
+    if os.path.exists(temporary_path):
+        os.unlink(temporary_path)
+    try:
+        for build_function in build_functions:
+            build_function(temporary_path)
+        os.rename(temporary_path, output_path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.unlink(temporary_path)
+
+
+def build(rebuild_all=False):
+    """
+    Build all the files in BUILD_TARGETS, skipping any where neither they, the files they are built from nor the code that builds
+    them have changed since they were last built. What all these looked like at the last build is recorded in the manifest at
+    BUILD_MANIFEST_PATH
+    """
+    manifest = os.path.exists(BUILD_MANIFEST_PATH) and json.load(open(BUILD_MANIFEST_PATH)) or {}
+    code_hash = get_code_hash()
+    for (output_path, source_paths, build_functions) in BUILD_TARGETS:
+        source_hashes = dict([(source_path, get_file_hash(source_path)) for source_path in source_paths])
+        source_hashes['datatools.py and lib/'] = code_hash
+        last_build = manifest.get(output_path, {})
+        if not rebuild_all and last_build.get('sources') == source_hashes and last_build.get('output') == get_file_hash(output_path):
+            print "%s is up to date" % output_path
+            continue
+
+        print "Building %s" % output_path
+        build_atomically('./' + output_path, build_functions)
+        manifest[output_path] = {'sources': source_hashes, 'output': get_file_hash(output_path)}
+        # Save the manifest after every target, so that if a later one fails we don't have to build this one again
+        with open(BUILD_MANIFEST_PATH + '.tmp', 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+        os.rename(BUILD_MANIFEST_PATH + '.tmp', BUILD_MANIFEST_PATH)
 
 
 if __name__ == "__main__":
-    import_bus_csv_to_db()
-    import_tube_xml_to_db()
-    import_dlr_xml_to_db()
-    import_network_data_to_graph()
+    parser = argparse.ArgumentParser(description="Build When's My Transport's databases from the data in sourcedata/")
+    parser.add_argument("--all", dest="rebuild_all", action="store_true", default=False,
+                        help="Build everything, even if it has not changed since it was last built")
+    build(parser.parse_args().rebuild_all)
     #scrape_odd_platform_designations()
-    import_tube_xml_to_text_corpus()
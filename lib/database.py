@@ -5,21 +5,56 @@ Database client for When's My Transport
 import logging
 import sqlite3
 import os
+import urllib
 
 DB_PATH = os.path.normpath(os.path.dirname(os.path.abspath(__file__)) + '/../db/')
 
+# Databases opened read-only are memory-mapped, so that every process reading one shares the same pages of memory for it
+READ_ONLY_MMAP_SIZE = 256 * 1024 * 1024
+READ_ONLY_CACHE_SIZE = 8 * 1024  # In kilobytes
+READ_ONLY_CONNECTIONS = {}
+
+
+def get_read_only_connection(dbfilename):
+    """
+    Return a read-only connection to the database file dbfilename, shared with everything else in this process reading it
+    """
+    # Connections cannot be shared between processes, so a process forked from this one will make its own
+    key = (os.getpid(), dbfilename)
+    if key not in READ_ONLY_CONNECTIONS:
+        logging.debug("Opening database %s read-only", dbfilename)
+        path = DB_PATH + '/' + dbfilename
+        # Opening a file that is not there would make a new empty database, so tell whoever asked for it instead
+        if not os.path.exists(path):
+            raise IOError("Database file %s does not exist" % path)
+        try:
+            # immutable means sqlite can assume the file never changes, so does not need to lock it or check for changes
+            db_connection = sqlite3.connect('file:%s?mode=ro&immutable=1' % urllib.quote(path))
+        except sqlite3.OperationalError:
+            # Versions of sqlite that cannot open URIs will fail to find the file, so open it as normal instead
+            db_connection = sqlite3.connect(path)
+        db_connection.row_factory = sqlite3.Row
+        db_connection.execute("PRAGMA mmap_size=%s" % READ_ONLY_MMAP_SIZE)
+        db_connection.execute("PRAGMA cache_size=-%s" % READ_ONLY_CACHE_SIZE)
+        READ_ONLY_CONNECTIONS[key] = db_connection
+    return READ_ONLY_CONNECTIONS[key]
+
 
 class WMTDatabase():
     """
     Class representing a database client for When's My Transport
     """
-    def __init__(self, dbfilename):
+    def __init__(self, dbfilename, read_only=False):
         """
-        Initialise & load a database from file
+        Initialise & load a database from file. If read_only is True, the database can only be read from (apart from temporary
+        tables) and its connection is shared with any other WMTDatabase reading it in this process
         """
-        logging.debug("Opening database %s", dbfilename)
-        self.db_connection = sqlite3.connect(DB_PATH + '/' + dbfilename)
-        self.db_connection.row_factory = sqlite3.Row
+        if read_only:
+            self.db_connection = get_read_only_connection(dbfilename)
+        else:
+            logging.debug("Opening database %s", dbfilename)
+            self.db_connection = sqlite3.connect(DB_PATH + '/' + dbfilename)
+            self.db_connection.row_factory = sqlite3.Row
         self.cursor = self.db_connection.cursor()
 
     def write_query(self, sql, args=()):
@@ -58,8 +93,8 @@ class WMTDatabase():
         Check to see if any row in the table has the value in column; returns True if exists, False if not
         """
         (where_statement, where_values) = self.make_where_statement(table_name, {column: value})
-        rows = self.get_rows("SELECT * FROM %s WHERE %s" % (table_name, where_statement), where_values)
-        return bool(rows)
+        row = self.get_row("SELECT 1 FROM %s WHERE %s LIMIT 1" % (table_name, where_statement), where_values)
+        return bool(row)
 
     def get_max_value(self, table_name, column, params):
         """
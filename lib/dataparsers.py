@@ -4,10 +4,10 @@ Data parsers for Whens My Transport?
 """
 import logging
 import re
-from datetime import datetime, timedelta
+from datetime import datetime
 
 from lib.exceptions import WhensMyTransportException
-from lib.models import TubeTrain, Bus, DLRTrain, DepartureCollection
+from lib.models import TubeTrain, Bus, DLRTrain, DepartureCollection, make_departure_time
 from lib.stringutils import capwords, gmt_to_localtime
 
 
@@ -31,7 +31,13 @@ def parse_bus_data(bus_data, route_number):
     for a in relevant_arrivals[:3]:
         logging.debug("Found bus %s going to %s at %s" % (a['routeName'], a['destination'], a['scheduledTime']))
 
-    relevant_buses = [Bus(a['destination'], gmt_to_localtime(a['scheduledTime'])) for a in relevant_arrivals[:3]]
+    # Departure times are counted in minutes from midnight, all worked out against the same clock
+    current_hour = datetime.now().hour
+    relevant_buses = []
+    for arrival in relevant_arrivals[:3]:
+        scheduled_time = gmt_to_localtime(arrival['scheduledTime'])
+        scheduled_minute = int(scheduled_time[:2]) * 60 + int(scheduled_time[2:4])
+        relevant_buses.append(Bus(arrival['destination'], make_departure_time(scheduled_minute, current_hour)))
     return relevant_buses
 
 
@@ -49,6 +55,7 @@ def parse_dlr_data(dlr_data, station):
 
     # Go through each platform and get data about every train arriving, including which direction it's headed
     trains_by_platform = DepartureCollection()
+    current_hour = datetime.now().hour
     for platform in dlr_data.findall("div[@id='ttbox']"):
         # Get the platform number from image attached and the time published
         img = platform.find("div[@id='platformleft']/img")
@@ -61,6 +68,7 @@ def parse_dlr_data(dlr_data, station):
         info = platform.find("div[@id='platformmiddle']")
         publication_time = info.find("div[@id='time']").text.strip()
         publication_time = datetime.strptime(publication_time, "%H:%M")
+        publication_minute = publication_time.hour * 60 + publication_time.minute
         line1 = info.find("div[@id='line1']")
         line2 = info.find("div[@id='line23']/p")
         line3 = info.find("div[@id='line23']/p/br")
@@ -73,10 +81,10 @@ def parse_dlr_data(dlr_data, station):
                 destination = capwords(result.group(1).strip())
                 if destination == 'Terminates Here':
                     continue
-                departure_delta = timedelta(minutes=(result.group(3) and int(result.group(3)) or 0))
-                departure_time = datetime.strftime(publication_time + departure_delta, "%H%M")
-                trains_by_platform.add_to_slot(platform_name, DLRTrain(destination, departure_time))
-                logging.debug("Found a train going to %s at %s", destination, departure_time)
+                departure_delta = result.group(3) and int(result.group(3)) or 0
+                train_obj = DLRTrain(destination, make_departure_time(publication_minute + departure_delta, current_hour))
+                trains_by_platform.add_to_slot(platform_name, train_obj)
+                logging.debug("Found a train going to %s at %s", destination, train_obj.get_departure_time())
             else:
                 logging.debug("Error - could not parse this line: %s", train)
 
@@ -101,6 +109,9 @@ def parse_tube_data(tube_data, station, line_code):
     trains_by_direction = DepartureCollection()
     publication_time = tube_data.find('WhenCreated').text
     publication_time = datetime.strptime(publication_time, "%d %b %Y %H:%M:%S")
+    # Departure times are counted in minutes from midnight, worked out from the publication time plus the seconds to go
+    publication_second = publication_time.hour * 3600 + publication_time.minute * 60 + publication_time.second
+    current_hour = datetime.now().hour
     for platform in tube_data.findall('.//P'):
         platform_name = platform.attrib['N']
         direction = re.search("(North|East|South|West)bound", platform_name, re.I)
@@ -132,8 +143,7 @@ def parse_tube_data(tube_data, station, line_code):
         for train in platform_trains:
             # Create a TubeTrain object
             destination = train.attrib['Destination']
-            departure_delta = timedelta(seconds=int(train.attrib['SecondsTo']))
-            departure_time = datetime.strftime(publication_time + departure_delta, "%H%M")
+            departure_time = make_departure_time((publication_second + int(train.attrib['SecondsTo'])) // 60, current_hour)
             set_number = train.attrib['SetNo']
             train_obj = TubeTrain(destination, direction, departure_time, line_code, set_number)
             trains_by_direction.add_to_slot(direction, train_obj)
@@ -25,6 +25,7 @@ class WhensMyTransportException(Exception):
         'not_in_uk':        "You do not appear to be located in the United Kingdom",
         'not_in_london':    "You do not appear to be located in the London area",
         'unknown_error':    "An unknown error occurred processing your Tweet. My creator has been informed",
+        'geocoder_down':    "I can't look up places by name right now, sorry",
 
         # WhensMyBus fatal errors
         'blank_bus_tweet':  "I need to have a bus number in order to find the times for it",
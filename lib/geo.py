@@ -7,6 +7,12 @@ to convert between different co-ordinate systems
 import math
 import urllib
 
+# NumPy is optional. If it is installed, batches of co-ordinates are converted as arrays in one go
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # Geocoders Define the URL and how to parse the resulting JSON object
 
 
@@ -33,6 +39,13 @@ class BaseGeocoder():
         query_url = self.url % urllib.urlencode(self.params)
         return query_url
 
+    def geocode(self, placename, browser):
+        """
+        Look up placename using the WMTBrowser browser, and return list of matching place(s), each represented by a
+        (latitude, longitude) tuple. Raises a WhensMyTransportException if the geocoder cannot be reached
+        """
+        return self.parse_geodata(browser.fetch_json(self.get_geocode_url(placename)))
+
 
 class BingGeocoder(BaseGeocoder):
     """
@@ -148,12 +161,25 @@ class GoogleGeocoder(BaseGeocoder):
 #
 # http://www.movable-type.co.uk/scripts/latlong-gridref.html
 #
-def LatLongToOSGrid(lat, lon):
+def LatLongToOSGrid(lat, lon, rounded=True):
     """
     Convert Geodesic co-ordinates to an OS grid reference, returned as an (eastings, northings) tuple
+
+    The eastings & northings are rounded to the nearest metre, unless rounded is False
+    """
+    (E, N) = LatLongToOSGridUsing(lat, lon, math)
+    if not rounded:
+        return (E, N)
+    return (int(round(E)), int(round(N)))
+
+
+def LatLongToOSGridUsing(lat, lon, maths):
     """
-    lat = math.radians(lat)
-    lon = math.radians(lon)
+    Does the work of LatLongToOSGrid(), returning unrounded (eastings, northings). maths is the module to do the sums with -
+    math if lat & lon are numbers, or numpy if they are NumPy arrays of them
+    """
+    lat = maths.radians(lat)
+    lon = maths.radians(lon)
 
     a = 6377563.396
     b = 6356256.910          # Airy 1830 major & minor semi-axes
@@ -167,21 +193,21 @@ def LatLongToOSGrid(lat, lon):
     n2 = n*n
     n3 = n*n*n
 
-    cosLat = math.cos(lat)
-    sinLat = math.sin(lat)
-    nu = a*F0/math.sqrt(1-e2*sinLat*sinLat)              # transverse radius of curvature
-    rho = a*F0*(1-e2)/math.pow(1-e2*sinLat*sinLat, 1.5)  # meridional radius of curvature
+    cosLat = maths.cos(lat)
+    sinLat = maths.sin(lat)
+    nu = a*F0/maths.sqrt(1-e2*sinLat*sinLat)              # transverse radius of curvature
+    rho = a*F0*(1-e2)/(1-e2*sinLat*sinLat) ** 1.5  # meridional radius of curvature
     eta2 = nu/rho-1
 
     Ma = (1 + n + (5.0/4.0)*n2 + (5.0/4.0)*n3) * (lat-lat0)
-    Mb = (3*n + 3*n*n + (21.0/8.0)*n3) * math.sin(lat-lat0) * math.cos(lat+lat0)
-    Mc = ((15.0/8.0)*n2 + (15.0/8.0)*n3) * math.sin(2*(lat-lat0)) * math.cos(2*(lat+lat0))
-    Md = (35.0/24.0)*n3 * math.sin(3*(lat-lat0)) * math.cos(3*(lat+lat0))
+    Mb = (3*n + 3*n*n + (21.0/8.0)*n3) * maths.sin(lat-lat0) * maths.cos(lat+lat0)
+    Mc = ((15.0/8.0)*n2 + (15.0/8.0)*n3) * maths.sin(2*(lat-lat0)) * maths.cos(2*(lat+lat0))
+    Md = (35.0/24.0)*n3 * maths.sin(3*(lat-lat0)) * maths.cos(3*(lat+lat0))
     M = b * F0 * (Ma - Mb + Mc - Md)              # meridional arc
 
     cos3lat = cosLat*cosLat*cosLat
     cos5lat = cos3lat*cosLat*cosLat
-    tan2lat = math.tan(lat)*math.tan(lat)
+    tan2lat = maths.tan(lat)*maths.tan(lat)
     tan4lat = tan2lat*tan2lat
 
     I = M + N0
@@ -201,8 +227,7 @@ def LatLongToOSGrid(lat, lon):
 
     N = I + II*dLon2 + III*dLon4 + IIIA*dLon6
     E = E0 + IV*dLon + V*dLon3 + VI*dLon5
-
-    return (int(round(E)), int(round(N)))
+    return (E, N)
 
 def gridrefNumToLet(e, n, digits=10):
     """
@@ -235,6 +260,19 @@ def gridrefNumToLet(e, n, digits=10):
     return gridRef
 
 
+# ellipse parameters
+ELLIPSES = { 'WGS84':    { 'a': 6378137.0,   'b': 6356752.3142, 'f': 1/298.257223563 },
+             'Airy1830': { 'a': 6377563.396, 'b': 6356256.910,  'f': 1/299.3249646   } }
+
+# helmert transform parameters
+HELMERT_TRANSFORMS = { 'WGS84toOSGB36': { 'tx': -446.448,  'ty':  125.157,   'tz': -542.060,   # m
+                                          'rx':   -0.1502, 'ry':   -0.2470,  'rz':   -0.8421,  # sec
+                                          's':    20.4894 },                               # ppm
+                       'OSGB36toWGS84': { 'tx':  446.448,  'ty': -125.157,   'tz':  542.060,
+                                          'rx':    0.1502, 'ry':    0.2470,  'rz':    0.8421,
+                                          's':   -20.4894 } }
+
+
 def convertWGS84toOSGB36(lat, lon, height=0):
     """
     Convert a latitude & longitude from WGS84 (used by GPS) and return a (latitude, longitude)
@@ -243,40 +281,39 @@ def convertWGS84toOSGB36(lat, lon, height=0):
     This allows us to convert from one model of the earth's spherality to another and make our
     geolocations *really* accurate
     """
-    # ellipse parameters
-    e = { 'WGS84':    { 'a': 6378137.0,   'b': 6356752.3142, 'f': 1/298.257223563 },
-              'Airy1830': { 'a': 6377563.396, 'b': 6356256.910,  'f': 1/299.3249646   } }
-
-    # helmert transform parameters
-    h = { 'WGS84toOSGB36': { 'tx': -446.448,  'ty':  125.157,   'tz': -542.060,   # m
-                               'rx':   -0.1502, 'ry':   -0.2470,  'rz':   -0.8421,  # sec
-                               's':    20.4894 },                               # ppm
-          'OSGB36toWGS84': { 'tx':  446.448,  'ty': -125.157,   'tz':  542.060,
-                               'rx':    0.1502, 'ry':    0.2470,  'rz':    0.8421,
-                               's':   -20.4894 } }
-
-    return convert(lat, lon, height, e['WGS84'], h['WGS84toOSGB36'], e['Airy1830'])
+    return convert(lat, lon, height, ELLIPSES['WGS84'], HELMERT_TRANSFORMS['WGS84toOSGB36'], ELLIPSES['Airy1830'])
 
 
 def convert(lat, lon, height, e1, t, e2):
     """
     General-purpose spheroid conversion function
     """
+    (lat, lon, height) = convertUsing(lat, lon, height, e1, t, e2, math)
+    # Rounding to 7 decimal places in a degree gives us about +/- 0.01m accuracy
+    return (round(lat, 7), round(lon, 7), height)
+
+
+def convertUsing(lat, lon, height, e1, t, e2, maths):
+    """
+    Does the work of convert(), returning an unrounded (latitude, longitude, height). maths is the module to do the sums with -
+    math if lat & lon are numbers, or numpy if they are NumPy arrays of them
+    """
+    atan2 = maths is math and math.atan2 or maths.arctan2
     # -- convert polar to cartesian coordinates (using ellipse 1)
-    lat = math.radians(lat)
-    lon = math.radians(lon)
+    lat = maths.radians(lat)
+    lon = maths.radians(lon)
 
     a = e1['a']
     b = e1['b']
 
-    sinPhi = math.sin(lat)
-    cosPhi = math.cos(lat)
-    sinLambda = math.sin(lon)
-    cosLambda = math.cos(lon)
+    sinPhi = maths.sin(lat)
+    cosPhi = maths.cos(lat)
+    sinLambda = maths.sin(lon)
+    cosLambda = maths.cos(lon)
     H = height
 
     eSq = (a*a - b*b) / (a*a)
-    nu = a / math.sqrt(1 - eSq*sinPhi*sinPhi)
+    nu = a / maths.sqrt(1 - eSq*sinPhi*sinPhi)
 
     x1 = (nu+H) * cosPhi * cosLambda
     y1 = (nu+H) * cosPhi * sinLambda
@@ -305,19 +342,18 @@ def convert(lat, lon, height, e1, t, e2):
     # results accurate to around 4 metres
 
     eSq = (a*a - b*b) / (a*a)
-    p = math.sqrt(x2*x2 + y2*y2)
-    phi = math.atan2(z2, p*(1-eSq))
-    phiP = 2*math.pi
-    while (math.fabs(phi-phiP) > precision):
-        nu = a / math.sqrt(1 - eSq*math.sin(phi)*math.sin(phi))
+    p = maths.sqrt(x2*x2 + y2*y2)
+    phi = atan2(z2, p*(1-eSq))
+    phiP = phi*0 + 2*math.pi
+    # With arrays, keep going until every point has converged - those that already have just change by a negligible amount
+    while maths is math and math.fabs(phi-phiP) > precision or maths is not math and numpy.any(numpy.fabs(phi-phiP) > precision):
+        nu = a / maths.sqrt(1 - eSq*maths.sin(phi)*maths.sin(phi))
         phiP = phi
-        phi = math.atan2(z2 + eSq*nu*math.sin(phi), p)
+        phi = atan2(z2 + eSq*nu*maths.sin(phi), p)
 
-    Lambda = math.atan2(y2, x2)
-    H = p/math.cos(phi) - nu
-
-    # Rounding to 7 decimal places in a degree gives us about +/- 0.01m accuracy
-    return (round(math.degrees(phi), 7), round(math.degrees(Lambda), 7), H)
+    Lambda = atan2(y2, x2)
+    H = p/maths.cos(phi) - nu
+    return (maths.degrees(phi), maths.degrees(Lambda), H)
 
 
 def convertWGS84toOSEastingNorthing(latitude, longitude):
@@ -329,6 +365,186 @@ def convertWGS84toOSEastingNorthing(latitude, longitude):
     return (easting, northing)
 
 
+def OSGridToLatLong(E, N):
+    """
+    Convert an OS grid reference, as an easting & northing, to Geodesic co-ordinates returned as a (latitude, longitude) tuple
+    """
+    a = 6377563.396
+    b = 6356256.910          # Airy 1830 major & minor semi-axes
+    F0 = 0.9996012717                         # NatGrid scale factor on central meridian
+    lat0 = math.radians(49)
+    lon0 = math.radians(-2)  # NatGrid true origin
+    N0 = -100000
+    E0 = 400000                 # northing & easting of true origin, metres
+    e2 = 1 - (b*b)/(a*a)                      # eccentricity squared
+    n = (a-b)/(a+b)
+    n2 = n*n
+    n3 = n*n*n
+
+    lat = lat0
+    M = 0
+    # Iterate until the northing's error is under 0.01mm
+    while True:
+        lat = (N-N0-M)/(a*F0) + lat
+
+        Ma = (1 + n + (5.0/4.0)*n2 + (5.0/4.0)*n3) * (lat-lat0)
+        Mb = (3*n + 3*n*n + (21.0/8.0)*n3) * math.sin(lat-lat0) * math.cos(lat+lat0)
+        Mc = ((15.0/8.0)*n2 + (15.0/8.0)*n3) * math.sin(2*(lat-lat0)) * math.cos(2*(lat+lat0))
+        Md = (35.0/24.0)*n3 * math.sin(3*(lat-lat0)) * math.cos(3*(lat+lat0))
+        M = b * F0 * (Ma - Mb + Mc - Md)              # meridional arc
+        if math.fabs(N-N0-M) < 0.00001:
+            break
+
+    cosLat = math.cos(lat)
+    sinLat = math.sin(lat)
+    nu = a*F0/math.sqrt(1-e2*sinLat*sinLat)              # transverse radius of curvature
+    rho = a*F0*(1-e2)/math.pow(1-e2*sinLat*sinLat, 1.5)  # meridional radius of curvature
+    eta2 = nu/rho-1
+
+    tanLat = math.tan(lat)
+    tan2lat = tanLat*tanLat
+    tan4lat = tan2lat*tan2lat
+    tan6lat = tan4lat*tan2lat
+    secLat = 1/cosLat
+    nu3 = nu*nu*nu
+    nu5 = nu3*nu*nu
+    nu7 = nu5*nu*nu
+    VII = tanLat/(2*rho*nu)
+    VIII = tanLat/(24*rho*nu3)*(5+3*tan2lat+eta2-9*tan2lat*eta2)
+    IX = tanLat/(720*rho*nu5)*(61+90*tan2lat+45*tan4lat)
+    X = secLat/nu
+    XI = secLat/(6*nu3)*(nu/rho+2*tan2lat)
+    XII = secLat/(120*nu5)*(5+28*tan2lat+24*tan4lat)
+    XIIA = secLat/(5040*nu7)*(61+662*tan2lat+1320*tan4lat+720*tan6lat)
+
+    dE = E-E0
+    dE2 = dE*dE
+    dE3 = dE2*dE
+    dE4 = dE2*dE2
+    dE5 = dE3*dE2
+    dE6 = dE4*dE2
+    dE7 = dE5*dE2
+    lat = lat - VII*dE2 + VIII*dE4 - IX*dE6
+    lon = lon0 + X*dE - XI*dE3 + XII*dE5 - XIIA*dE7
+
+    return (math.degrees(lat), math.degrees(lon))
+
+
+def convertOSGB36toWGS84(lat, lon, height=0):
+    """
+    Convert a latitude & longitude from OSGB36 (used by OS maps) and return a (latitude, longitude)
+    tuple of its equivalent in the WGS84 system (used by GPS)
+    """
+    return convert(lat, lon, height, ELLIPSES['Airy1830'], HELMERT_TRANSFORMS['OSGB36toWGS84'], ELLIPSES['WGS84'])
+
+
+def convertOSEastingNorthingtoWGS84(easting, northing):
+    """
+    Convert an OS (easting, northing) position, returns a WGS84 (latitude, longitude) tuple
+    """
+    (latitude, longitude) = OSGridToLatLong(easting, northing)
+    (new_latitude, new_longitude, _ignore) = convertOSGB36toWGS84(latitude, longitude)
+    return (new_latitude, new_longitude)
+
+
+# Batch versions of the above, for converting many points at once. Each takes sequences of latitudes and longitudes and
+# returns a tuple of sequences. If NumPy is installed these are NumPy arrays worked on as a whole; if not, they are lists
+# filled by calling the functions above on each point in turn
+def LatLongToOSGridArrays(lats, lons):
+    """
+    Convert sequences of Geodesic co-ordinates to OS grid references, returned as an (eastings, northings) tuple of sequences
+    """
+    if numpy is None:
+        grid_references = [LatLongToOSGrid(lat, lon) for (lat, lon) in zip(lats, lons)]
+        return ([easting for (easting, _northing) in grid_references], [northing for (_easting, northing) in grid_references])
+
+    (E, N) = LatLongToOSGridUsing(numpy.asarray(lats, dtype=float), numpy.asarray(lons, dtype=float), numpy)
+    return (numpy.round(E).astype(int), numpy.round(N).astype(int))
+
+
+def convertWGS84toOSGB36Arrays(lats, lons, height=0):
+    """
+    Convert sequences of latitudes & longitudes from WGS84 to OSGB36, returned as a (latitudes, longitudes, heights) tuple of sequences
+    """
+    if numpy is None:
+        positions = [convertWGS84toOSGB36(lat, lon, height) for (lat, lon) in zip(lats, lons)]
+        return ([position[0] for position in positions], [position[1] for position in positions], [position[2] for position in positions])
+    return convertArrays(lats, lons, height, ELLIPSES['WGS84'], HELMERT_TRANSFORMS['WGS84toOSGB36'], ELLIPSES['Airy1830'])
+
+
+def convertArrays(lats, lons, height, e1, t, e2):
+    """
+    General-purpose spheroid conversion function for NumPy arrays of co-ordinates - see convert() above
+    """
+    (lats, lons, height) = convertUsing(numpy.asarray(lats, dtype=float), numpy.asarray(lons, dtype=float), height, e1, t, e2, numpy)
+    # Rounding to 7 decimal places in a degree gives us about +/- 0.01m accuracy
+    return (numpy.round(lats, 7), numpy.round(lons, 7), height)
+
+
+def convertWGS84toOSEastingNorthingArrays(lats, lons):
+    """
+    Convert sequences of WGS84 latitudes & longitudes, returns an (eastings, northings) tuple of sequences
+    """
+    (new_lats, new_lons, _ignore) = convertWGS84toOSGB36Arrays(lats, lons)
+    return LatLongToOSGridArrays(new_lats, new_lons)
+
+
+# Fast path for positions in and around London, where nearly all our users are. Eastings & northings here are interpolated from
+# a grid of exact conversions every LONDON_GRID_STEP degrees, built the first time it is needed. Interpolated values are within
+# about 0.3m of the exact ones, so within 1m once rounded; anywhere outside the grid we fall back to the exact conversion
+LONDON_GRID_BOUNDS = (51.15, 51.85, -0.65, 0.5)  # South, North, West, East
+LONDON_GRID_STEP = 0.05
+LONDON_GRID = []
+
+
+def getLondonGrid():
+    """
+    Return the grid of exact (easting, northing) conversions for London, as a list of rows running South to North, each a list
+    of unrounded (easting, northing) tuples running West to East. The grid is built when this is first called
+    """
+    if not LONDON_GRID:
+        (south, north, west, east) = LONDON_GRID_BOUNDS
+        rows = int(round((north - south) / LONDON_GRID_STEP)) + 1
+        columns = int(round((east - west) / LONDON_GRID_STEP)) + 1
+        for i in range(rows):
+            row = []
+            for j in range(columns):
+                (lat, lon, _ignore) = convertWGS84toOSGB36(south + i * LONDON_GRID_STEP, west + j * LONDON_GRID_STEP)
+                row.append(LatLongToOSGrid(lat, lon, rounded=False))
+            LONDON_GRID.append(row)
+    return LONDON_GRID
+
+
+def isInLondonGrid(latitude, longitude):
+    """
+    Return True if the WGS84 (latitude, longitude) position is covered by the London interpolation grid
+    """
+    (south, north, west, east) = LONDON_GRID_BOUNDS
+    return south <= latitude < north and west <= longitude < east
+
+
+def approximateWGS84toOSEastingNorthing(latitude, longitude):
+    """
+    Convert a WGS84 (latitude, longitude) position, returns a (easting, northing) tuple accurate to within 1m. Positions in
+    and around London are interpolated from a precomputed grid; anywhere else is converted exactly
+    """
+    if not isInLondonGrid(latitude, longitude):
+        return convertWGS84toOSEastingNorthing(latitude, longitude)
+
+    # Bilinear interpolation between the four grid points surrounding the position
+    grid = getLondonGrid()
+    (south, _north, west, _east) = LONDON_GRID_BOUNDS
+    (i, u) = divmod((latitude - south) / LONDON_GRID_STEP, 1)
+    (j, v) = divmod((longitude - west) / LONDON_GRID_STEP, 1)
+    i = min(int(i), len(grid) - 2)
+    j = min(int(j), len(grid[0]) - 2)
+    ((e00, n00), (e01, n01)) = grid[i][j:j+2]
+    ((e10, n10), (e11, n11)) = grid[i+1][j:j+2]
+    easting = (1-u)*(1-v)*e00 + (1-u)*v*e01 + u*(1-v)*e10 + u*v*e11
+    northing = (1-u)*(1-v)*n00 + (1-u)*v*n01 + u*(1-v)*n10 + u*v*n11
+    return (int(round(easting)), int(round(northing)))
+
+
 def heading_to_direction(heading):
     """
     Helper function to convert a heading (in degrees), returns a human-readable direction as a string
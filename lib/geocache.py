@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""
+Geocode cache for When's My Transport - remembers the places found by a geocoder between sessions, so we do not have to ask
+the geocoder about the same place again and again
+"""
+import cPickle as pickle
+import logging
+import time
+
+from lib.database import WMTDatabase
+from lib.stringutils import normalise_placename
+
+GEOCODE_CACHE_MAXIMUM_AGE = 30 * 24 * 60 * 60  # 30 days maximum cache age
+GEOCODE_CACHE_MAXIMUM_SIZE = 10000  # Maximum number of placenames to remember
+
+
+class WMTGeocodeCache():
+    """
+    Class representing a persistent cache of geocoded placenames for When's My Transport
+
+    Placenames are normalised (so "Oxford Circus" and "oxford circus." are the same) and the points found for each are stored
+    as a list of (latitude, longitude) tuples. Entries older than maximum_age seconds are ignored, and once there are more than
+    maximum_size entries the oldest are deleted. Hits and misses are counted so we can see how useful the cache is
+    """
+    def __init__(self, instance_name, maximum_age=GEOCODE_CACHE_MAXIMUM_AGE, maximum_size=GEOCODE_CACHE_MAXIMUM_SIZE):
+        self.instance_name = instance_name
+        self.maximum_age = maximum_age
+        self.maximum_size = maximum_size
+        self.hits = 0
+        self.misses = 0
+        self.cachedb = WMTDatabase('%s.geocodecache.db' % self.instance_name)
+        self.cachedb.write_query("create table if not exists geocode_cache (placename unique, points, time_cached)")
+        self.cachedb.write_query("create index if not exists time_cached_index on geocode_cache (time_cached)")
+
+    def get_points(self, placename):
+        """
+        Fetch the list of points for placename from the cache. Returns None if it is not in the cache or has expired
+        """
+        normalised_name = normalise_placename(placename)
+        points = self.cachedb.get_value("select points from geocode_cache where placename = ? and time_cached > ?",
+                                        (normalised_name, time.time() - self.maximum_age))
+        if points is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            points = pickle.loads(points.encode('utf-8'))
+        logging.debug("Geocode cache %s for %s", points is None and "miss" or "hit", placename)
+        return points
+
+    def add_points(self, placename, points):
+        """
+        Add the list of points for placename to the cache, deleting the oldest entries if the cache has got too big
+        """
+        normalised_name = normalise_placename(placename)
+        if not normalised_name:
+            return
+        self.cachedb.write_query("insert or replace into geocode_cache (placename, points, time_cached) values (?, ?, ?)",
+                                 (normalised_name, pickle.dumps(points), time.time()))
+        size = self.cachedb.get_value("select count(*) from geocode_cache")
+        if size > self.maximum_size:
+            logging.debug("Geocode cache has %s entries, deleting the oldest %s", size, size - self.maximum_size)
+            self.cachedb.write_query("delete from geocode_cache where placename in "
+                                     "(select placename from geocode_cache order by time_cached limit ?)", (size - self.maximum_size,))
+
+    def get_hit_rate(self):
+        """
+        Return the percentage of lookups in this session that were found in the cache
+        """
+        lookups = self.hits + self.misses
+        return lookups and 100.0 * self.hits / lookups or 0.0
+
+    def report_hit_rate(self):
+        """
+        Log how many lookups in this session were found in the cache
+        """
+        if self.hits or self.misses:
+            logging.info("Geocode cache found %s out of %s places looked up, a hit rate of %.0f%%", self.hits, self.hits + self.misses,
+                         self.get_hit_rate())
@@ -4,9 +4,9 @@ List & Iterable Utilities for WhensMyTransport
 """
 
 
-def unique_values(seq):
+def unique_values(seq, limit=None):
     """
-    Return unique values of sequence seq, according to ID function idfun.
+    Return unique values of sequence seq, according to ID function idfun. If limit is specified, stop once that many have been found
 
     From http://www.peterbe.com/plog/uniqifiers-benchmark and modified. Values in seq must be hashable for this to work
     """
@@ -17,4 +17,19 @@ def unique_values(seq):
             continue
         seen[item] = 1
         result.append(item)
+        if len(result) == limit:
+            break
     return result
+
+
+def values_not_in(seq, *exclusions):
+    """
+    Return the values of sequence seq that are not in any of the iterables in exclusions, in the same order as they are in seq
+
+    The exclusions are put into one set first, so this takes time in proportion to the total length of everything, rather than
+    to the product of the lengths as testing membership of lists would. Values must be hashable for this to work
+    """
+    excluded = set()
+    for exclusion in exclusions:
+        excluded.update(exclusion)
+    return [item for item in seq if item not in excluded]
@@ -3,22 +3,24 @@
 """
 Location-finding service for WhensMyTransport
 """
-import cPickle as pickle
 import logging
 from math import sqrt, ceil
 import os.path
 from pprint import pprint
+import re
+import sqlite3
 
-# http://code.google.com/p/python-graph/
-from pygraph.algorithms.minmax import shortest_path
-
+from lib.exceptions import WhensMyTransportException
 from lib.models import Location, BusStop, RailStation
 from lib.stringutils import get_best_fuzzy_match
 from lib.database import WMTDatabase
-from lib.geo import convertWGS84toOSEastingNorthing
+from lib.geo import convertWGS84toOSEastingNorthing, convertWGS84toOSEastingNorthingArrays
+from lib.network import WMTNetwork
 
 
 DB_PATH = os.path.normpath(os.path.dirname(os.path.abspath(__file__)) + '/../db/')
+# A UK postcode, e.g. EC1M 4PN
+POSTCODE_REGEX = re.compile(r'^[A-Z]{1,2}[0-9][0-9A-Z]? ?[0-9][A-Z]{2}$', re.I)
 
 
 class WMTLocations():
@@ -27,7 +29,7 @@ class WMTLocations():
     will return the best matching stop. Subclassed and not called directly
     """
     def __init__(self, instance_name):
-        self.database = WMTDatabase('%s.geodata.db' % instance_name)
+        self.database = WMTDatabase('%s.geodata.db' % instance_name, read_only=True)
         self.network = None
         self.returned_object = Location
 
@@ -62,6 +64,34 @@ class WMTLocations():
             logging.debug("No location found near %s, sorry", position)
             return None
 
+    def find_closest_for_each(self, positions, params, column):
+        """
+        Find the closest location to any of the (lat, long) positions in the list positions, for each different value of column
+        among the locations matching the dictionary params (of the format { Column Name : value }). Returns a dictionary, with
+        the values of column as keys and objects of class returned_object as values
+
+        This takes just the one database query, however many positions there are
+        """
+        if not positions:
+            return {}
+        (eastings, northings) = convertWGS84toOSEastingNorthingArrays([position[0] for position in positions],
+                                                                      [position[1] for position in positions])
+
+        # As with find_closest() above, the smallest square of the distance will do to find the closest. Each location's is the
+        # smallest to any of the positions, and sqlite gives us the rest of the columns of the row with the smallest in each group
+        dist_squared_sums = ["(location_easting - %d)*(location_easting - %d) + (location_northing - %d)*(location_northing - %d)"
+                             % (easting, easting, northing, northing) for (easting, northing) in zip(eastings, northings)]
+        dist_squared = len(dist_squared_sums) > 1 and "MIN(%s)" % ", ".join(dist_squared_sums) or dist_squared_sums[0]
+        (where_statement, where_values) = self.database.make_where_statement('locations', params)
+        query = """
+                SELECT *, MIN(%s) AS dist_squared
+                FROM locations
+                WHERE %s
+                GROUP BY %s
+                """ % (dist_squared, where_statement, column)
+        rows = self.database.get_rows(query, where_values)
+        return dict([(row[column], self.returned_object(Distance=sqrt(row['dist_squared']), **row)) for row in rows])
+
     def find_fuzzy_match(self, stop_or_station_name, params):
         """
         Find the best fuzzy match to the query_string, querying the database with dictionary params, of the format
@@ -106,6 +136,22 @@ class BusStopLocations(WMTLocations):
     def __init__(self):
         WMTLocations.__init__(self, 'whensmybus')
         self.returned_object = BusStop
+        self.routes = None
+
+    def get_route_details(self, route_number):
+        """
+        Return a tuple of the number of runs and the number of stops the route with route_number has, or None if there is no such route
+
+        Every route's details are read the first time this is called, from the routes table made by datatools (or worked out from
+        the locations table, if the database was made before it had one)
+        """
+        if self.routes is None:
+            if self.database.check_existence_of('sqlite_master', 'name', 'routes'):
+                rows = self.database.get_rows("SELECT route, runs, stops FROM routes")
+            else:
+                rows = self.database.get_rows("SELECT route, MAX(run), COUNT(*) FROM locations GROUP BY route")
+            self.routes = dict([(route, (runs, stops)) for (route, runs, stops) in rows])
+        return self.routes.get(route_number)
 
 
 class RailStationLocations(WMTLocations):
@@ -114,16 +160,31 @@ class RailStationLocations(WMTLocations):
     """
     def __init__(self):
         WMTLocations.__init__(self, 'whensmytrain')
-        network_file = DB_PATH + '/whensmytrain.network.gr'
+        network_file = DB_PATH + '/whensmytrain.network.bin'
         logging.debug("Opening network node data %s", os.path.basename(network_file))
-        self.network = pickle.load(open(network_file))
+        station_positions = dict([(row['name'], (row['location_easting'], row['location_northing']))
+                                  for row in self.database.get_rows("SELECT name, location_easting, location_northing FROM locations")])
+        self.network = WMTNetwork(network_file, station_positions)
         self.returned_object = RailStation
+        # The quickest direct line between every pair of stations can be worked out in advance by datatools - if it has been, use it
+        direct_lines_file = 'whensmytrain.directlines.db'
+        self.direct_lines = os.path.exists(DB_PATH + '/' + direct_lines_file) and WMTDatabase(direct_lines_file, read_only=True) or None
 
     def get_lines_serving(self, origin, destination=None):
         """
         Return a list of line codes that the RailStation origin is served by. If RailStation destination is specified, then
         only the quickest line that directly goes from origin to destination is returned as a single element of that list
         """
+        if destination and self.direct_lines:
+            line_code = self.direct_lines.get_value("SELECT line FROM direct_lines WHERE origin_code=? AND destination_name=?",
+                                                    (origin.code, destination.name))
+            return line_code and [line_code] or []
+        return self.find_lines_serving(origin, destination)
+
+    def find_lines_serving(self, origin, destination=None):
+        """
+        Work out the list of line codes for get_lines_serving(), without looking up the quickest direct line in advance
+        """
         rows = self.database.get_rows("SELECT name,line FROM locations WHERE code=?", (origin.code,))
         stations = [(RailStation(name), line) for (name, line) in rows]
         # If a destination exists, filter using it. If multiple ways of getting to destination,
@@ -143,9 +204,10 @@ class RailStationLocations(WMTLocations):
         """
         origin_name = origin.name + ":entrance"
         destination_name = destination.name + ":exit"
-        network = self.network[line_code]
-        shortest_path_times = shortest_path(network, origin_name)[1]
-        return int(ceil(shortest_path_times.get(destination_name, -1)))
+        time_taken = self.network.find_route(origin_name, destination_name, line_code)[1]
+        if time_taken is None:
+            return -1
+        return int(ceil(time_taken))
 
     def describe_route(self, origin, destination, line_code='All', via=None):
         """
@@ -164,22 +226,9 @@ class RailStationLocations(WMTLocations):
         origin_name = origin.name + ":entrance"
         destination_name = destination.name + ":exit"
 
-        network = self.network[line_code]
-        shortest_path_values = shortest_path(network, origin_name)
-        shortest_path_dictionary = shortest_path_values[0]
-
-        if origin_name not in shortest_path_dictionary or destination_name not in shortest_path_dictionary:
-            return []
-        # Shortest path dictionary consists of a dictionary of node names as keys, with the values
-        # being the name of the node that preceded it in the shortest path
-        # Count back from our destinaton, to the origin point
-        path_taken = []
-        while destination_name:
-            path_taken.append(tuple(destination_name.split(":")))
-            destination_name = shortest_path_dictionary[destination_name]
-
-        # Trim off the entrance & exit nodes and reverse the list to get it in the right order
-        path_taken = path_taken[1:-1][::-1]
+        route = self.network.find_route(origin_name, destination_name, line_code)[0]
+        # Trim off the entrance & exit nodes to get just the platforms we go through
+        path_taken = [tuple(node_name.split(":")) for node_name in route[1:-1]]
         return path_taken
 
     def direct_route_exists(self, origin, destination, line_code, via=None, must_stop_at=None):
@@ -251,3 +300,69 @@ class RailStationLocations(WMTLocations):
             return self.is_correct_direction(train.direction, origin, desired_station, train.line_code)
         else:
             return False
+
+    def get_trains_stopping_at(self, trains, origin, desired_station):
+        """
+        Return a list of the Trains in trains from RailStation origin that will stop at RailStation desired_station on the way
+
+        Trains with the same destination, via, direction and line all take the same route, so we only work out whether they stop
+        at desired_station once for each of these
+        """
+        stops_at_desired_station = {}
+        stopping_trains = []
+        for train in trains:
+            route_key = (train.destination_name, train.via_name, train.direction, train.line_code)
+            if route_key not in stops_at_desired_station:
+                stops_at_desired_station[route_key] = self.does_train_stop_at(train, origin, desired_station)
+            if stops_at_desired_station[route_key]:
+                stopping_trains.append(train)
+        return stopping_trains
+
+
+class LocalGeocoder():
+    """
+    Geocoder using our own gazetteer of bus stop, station and place names, built by datatools.py - so no web service is needed.
+    It has the same geocode() method as the web geocoders in lib.geo, so can be used in place of any of them
+
+    The gazetteer has no postcodes in it, so these are looked up with fallback_geocoder (a web geocoder) if we have one, and are
+    otherwise not found
+    """
+    def __init__(self, fallback_geocoder=None, gazetteer_filename='whensmytransport.gazetteer.db', max_results=10):
+        """
+        Constructor
+        """
+        self.database = None
+        self.fallback_geocoder = fallback_geocoder
+        self.gazetteer_filename = gazetteer_filename
+        self.max_results = max_results
+
+    def geocode(self, placename, browser=None):
+        """
+        Look up placename in the gazetteer, and return list of matching place(s), each represented by a (latitude, longitude) tuple
+
+        Names are normalised the same way as bus stop names, and an exact match is preferred, but failing that we look for names
+        beginning with placename (e.g. "Hoxton" will find "Hoxton Station"). browser is only needed by the fallback geocoder.
+        Raises a WhensMyTransportException if the gazetteer cannot be read
+        """
+        if POSTCODE_REGEX.match(placename.strip()):
+            if self.fallback_geocoder:
+                return self.fallback_geocoder.geocode(placename, browser)
+            logging.debug("%s looks like a postcode, which the gazetteer does not have", placename)
+            return []
+        normalised_name = BusStop(placename).get_normalised_name()
+        if not normalised_name:
+            return []
+        try:
+            if not self.database:
+                self.database = WMTDatabase(self.gazetteer_filename, read_only=True)
+            query = "SELECT latitude, longitude FROM gazetteer WHERE normalised_name = ? LIMIT ?"
+            rows = self.database.get_rows(query, (normalised_name, self.max_results))
+            if not rows:
+                # Normalised names are only ever upper-case letters, numbers and underscores, all of which sort before a tilde, so
+                # this range (unlike a LIKE) can make use of the index on normalised_name
+                query = "SELECT latitude, longitude FROM gazetteer WHERE normalised_name > ? AND normalised_name < ? ORDER BY normalised_name LIMIT ?"
+                rows = self.database.get_rows(query, (normalised_name, normalised_name + '~', self.max_results))
+        except (IOError, sqlite3.Error) as exc:
+            logging.error("Could not read the gazetteer: %s", exc)
+            raise WhensMyTransportException('geocoder_down')
+        return [(row['latitude'], row['longitude']) for row in rows]
@@ -3,23 +3,93 @@
 """
 Models and abstractions of concepts such as stations, trains, bus stops etc.
 """
-from datetime import datetime, timedelta
+from datetime import datetime
+from operator import attrgetter
 import logging
 import re
 
 from lib.listutils import unique_values
-from lib.stringutils import cleanup_name_from_undesirables, get_name_similarity
+from lib.stringutils import cleanup_name_from_undesirables, compile_undesirables, get_name_similarity, intern_name
+
+# Regular expressions and lookup tables used to clean up & abbreviate names. These are used for every location and departure
+# we create, so are compiled just the once here
+
+# TfL's ASCII symbols for Tube, National Rail, DLR & Tram in bus stop names
+BUS_STOP_SYMBOLS = compile_undesirables(('<>', '#', r'\[DLR\]', '>T<'))
+# Upper-cased road names and their abbreviations, and common words like 'The', in bus stop names
+BUS_STOP_ABBREVIATIONS = tuple([(re.compile(r'\b' + word + r'\b'), abbreviation) for (word, abbreviation) in
+                                (('SQUARE', 'SQ'), ('AVENUE', 'AVE'), ('STREET', 'ST'), ('ROAD', 'RD'), ('STATION', 'STN'),
+                                 ('PUBLIC HOUSE', 'PUB'), ('THE', ''))])
+NON_WORD_CHARACTERS = re.compile(r'[\W]')
+
+# Stations we just have to cut down by hand
+STATION_TRANSLATIONS = {
+    "High Street Kensington": "High St Ken",
+    "King's Cross St. Pancras": "Kings X St P",
+    "Kensington (Olympia)": "Olympia",
+    "W'wich Arsenal": "Woolwich A",
+}
+# Punctuation marks in station names that can be cut down
+STATION_PUNCTUATION = compile_undesirables((r'\.', ', ', r'\(', r'\)', "'",))
+# Words in station names like Road and Park that can be slimmed down as well
+STATION_ABBREVIATIONS = {
+    'Bridge': 'Br',
+    'Broadway': 'Bdwy',
+    'Central': 'Ctrl',
+    'Court': 'Ct',
+    'Cross': 'X',
+    'Crescent': 'Cresc',
+    'East': 'E',
+    'Gardens': 'Gdns',
+    'Green': 'Grn',
+    'Heathway': 'Hthwy',
+    'Junction': 'Jct',
+    'Market': 'Mkt',
+    'North': 'N',
+    'Park': 'Pk',
+    'Road': 'Rd',
+    'South': 'S',
+    'Square': 'Sq',
+    'Street': 'St',
+    'Terminal': 'T',
+    'Terminals': 'T',
+    'West': 'W',
+}
+
+# Regular expressions of instructions, depot names (presumably instructions for shunting after arrival), or platform numbers
+# that TfL put in Tube trains' destinations, plus the "and" and "via" parts of those destinations
+TUBE_DESTINATION_UNDESIRABLES = compile_undesirables(('\(rev to .*\)',
+                                                      '\(Rev\) Bank Branch',
+                                                      r'sidings?\b',
+                                                      '(then )?depot',
+                                                      'ex (barnet|edgware) branch',
+                                                      '\(ex .*\)',
+                                                      '/ london road',
+                                                      '27 Road',
+                                                      r'24r/25r',
+                                                      '\(plat\. [0-9]+\)',
+                                                      ' loop',
+                                                      '\(circle\)',
+                                                      '\(district\)',))
+TUBE_DESTINATION_AND = re.compile(r"\band\b", flags=re.I)
+TUBE_DESTINATION_VIA = re.compile(" \(?via ([^)]*)\)?$", flags=re.I)
+TUBE_DESTINATION_VIA_AND_AFTER = re.compile(" \(?via .*$", flags=re.I)
 
 
 #
 # Representations of stations, stops etc
 #
 
-class Location():
+class Location(object):
     #pylint: disable=R0903
     """
     Class representing any kind of location (bus stop or station)
+
+    Locations and departures are created in their hundreds for every request, so these classes all use __slots__
+    rather than per-instance dictionaries to save memory
     """
+    __slots__ = ('name',)
+
     def __init__(self, name):
         self.name = name
 
@@ -38,6 +108,8 @@ class BusStop(Location):
     """
     Class representing a bus stop
     """
+    __slots__ = ('number', 'heading', 'sequence', 'distance_away', 'run', '_clean_name', '_normalised_name')
+
     def __init__(self, name='', bus_stop_code='', heading=0, sequence=1, distance=0.0, run=0, **kwargs):
         Location.__init__(self, name)
         self.number = bus_stop_code
@@ -45,6 +117,9 @@ class BusStop(Location):
         self.sequence = sequence
         self.distance_away = distance
         self.run = run
+        # Clean & normalised names are worked out the first time they are asked for, and then kept
+        self._clean_name = None
+        self._normalised_name = None
 
     def __cmp__(self, other):
         return cmp(self.distance_away, other.distance_away)
@@ -59,26 +134,28 @@ class BusStop(Location):
         """
         Get rid of TfL's ASCII symbols for Tube, National Rail, DLR & Tram from this stop's name
         """
-        return cleanup_name_from_undesirables(self.name, ('<>', '#', r'\[DLR\]', '>T<'))
+        if self._clean_name is None:
+            self._clean_name = cleanup_name_from_undesirables(self.name, BUS_STOP_SYMBOLS)
+        return self._clean_name
 
     def get_normalised_name(self):
         """
         Normalise a bus stop name, sorting out punctuation, capitalisation, abbreviations & symbols
         """
-        # Upper-case and abbreviate road names
-        normalised_name = self.get_clean_name().upper()
-        for (word, abbreviation) in (('SQUARE', 'SQ'), ('AVENUE', 'AVE'), ('STREET', 'ST'), ('ROAD', 'RD'), ('STATION', 'STN'), ('PUBLIC HOUSE', 'PUB')):
-            normalised_name = re.sub(r'\b' + word + r'\b', abbreviation, normalised_name)
-        # Get rid of common words like 'The'
-        for common_word in ('THE',):
-            normalised_name = re.sub(r'\b' + common_word + r'\b', '', normalised_name)
-        # Remove spaces and punctuation and return
-        normalised_name = re.sub('[\W]', '', normalised_name)
-        return normalised_name
+        if self._normalised_name is None:
+            # Upper-case and abbreviate road names, and get rid of common words like 'The'
+            normalised_name = self.get_clean_name().upper()
+            for (word, abbreviation) in BUS_STOP_ABBREVIATIONS:
+                normalised_name = word.sub(abbreviation, normalised_name)
+            # Remove spaces and punctuation
+            self._normalised_name = NON_WORD_CHARACTERS.sub('', normalised_name)
+        return self._normalised_name
 
-    def get_similarity(self, test_string=''):
+    def get_similarity(self, test_string='', minimum_score=0):
         """
         Custom similarity match for bus stops - takes into account many of them will be from train stations or bus stations
+
+        minimum_score is passed on to get_name_similarity()
         """
         # Use the above function to normalise our names and facilitate easier comparison
         my_name = self.get_normalised_name()
@@ -89,20 +166,20 @@ class BusStop(Location):
 
         # If user has specified a station or bus station, then a partial match at start or end of string works for us
         # We prioritise, just slightly, names that have the match at the beginning
-        if re.search("(BUS)?STN", their_name):
+        if "STN" in their_name:
             if my_name.startswith(their_name):
                 return 95
             if my_name.endswith(their_name):
                 return 94
 
         # If on the other hand, we add station or bus station to their name and it matches, that's also pretty good
-        if re.search("^%s(BUS)?STN" % their_name, my_name):
+        if my_name.startswith(their_name + "STN") or my_name.startswith(their_name + "BUSSTN"):
             return 91
-        if re.search("%s(BUS)?STN$" % their_name, my_name):
+        if my_name.endswith(their_name + "STN") or my_name.endswith(their_name + "BUSSTN"):
             return 90
 
         # Else fall back on name similarity
-        return get_name_similarity(my_name, their_name)
+        return get_name_similarity(my_name, their_name, minimum_score)
 
 
 class RailStation(Location):
@@ -110,16 +187,28 @@ class RailStation(Location):
     """
     Class representing a railway station
     """
+    __slots__ = ('code', 'location_easting', 'location_northing', 'inner', 'outer', '_abbreviated_name')
+
     def __init__(self, name='', code='', location_easting=0, location_northing=0, inner='', outer='', **kwargs):
         Location.__init__(self, name)
         self.code = code
         self.location_easting = location_easting
         self.location_northing = location_northing
-        self.circular_directions = {'inner': inner, 'outer': outer}
+        self.inner = inner
+        self.outer = outer
+        # Abbreviated name is worked out the first time it is asked for, and then kept
+        self._abbreviated_name = None
 
     def __eq__(self, other):
         return self.name == other.name and self.code == other.code
 
+    @property
+    def circular_directions(self):
+        """
+        Dictionary translating 'inner' and 'outer' rails into compass directions, for stations on circular lines
+        """
+        return {'inner': self.inner, 'outer': self.outer}
+
     def get_name(self):
         """
         Return this station's name
@@ -130,59 +219,27 @@ class RailStation(Location):
         """
         Take this station's name and abbreviate it to make it fit on Twitter better
         """
-        # Stations we just have to cut down by hand
-        translations = {
-            "High Street Kensington": "High St Ken",
-            "King's Cross St. Pancras": "Kings X St P",
-            "Kensington (Olympia)": "Olympia",
-            "W'wich Arsenal": "Woolwich A",
-        }
-        station_name = translations.get(self.name, self.name)
-
-        # Punctuation marks can be cut down
-        punctuation_to_remove = (r'\.', ', ', r'\(', r'\)', "'",)
-        station_name = cleanup_name_from_undesirables(station_name, punctuation_to_remove)
-
-        # Words like Road and Park can be slimmed down as well
-        abbreviations = {
-            'Bridge': 'Br',
-            'Broadway': 'Bdwy',
-            'Central': 'Ctrl',
-            'Court': 'Ct',
-            'Cross': 'X',
-            'Crescent': 'Cresc',
-            'East': 'E',
-            'Gardens': 'Gdns',
-            'Green': 'Grn',
-            'Heathway': 'Hthwy',
-            'Junction': 'Jct',
-            'Market': 'Mkt',
-            'North': 'N',
-            'Park': 'Pk',
-            'Road': 'Rd',
-            'South': 'S',
-            'Square': 'Sq',
-            'Street': 'St',
-            'Terminal': 'T',
-            'Terminals': 'T',
-            'West': 'W',
-        }
-        station_name = ' '.join([abbreviations.get(word, word) for word in station_name.split(' ')])
-
-        # Any station with & in it gets only the initial of the second word - e.g. Elephant & C
-        if station_name.find('&') > -1:
-            station_name = station_name[:station_name.find('&') + 2]
-        return station_name
-
-    def get_similarity(self, test_string=''):
+        if self._abbreviated_name is None:
+            station_name = STATION_TRANSLATIONS.get(self.name, self.name)
+            station_name = cleanup_name_from_undesirables(station_name, STATION_PUNCTUATION)
+            station_name = ' '.join([STATION_ABBREVIATIONS.get(word, word) for word in station_name.split(' ')])
+            # Any station with & in it gets only the initial of the second word - e.g. Elephant & C
+            if station_name.find('&') > -1:
+                station_name = station_name[:station_name.find('&') + 2]
+            self._abbreviated_name = station_name
+        return self._abbreviated_name
+
+    def get_similarity(self, test_string='', minimum_score=0):
         """
         Custom similarity for train stations - takes into account fact many people use abbreviated names
+
+        minimum_score is passed on to get_name_similarity()
         """
         # For low-scoring matches, we try matching between a string the same size as the user query, if its shorter than the name
         # being tested against, so this works for e.g. Kings Cross matching King's Cross St Pancras
-        score = get_name_similarity(self.name, test_string)
+        score = get_name_similarity(self.name, test_string, minimum_score)
         if len(test_string) < len(self.name):
-            abbreviated_score = get_name_similarity(self.name[:len(test_string)], test_string)
+            abbreviated_score = get_name_similarity(self.name[:len(test_string)], test_string, minimum_score)
             if abbreviated_score >= 85 and abbreviated_score > score:
                 return min(abbreviated_score, 99)  # Never 100, in case it overrides an exact match
         return score
@@ -191,18 +248,38 @@ class RailStation(Location):
 # Representations of departures
 #
 
+MINUTES_IN_A_DAY = 24 * 60
+
 
-class Departure():
+def make_departure_time(minute_of_day, current_hour):
+    """
+    Take a time of day as the number of minutes since midnight, and the current hour, and return the departure time as used by
+    Departure objects - i.e. the number of minutes since midnight today
+
+    Deals with us being one side of midnight from the prescribed time - if the current hour is more than an hour after the hour of
+    departure, then the departure is taken as being tomorrow
+    """
+    minute_of_day %= MINUTES_IN_A_DAY
+    if current_hour > minute_of_day // 60 + 1:
+        minute_of_day += MINUTES_IN_A_DAY
+    return minute_of_day
+
+
+class Departure(object):
     """
     Class representing a train or bus
+
+    The departure time is stored as minutes since midnight today (see make_departure_time() above). It can be given to the
+    constructor in that form, or as a 24-hour clock string such as "2359"
     """
     #pylint: disable=R0903
+    __slots__ = ('destination', 'departure_time')
+
     def __init__(self, destination, departure_time):
-        self.destination = destination
-        self.departure_time = datetime.strptime(departure_time, "%H%M")
-        # Deal with us being one side of midnight from the prescribed times
-        if datetime.now().hour > self.departure_time.hour + 1:
-            self.departure_time += timedelta(days=1)
+        self.destination = intern_name(destination)
+        if isinstance(departure_time, basestring):
+            departure_time = make_departure_time(int(departure_time[:2]) * 60 + int(departure_time[2:4]), datetime.now().hour)
+        self.departure_time = departure_time
 
     def __cmp__(self, other):
         return cmp(self.departure_time, other.departure_time)
@@ -226,7 +303,7 @@ class Departure():
         """
         Returns human-readable version of departure time, in the 24-hour clock
         """
-        return self.departure_time.strftime("%H%M")
+        return "%02d%02d" % divmod(self.departure_time % MINUTES_IN_A_DAY, 60)
 
 
 class NullDeparture(Departure):
@@ -234,8 +311,11 @@ class NullDeparture(Departure):
     Class representing a non-existent train or bus (i.e. when none is showing)
     """
     #pylint: disable=R0903
+    __slots__ = ('direction',)
+
     def __init__(self, direction=""):
-        Departure.__init__(self, "None", datetime.now().strftime("%H%M"))
+        now = datetime.now()
+        Departure.__init__(self, "None", now.hour * 60 + now.minute)
         self.direction = direction
 
     def get_destination(self, abbreviated=False):
@@ -259,6 +339,8 @@ class Bus(Departure):
     by recording the departure point as well
     """
     #pylint: disable=R0903
+    __slots__ = ()
+
     def __init__(self, destination, departure_time, _departure_point=""):
         Departure.__init__(self, destination, departure_time)
 
@@ -268,17 +350,52 @@ class Train(Departure):
     Class representing a train of any kind
 
     Unlike Buses, trains can have unknown destinations or complicated destination names
+
+    The destination and via stations are only stored as names until a RailStation for them is actually asked for, as most
+    trains have their stations replaced by canonical ones from the database anyway
     """
+    __slots__ = ('destination_name', 'via_name', '_destination', '_via', 'direction', 'line_code')
+
     def __init__(self, destination_name, departure_time):
-        Departure.__init__(self, destination_name, departure_time)
         if destination_name == "Unknown":
-            self.destination = None
-        else:
-            self.destination = RailStation(destination_name)
+            destination_name = None
+        Departure.__init__(self, destination_name, departure_time)
         self.via = None
         self.direction = ""
         self.line_code = ""
 
+    def get_destination_station(self):
+        """
+        Return this train's destination as a RailStation, creating it from the destination name if need be
+        """
+        if self._destination is None and self.destination_name:
+            self._destination = RailStation(self.destination_name)
+        return self._destination
+
+    def set_destination_station(self, destination):
+        """
+        Set this train's destination - either a RailStation, a station name or None
+        """
+        (self.destination_name, self._destination) = split_station_and_name(destination)
+
+    destination = property(get_destination_station, set_destination_station)
+
+    def get_via_station(self):
+        """
+        Return the station this train is going via as a RailStation (or None if there is not one)
+        """
+        if self._via is None and self.via_name:
+            self._via = RailStation(self.via_name)
+        return self._via
+
+    def set_via_station(self, via):
+        """
+        Set the station this train is going via - either a RailStation, a station name or None
+        """
+        (self.via_name, self._via) = split_station_and_name(via)
+
+    via = property(get_via_station, set_via_station)
+
     def get_destination(self, abbreviated=False):
         destination = self.get_destination_no_via(abbreviated)
         via = self.get_via(abbreviated)
@@ -291,11 +408,11 @@ class Train(Departure):
         """
         Return this train's destination in suitably shortened format, without the via
         """
-        if self.destination:
+        if self.destination_name:
             if abbreviated:
                 destination = self.destination.get_abbreviated_name()
-            else:                
-                destination = self.destination.get_name()
+            else:
+                destination = self.destination_name
         else:
             destination = "%s Train" % self.direction
         return destination
@@ -305,57 +422,55 @@ class Train(Departure):
         Return the station this train is "via", if there is one
         """
         if abbreviated:
-            return self.via and self.via.get_abbreviated_name() or ""
+            return self.via_name and self.via.get_abbreviated_name() or ""
         else:
-            return self.via and self.via.get_name() or ""
+            return self.via_name or ""
 
 
+def split_station_and_name(station_or_name):
+    """
+    Take a RailStation, a station name or None, and return a (name, RailStation) tuple. No RailStation is created for a bare name
+    """
+    if isinstance(station_or_name, basestring):
+        return (station_or_name, None)
+    elif station_or_name is not None:
+        return (station_or_name.name, station_or_name)
+    else:
+        return (None, None)
+
 
 class TubeTrain(Train):
     """
     Class representing a Tube train
     """
     #pylint: disable=W0231
+    __slots__ = ('set_number',)
+
     def __init__(self, destination_name, direction, departure_time, line_code, set_number):
         manual_translations = {"Heathrow T123 + 5": "Heathrow Terminal 5",
                                "Olympia": "Kensington (Olympia)"}
         destination_name = manual_translations.get(destination_name, destination_name)
         # Get rid of TfL's odd designations in the Destination field to make it compatible with our list of stations in the database
         # Destination names are full of garbage. What I would like is a database mapping codes to canonical names, but this does not exist
-        destination_name = re.sub(r"\band\b", "&", destination_name, flags=re.I)
+        destination_name = TUBE_DESTINATION_AND.sub("&", destination_name)
 
         # Destinations that are line names or Unknown get boiled down to Unknown
         if destination_name in ("Unknown", "Circle & Hammersmith & City") or destination_name.startswith("Circle Line") \
             or destination_name.endswith("Train") or destination_name.endswith("Line"):
             destination_name = "Unknown"
         else:
-            # Regular expressions of instructions, depot names (presumably instructions for shunting after arrival), or platform numbers
-            undesirables = ('\(rev to .*\)',
-                            '\(Rev\) Bank Branch',
-                            r'sidings?\b',
-                            '(then )?depot',
-                            'ex (barnet|edgware) branch',
-                            '\(ex .*\)',
-                            '/ london road',
-                            '27 Road',
-                            r'24r/25r',
-                            '\(plat\. [0-9]+\)',
-                            ' loop',
-                            '\(circle\)',
-                            '\(district\)',)
-            destination_name = cleanup_name_from_undesirables(destination_name, undesirables)
-
-        via_match = re.search(" \(?via ([^)]*)\)?$", destination_name, flags=re.I)
+            destination_name = cleanup_name_from_undesirables(destination_name, TUBE_DESTINATION_UNDESIRABLES)
+
+        via_match = TUBE_DESTINATION_VIA.search(destination_name)
         if via_match:
             manual_translations = {"CX": "Charing Cross", "T4": "Heathrow Terminal 4"}
             via = manual_translations.get(via_match.group(1), via_match.group(1))
-            destination_name = re.sub(" \(?via .*$", "", destination_name, flags=re.I)
+            destination_name = TUBE_DESTINATION_VIA_AND_AFTER.sub("", destination_name)
         else:
             via = ""
 
         Train.__init__(self, destination_name, departure_time)
-        if via:
-            self.via = RailStation(via)
+        self.via = via or None
         self.direction = direction
         self.line_code = line_code
         self.set_number = set_number
@@ -371,6 +486,8 @@ class DLRTrain(Train):
     """
     Class representing a DLR train
     """
+    __slots__ = ()
+
     def __init__(self, destination, departure_time):
         Train.__init__(self, destination, departure_time)
         self.line_code = "DLR"
@@ -423,26 +540,23 @@ class DepartureCollection:
         """
         if not self.departure_data:
             return ""
-        # This is a dictionary, each key a slot, each value a { destination:[list of times] } dictionary itself
-        departures_output = {}
+        departures_output = []
         for slot in sorted(self.departure_data.keys()):
-            # Group by departure within each slot
-            departures = unique_values(sorted(self.departure_data[slot]))[:5]
-            destinations = unique_values([departure.get_destination(True) for departure in departures])
+            # Group by departure within each slot, working out each departure's abbreviated destination just the once
             departures_by_destination = {}
-            for destination in destinations:
-                departures_by_destination[destination] = [departure.get_departure_time() for departure in departures if departure.get_destination(True) == destination]
+            for departure in unique_values(sorted(self.departure_data[slot], key=attrgetter('departure_time')), 5):
+                departures_by_destination.setdefault(departure.get_destination(True), []).append(departure.get_departure_time())
             # Then sort grouped departures, earliest first within the slot. Different destinations separated by commas
-            sort_earliest_departure_first = lambda (destination1, times1), (destination2, times2): cmp(times1[0], times2[0])
-            destinations_and_times = sorted(departures_by_destination.items(), sort_earliest_departure_first)
-            departures_for_this_slot = ["%s %s" % (destination, ' '.join(times[:3])) for (destination, times) in destinations_and_times]
-            departures_output[slot] = ', '.join([departure.strip() for departure in departures_for_this_slot])
+            destinations_and_times = sorted(departures_by_destination.items(), key=lambda (destination, times): times[0])
+            departures_for_this_slot = ', '.join([("%s %s" % (destination, ' '.join(times[:3]))).strip()
+                                                  for (destination, times) in destinations_and_times])
             # Bus stops get their names included as well, if there is a departure
-            if isinstance(slot, BusStop) and not departures_output[slot].startswith("None shown"):
-                departures_output[slot] = "%s to %s" % (slot.get_clean_name(), departures_output[slot])
+            if isinstance(slot, BusStop) and not departures_for_this_slot.startswith("None shown"):
+                departures_for_this_slot = "%s to %s" % (slot.get_clean_name(), departures_for_this_slot)
+            departures_output.append(departures_for_this_slot)
 
         # Return slots separated by semi-colons
-        return '; '.join([departures_output[slot] for slot in sorted(departures_output.keys())])
+        return '; '.join(departures_output)
 
     def __repr__(self):
         return self.departure_data.__repr__()
@@ -451,7 +565,7 @@ class DepartureCollection:
         """
         Adds departure to slot, creating said slot if it doesn't already exist
         """
-        self.departure_data[slot] = self.departure_data.get(slot, []) + [departure]
+        self.departure_data.setdefault(slot, []).append(departure)
 
     def merge_common_slots(self):
         """
@@ -475,13 +589,18 @@ class DepartureCollection:
 
         If delete_existing_empty_slots is True, then this deletes pre-existing empty slots as well as ones that have been emptied by the filter function
         """
+        # Lists are filtered in place, so no new list is built for each slot - departures we keep are moved up over the ones we
+        # don't, and then the end of the list is cut off
         for (slot, departures) in self.departure_data.items():
             if departures or delete_existing_empty_slots:
-                departures = [d for d in departures if filter_function(d)]
+                number_kept = 0
+                for departure in departures:
+                    if filter_function(departure):
+                        departures[number_kept] = departure
+                        number_kept += 1
+                del departures[number_kept:]
                 if not departures:
                     del self.departure_data[slot]
-                else:
-                    self.departure_data[slot] = departures
 
     def cleanup(self, null_object_constructor=NullDeparture):
         """
@@ -493,11 +612,18 @@ class DepartureCollection:
         null_object_constructor is either a classname constructor, or a function that returns a created object
         e.g. lambda a: Constructor(a.lower())
         """
-        # Make sure there is a departure in at least one slot
-        if not [departures for departures in self.departure_data.values() if departures]:
+        # Go through list of slots and departures for them, noting down those with an empty list (no departures). If there is a
+        # departure in at least one slot, we replace the empty ones with the null object specified ("None shown..."); if there
+        # are no departures at all, we empty the dictionary
+        empty_slots = []
+        has_departures = False
+        for (slot, departures) in self.departure_data.iteritems():
+            if departures:
+                has_departures = True
+            elif departures == []:
+                empty_slots.append(slot)
+        if not has_departures:
             self.departure_data = {}
-        # Go through list of slots and departures for them.  If there is a None, then there is no slot at all and we delete it
-        # If there is an empty list (no departures) then we replace it with the null object specified ("None shown...").
-        for slot in self.departure_data.keys():
-            if self.departure_data[slot] == []:
-                self.departure_data[slot] = [null_object_constructor(slot)]
+            return
+        for slot in empty_slots:
+            self.departure_data[slot] = [null_object_constructor(slot)]
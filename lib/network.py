@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+"""
+Network of the Tube & DLR for When's My Transport, stored in a compact binary file so it can be loaded quickly
+
+Every node in the network is a string, either "Station:entrance", "Station:exit" or "Station:Direction:Line" (one for each set of
+platforms). The network is made up of one graph for each line, plus one for the whole network ('All'); every line's graph is
+part of the whole network's graph, with the same weights, so we only store the whole network and mark which lines each node
+and edge belongs to.
+
+The file is laid out as follows, with all numbers little-endian:
+
+    Header: "WMTN", then unsigned 32-bit integers for the version, number of lines, nodes and edges, and length of the name table
+    Name table: the line codes and then the node names (sorted), separated by newlines and padded to a multiple of 4 bytes
+    Edge offsets: unsigned 32-bit integer for each node, plus one; edges from node i are numbered offsets[i] to offsets[i+1] - 1
+    Edge targets: unsigned 32-bit integer for each edge, the node it goes to
+    Edge weights: 64-bit float for each edge, the time in minutes it takes
+    Edge lines: unsigned 32-bit integer for each edge, with bit n set if it is part of the nth line's graph
+    Node lines: unsigned 32-bit integer for each node, with bit n set if it is part of the nth line's graph
+"""
+from array import array
+from heapq import heappush, heappop
+from math import sqrt
+import mmap
+import struct
+import sys
+
+NETWORK_FILE_MAGIC = 'WMTN'
+NETWORK_FILE_VERSION = 1
+NETWORK_FILE_HEADER = struct.Struct('<4sIIIII')
+ITEM_SIZES = {'I': 4, 'd': 8}
+TRAIN_SPEED = 600.0  # Metres per minute - the 36km/h that datatools assumes trains go at when working out the network's weights
+
+
+def make_array(typecode, values=()):
+    """
+    Return an array of typecode, which is 'I' (unsigned 32-bit integers) or 'd' (64-bit floats), containing values
+    """
+    values_array = array(typecode, values)
+    if values_array.itemsize != ITEM_SIZES[typecode]:
+        raise TypeError("Arrays of type %s are not %s-bit on this platform" % (typecode, 8 * ITEM_SIZES[typecode]))
+    return values_array
+
+
+def save_network(graphs, filename):
+    """
+    Save graphs, a dictionary of line codes to pygraph digraphs (which must include 'All', the whole network), to filename
+    """
+    line_codes = ['All'] + sorted([line_code for line_code in graphs.keys() if line_code != 'All'])
+    if len(line_codes) > 32:
+        raise ValueError("Cannot save a network with more than 32 lines")
+    whole_network = graphs['All']
+    node_names = sorted(whole_network.nodes())
+    node_indices = dict([(node_name, index) for (index, node_name) in enumerate(node_names)])
+
+    node_lines = [0] * len(node_names)
+    edge_lines = {}
+    for (line_index, line_code) in enumerate(line_codes):
+        graph = graphs[line_code]
+        for node_name in graph.nodes():
+            node_lines[node_indices[node_name]] |= 1 << line_index
+        for edge in graph.edges():
+            if graph.edge_weight(edge) != whole_network.edge_weight(edge):
+                raise ValueError("Edge %s has a different weight on line %s to the whole network" % (edge, line_code))
+            edge_lines[edge] = edge_lines.get(edge, 0) | 1 << line_index
+
+    (edge_offsets, edge_targets, edge_weights, edge_line_masks) = ([], [], [], [])
+    for node_name in node_names:
+        edge_offsets.append(len(edge_targets))
+        for neighbour in sorted(whole_network.neighbors(node_name), key=node_indices.get):
+            edge_targets.append(node_indices[neighbour])
+            edge_weights.append(whole_network.edge_weight((node_name, neighbour)))
+            edge_line_masks.append(edge_lines[(node_name, neighbour)])
+    edge_offsets.append(len(edge_targets))
+
+    names = '\n'.join(line_codes + node_names)
+    names += '\0' * (-len(names) % 4)
+    arrays = [make_array('I', edge_offsets), make_array('I', edge_targets), make_array('d', edge_weights),
+              make_array('I', edge_line_masks), make_array('I', node_lines)]
+    network_file = open(filename, 'wb')
+    network_file.write(NETWORK_FILE_HEADER.pack(NETWORK_FILE_MAGIC, NETWORK_FILE_VERSION,
+                                                len(line_codes), len(node_names), len(edge_targets), len(names)))
+    network_file.write(names)
+    for values_array in arrays:
+        if sys.byteorder != 'little':
+            values_array.byteswap()
+        values_array.tofile(network_file)
+    network_file.close()
+
+
+class WMTNetwork():
+    """
+    Class representing the Tube & DLR network, as loaded from a file made by save_network()
+
+    station_positions is an optional dictionary of station names to (easting, northing) tuples, used by find_route()
+    """
+    def __init__(self, filename, station_positions=None):
+        network_file = open(filename, 'rb')
+        data = mmap.mmap(network_file.fileno(), 0, access=mmap.ACCESS_READ)
+        network_file.close()
+        (magic, version, line_count, node_count, edge_count, names_length) = NETWORK_FILE_HEADER.unpack_from(data, 0)
+        if magic != NETWORK_FILE_MAGIC or version != NETWORK_FILE_VERSION:
+            raise ValueError("%s is not a version %s network file" % (filename, NETWORK_FILE_VERSION))
+
+        position = NETWORK_FILE_HEADER.size
+        names = data[position:position + names_length].rstrip('\0').split('\n')
+        position += names_length
+        self.line_bits = dict([(line_code, 1 << line_index) for (line_index, line_code) in enumerate(names[:line_count])])
+        self.node_names = names[line_count:]
+        self.node_indices = dict([(node_name, index) for (index, node_name) in enumerate(self.node_names)])
+
+        arrays = []
+        for (typecode, length) in (('I', node_count + 1), ('I', edge_count), ('d', edge_count), ('I', edge_count), ('I', node_count)):
+            values_array = make_array(typecode)
+            values_array.fromstring(data[position:position + ITEM_SIZES[typecode] * length])
+            if sys.byteorder != 'little':
+                values_array.byteswap()
+            arrays.append(values_array)
+            position += ITEM_SIZES[typecode] * length
+        (self.edge_offsets, self.edge_targets, self.edge_weights, self.edge_lines, self.node_lines) = arrays
+        data.close()
+
+        station_positions = station_positions or {}
+        self.node_positions = [station_positions.get(node_name.partition(':')[0]) for node_name in self.node_names]
+
+    def find_route(self, source, target, line_code='All'):
+        """
+        Find the quickest route from the node named source to the node named target on the line with line_code, using the A*
+        algorithm. Returns a tuple of the list of names of the nodes on the route (starting with source and ending with target)
+        and the time it takes, or ([], None) if target cannot be reached. Raises a KeyError if source is not on the line
+
+        Unlike Dijkstra's algorithm, this heads towards target first and stops as soon as it gets there. How far a node is from
+        target is guessed from the straight-line distance between their stations at TRAIN_SPEED; no journey can be quicker than
+        that, so the route found is still the quickest
+        """
+        line_bit = self.line_bits[line_code]
+        source_index = self.node_indices[source]
+        if not self.node_lines[source_index] & line_bit:
+            raise KeyError(source)
+        target_index = self.node_indices.get(target)
+        if target_index is None or not self.node_lines[target_index] & line_bit:
+            return ([], None)
+        (edge_offsets, edge_targets, edge_weights, edge_lines) = (self.edge_offsets, self.edge_targets, self.edge_weights, self.edge_lines)
+
+        node_positions = self.node_positions
+        target_position = node_positions[target_index]
+        estimates = {}
+
+        def estimate(node):
+            """Return the guessed time from node to target, which is 0 if we don't know where either is"""
+            if node not in estimates:
+                position = node_positions[node]
+                estimates[node] = position and target_position and sqrt((position[0] - target_position[0]) ** 2 +
+                                                                         (position[1] - target_position[1]) ** 2) / TRAIN_SPEED or 0
+            return estimates[node]
+
+        distances = {source_index: 0}
+        previous = {source_index: None}
+        queue = [(estimate(source_index), source_index)]
+        finished = set()
+        while queue:
+            (_guess, node) = heappop(queue)
+            if node == target_index:
+                break
+            if node in finished:
+                continue
+            finished.add(node)
+            distance = distances[node]
+            for edge in xrange(edge_offsets[node], edge_offsets[node + 1]):
+                neighbour = edge_targets[edge]
+                if edge_lines[edge] & line_bit and neighbour not in finished:
+                    new_distance = distance + edge_weights[edge]
+                    if neighbour not in distances or new_distance < distances[neighbour]:
+                        distances[neighbour] = new_distance
+                        previous[neighbour] = node
+                        heappush(queue, (new_distance + estimate(neighbour), neighbour))
+        else:
+            return ([], None)
+
+        route = []
+        node = target_index
+        while node is not None:
+            route.append(self.node_names[node])
+            node = previous[node]
+        return (route[::-1], distances[target_index])
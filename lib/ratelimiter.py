@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+Rate limiting for When's My Transport - paces requests to an API (i.e. Twitter's) so that we never go over its limits
+"""
+import logging
+import time
+
+
+class WMTRateLimitExceeded(Exception):
+    """
+    Exception raised when a request could only be made by waiting for longer than we are prepared to
+    """
+    def __init__(self, name, wait_time):
+        super(WMTRateLimitExceeded, self).__init__("Would have to wait %0.1f seconds to make %s request" % (wait_time, name))
+        self.wait_time = wait_time
+
+
+class WMTRateLimiter():
+    """
+    Class representing a token bucket rate limiter. The bucket holds up to capacity tokens and is refilled at rate tokens per
+    second; each request takes a token, and if there are none left we wait for one. So we can make capacity requests in a burst,
+    and rate requests per second on average after that
+
+    If the API tells us how many requests we have left (e.g. in Twitter's rate limit headers), give it to update() and we will
+    not make any more than that until the API resets its count, as its count includes requests made by anyone else using our
+    account. If max_wait is given, we never wait longer than that many seconds for a request. The state of the bucket can be
+    saved with get_state() and restored with set_state(), so that it carries over from one run to the next. clock and sleep can
+    be replaced for testing
+    """
+    def __init__(self, name, capacity, rate, max_wait=None, clock=time.time, sleep=time.sleep):
+        self.name = name
+        self.capacity = capacity
+        self.rate = rate
+        self.max_wait = max_wait
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = float(capacity)
+        self.last_refill_time = clock()
+        self.api_limit = None
+        self.api_remaining = None
+        self.api_reset_time = None
+        self.requests = 0
+        self.time_waited = 0.0
+
+    def refill(self):
+        """
+        Add the tokens due since we last refilled, and forget the API's count if it has since been reset
+        """
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill_time) * self.rate)
+        self.last_refill_time = now
+        if self.api_reset_time is not None and now >= self.api_reset_time:
+            self.api_remaining = None
+            self.api_reset_time = None
+
+    def get_wait_time(self, requests=1):
+        """
+        Return how long in seconds we have to wait before we can make requests requests (by default, just one)
+        """
+        self.refill()
+        wait_time = 0
+        if self.tokens < requests:
+            wait_time = (requests - self.tokens) / self.rate
+        if self.api_remaining is not None and self.api_remaining < requests:
+            wait_time = max(wait_time, self.api_reset_time - self.clock())
+        return wait_time
+
+    def check_room_for(self, requests):
+        """
+        Raise a WMTRateLimitExceeded if making requests requests in a row would mean waiting longer than max_wait seconds
+        """
+        wait_time = self.get_wait_time(requests)
+        if self.max_wait is not None and wait_time > self.max_wait:
+            raise WMTRateLimitExceeded(self.name, wait_time)
+
+    def acquire(self):
+        """
+        Wait until we can make a request without going over the limit and count it as made. Returns how long we waited, in seconds
+
+        If we would have to wait longer than max_wait seconds, raise a WMTRateLimitExceeded straight away instead, without counting
+        the request
+        """
+        self.check_room_for(1)
+        time_waited = 0
+        wait_time = self.get_wait_time()
+        while wait_time > 0:
+            logging.debug("Waiting %0.1f seconds before making %s request", wait_time, self.name)
+            self.sleep(wait_time)
+            time_waited += wait_time
+            wait_time = self.get_wait_time()
+        self.tokens -= 1
+        if self.api_remaining is not None:
+            self.api_remaining -= 1
+        self.requests += 1
+        self.time_waited += time_waited
+        return time_waited
+
+    def update(self, limit, remaining, reset_time):
+        """
+        Tell us that the API allows limit requests, and we have remaining of them left until reset_time (as given by clock)
+        """
+        self.api_limit = limit
+        self.api_remaining = remaining
+        self.api_reset_time = reset_time
+
+    def update_from_headers(self, get_header):
+        """
+        Update from the rate limit headers of an API's reply, as Twitter's are; get_header(name) returns the value of a header, or
+        None if it is not there
+        """
+        rate_limits = [get_header(header) for header in ('x-ratelimit-limit', 'x-ratelimit-remaining', 'x-ratelimit-reset')]
+        if None not in rate_limits:
+            self.update(*[int(value) for value in rate_limits])
+
+    def get_state(self):
+        """
+        Return a tuple of what we know about how many requests we can make, to be given to set_state() later
+        """
+        self.refill()
+        return (self.tokens, self.last_refill_time, self.api_limit, self.api_remaining, self.api_reset_time)
+
+    def set_state(self, state):
+        """
+        Restore what we knew about how many requests we can make from state, as returned by get_state()
+        """
+        (self.tokens, self.last_refill_time, self.api_limit, self.api_remaining, self.api_reset_time) = state
+        self.refill()
@@ -3,22 +3,58 @@
 Application settings handling for When's My Transport
 """
 import cPickle as pickle
+import copy
+import logging
+import os
+import socket
+import time
 from lib.database import WMTDatabase
 
+SETTINGS_BUSY_TIMEOUT = 10000  # Milliseconds to wait for another process to finish writing to the settings database
+TWEET_LEASE_TIME = 10 * 60  # Seconds a process has to answer a Tweet before another process can take it over
+TWEET_LEASE_HISTORY = 24 * 60 * 60  # Seconds to remember a Tweet has been answered for, so no other process answers it again
+
 
 class WMTSettings():
     """
     Class representing a settings read/write handler (for remembering data between sessions) for When's My Transport
+
+    Settings are kept in memory once read, and updates are only written to the database when flush() is called, all in one
+    transaction. The number of transactions made so far is counted in commits
+
+    More than one process can use the same settings at once (e.g. if one run of the bot has not finished before the next starts),
+    so the database uses write-ahead logging, so that reading does not wait for writing, and each process takes a lease on
+    each Tweet it answers, so that no two processes answer the same one
     """
     def __init__(self, instance_name):
         self.instance_name = instance_name
         self.settingsdb = WMTDatabase('%s.settings.db' % self.instance_name)
+        # We manage our own transactions, so that we can read and then write a setting without another process writing in between
+        self.settingsdb.db_connection.isolation_level = None
+        self.settingsdb.cursor.execute("PRAGMA busy_timeout=%d" % SETTINGS_BUSY_TIMEOUT)
+        self.settingsdb.cursor.execute("PRAGMA journal_mode=WAL")
         self.settingsdb.write_query("create table if not exists %s_settings (setting_name unique, setting_value)" % self.instance_name)
+        self.settingsdb.write_query("create table if not exists %s_leases (tweet_key unique, worker, leased_until, answered INT)" % self.instance_name)
+        self.settingsdb.write_query("create table if not exists %s_protected_users (twitter_id unique)" % self.instance_name)
+        self.worker = "%s:%s" % (socket.gethostname(), os.getpid())
+        self.cache = {}
+        self.unsaved_setting_names = set()
+        self.high_water_mark_names = set()
+        self.commits = 0
 
     def get_setting(self, setting_name):
         """
         Fetch value of setting from settings database
         """
+        if setting_name not in self.cache:
+            self.cache[setting_name] = self.read_setting(setting_name)
+        # Copy it so that changing a setting (e.g. appending to a list) does not change our cache without update_setting()
+        return copy.deepcopy(self.cache[setting_name])
+
+    def read_setting(self, setting_name):
+        """
+        Read value of setting from settings database, ignoring what we have in memory
+        """
         # pylint: disable=W0703
         setting_value = self.settingsdb.get_value("select setting_value from %s_settings where setting_name = ?" % self.instance_name, (setting_name,))
         # Try unpickling, if this doesn't work then return the raw value (to deal with legacy databases)
@@ -31,8 +67,112 @@ class WMTSettings():
 
     def update_setting(self, setting_name, setting_value):
         """
-        Set value of named setting in settings database
+        Set value of named setting, to be written to the settings database on the next flush()
+        """
+        self.cache[setting_name] = copy.deepcopy(setting_value)
+        self.unsaved_setting_names.add(setting_name)
+
+    def update_high_water_mark(self, setting_name, setting_value):
+        """
+        Set value of named setting as update_setting() does, but only if it is higher than its current value, so that it never
+        goes backwards (e.g. the ID of the last Tweet answered). This is checked again on flush(), in case another process has
+        set it higher in the meantime
+        """
+        self.high_water_mark_names.add(setting_name)
+        current_value = self.get_setting(setting_name)
+        if current_value is None or setting_value > current_value:
+            self.update_setting(setting_name, setting_value)
+
+    def flush(self):
+        """
+        Write any updated settings to the settings database in one transaction, and return how many were written
+        """
+        if not self.unsaved_setting_names:
+            return 0
+        cursor = self.settingsdb.cursor
+        # Take the write lock before reading, so no other process can change a high-water mark between our reading and writing it
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            for setting_name in self.unsaved_setting_names & self.high_water_mark_names:
+                saved_value = self.read_setting(setting_name)
+                if saved_value is not None and saved_value >= self.cache[setting_name]:
+                    self.cache[setting_name] = saved_value
+                    self.unsaved_setting_names.discard(setting_name)
+            setting_names = sorted(self.unsaved_setting_names)
+            cursor.executemany("insert or replace into %s_settings (setting_name, setting_value) values (?, ?)" % self.instance_name,
+                               [(setting_name, pickle.dumps(self.cache[setting_name])) for setting_name in setting_names])
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+        self.unsaved_setting_names.clear()
+        self.commits += 1
+        logging.debug("Saved %s settings to the settings database", len(setting_names))
+        return len(setting_names)
+
+    def lease_tweet(self, tweet_key, lease_time=TWEET_LEASE_TIME):
+        """
+        Try to take the lease on answering the Tweet with tweet_key (a string unique to it), for lease_time seconds. Returns True
+        if we have it, or False if another process has it or the Tweet has already been answered
+        """
+        now = time.time()
+        cursor = self.settingsdb.cursor
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            lease = self.settingsdb.get_row("select worker, leased_until, answered from %s_leases where tweet_key = ?" % self.instance_name,
+                                            (tweet_key,))
+            is_leased = not lease or not lease['answered'] and (lease['worker'] == self.worker or lease['leased_until'] < now)
+            if is_leased:
+                cursor.execute("insert or replace into %s_leases (tweet_key, worker, leased_until, answered) values (?, ?, ?, 0)" % self.instance_name,
+                               (tweet_key, self.worker, now + lease_time))
+            cursor.execute("delete from %s_leases where leased_until < ?" % self.instance_name, (now - TWEET_LEASE_HISTORY,))
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+        if not is_leased:
+            logging.debug("Tweet %s is being or has been answered by %s", tweet_key, lease['worker'])
+        return is_leased
+
+    def finish_tweet(self, tweet_key):
+        """
+        Record that we have answered the Tweet with tweet_key, whose lease we have, so no other process will take it
+        """
+        self.settingsdb.write_query("update %s_leases set answered = 1, leased_until = ? where tweet_key = ? and worker = ?" % self.instance_name,
+                                   (time.time(), tweet_key, self.worker))
+
+    def release_tweet(self, tweet_key):
+        """
+        Give up the lease we have on the Tweet with tweet_key without answering it, so that any process can take it straight away
+        """
+        self.settingsdb.write_query("update %s_leases set leased_until = 0 where tweet_key = ? and worker = ? and not answered" % self.instance_name,
+                                   (tweet_key, self.worker))
+
+    def get_lowest_unanswered_id(self, kind):
+        """
+        Return the lowest ID of a Tweet of kind (e.g. "tweet" or "direct_message") that some process has taken the lease on but not
+        answered, or None if there are none. Later Tweets may have been answered by other processes, so the last answered Tweet
+        alone does not tell us which ones we still have to fetch
+        """
+        return self.settingsdb.get_value("select min(cast(substr(tweet_key, ?) as integer)) from %s_leases where not answered and tweet_key like ?" % self.instance_name,
+                                         (len(kind) + 2, "%s:%%" % kind))
+
+    def get_protected_users(self):
+        """
+        Return a set of the IDs of protected users we have asked to follow, who have not yet let us
+        """
+        # These used to be stored as a list in a setting, so move any there into their own table
+        legacy_protected_users = self.get_setting("protected_users_to_ignore")
+        if legacy_protected_users:
+            for twitter_id in legacy_protected_users:
+                self.add_protected_user(twitter_id)
+            self.settingsdb.write_query("delete from %s_settings where setting_name = ?" % self.instance_name, ("protected_users_to_ignore",))
+            self.cache["protected_users_to_ignore"] = None
+        rows = self.settingsdb.get_rows("select twitter_id from %s_protected_users" % self.instance_name)
+        return set([row['twitter_id'] for row in rows])
+
+    def add_protected_user(self, twitter_id):
+        """
+        Remember that the user with twitter_id is protected and has not let us follow them
         """
-        setting_value = pickle.dumps(setting_value)
-        self.settingsdb.write_query("insert or replace into %s_settings (setting_name, setting_value) values (?, ?)" % self.instance_name,
-                                    (setting_name, setting_value))
+        self.settingsdb.write_query("insert or ignore into %s_protected_users (twitter_id) values (?)" % self.instance_name, (twitter_id,))
@@ -6,6 +6,9 @@ import difflib
 import re
 from time import localtime
 
+MULTIPLE_SPACES = re.compile(r' +')
+NON_ALPHANUMERICS = re.compile(r'[\W_]+', flags=re.U)
+
 
 def capwords(phrase):
     """
@@ -19,23 +22,57 @@ def capwords(phrase):
     return ' '.join(capitalized)
 
 
+def compile_undesirables(undesirables):
+    """
+    Compile each regular expression in the iterable undesirables, case-insensitively, for use with cleanup_name_from_undesirables()
+    """
+    return tuple([re.compile(undesirable, flags=re.I) for undesirable in undesirables])
+
+
 def cleanup_name_from_undesirables(name, undesirables):
     """
     Clean out every regular expression in the iterable undesirables from the name supplied, and capitalize
+
+    undesirables can be strings, or patterns already compiled by compile_undesirables()
     """
     for undesirable in undesirables:
-        name = re.sub(undesirable, '', name, flags=re.I)
-    name = re.sub(r' +', ' ', name.strip())
+        if isinstance(undesirable, basestring):
+            undesirable = re.compile(undesirable, flags=re.I)
+        name = undesirable.sub('', name)
+    name = MULTIPLE_SPACES.sub(' ', name.strip())
     return capwords(name)
 
 
-def get_name_similarity(string1, string2):
+def normalise_placename(placename):
+    """
+    Return placename in lower case, with each run of spaces and punctuation turned into a single space, so that the same place
+    typed slightly differently (e.g. "Oxford Circus" and "oxford  circus.") comes out the same
+    """
+    return NON_ALPHANUMERICS.sub(' ', placename.lower()).strip()
+
+
+def intern_name(name):
+    """
+    Return an interned copy of a (byte)string name, so that all the objects sharing a name share a single copy of it
+    """
+    if isinstance(name, str):
+        return intern(name)
+    return name
+
+
+def get_name_similarity(string1, string2, minimum_score=0):
     """
     Return a score between 0 and 100 of the strings' similarity, based on difflib's string similarity algorithm returning an integer
     between 0 (no match) and 100 (perfect). 70 or more seems to be a confident enough match
+
+    If minimum_score is specified, and difflib's cheap upper bounds on similarity show the score must be below it, 0 is returned
+    without working out the full score
     """
     # Based on https://github.com/seatgeek/fuzzywuzzy/blob/master/fuzzywuzzy/fuzz.py
-    return int(100 * difflib.SequenceMatcher(None, string1, string2).ratio())
+    matcher = difflib.SequenceMatcher(None, string1, string2)
+    if minimum_score and (int(100 * matcher.real_quick_ratio()) < minimum_score or int(100 * matcher.quick_ratio()) < minimum_score):
+        return 0
+    return int(100 * matcher.ratio())
 
 
 def get_best_fuzzy_match(search_term, possible_items, minimum_confidence=70):
@@ -43,24 +80,28 @@ def get_best_fuzzy_match(search_term, possible_items, minimum_confidence=70):
     Get the best matching item in a list of possible_values that matches search_term
 
     Search terms are strings. Items must have a get_similarity() method, or be strings
+
+    The best item is the one we are most confident matches; ties are broken in favour of the shortest item, and then the latest
+    in the list. If we are not at least minimum_confidence confident in the best item, None is returned
     """
-    # Get tuples of matches, each a (value, confidence) pair : confidence is between 0 and 100 and reflects
-    # how confident we are that that value (or its property) matches the term we have asked for
     if not possible_items:
         return None
 
+    # Go through each item, working out the confidence (between 0 and 100) that it matches the term we have asked for, and keeping
+    # hold of the best so far. Nothing can beat an item below minimum_confidence, so that is where the bar starts. Items that
+    # cannot reach the bar are not scored in full (see get_name_similarity() above), but as they cannot be picked that is fine
+    best_value = None
+    best_confidence = minimum_confidence
+    best_length = 0
     if hasattr(possible_items[0], "get_similarity"):
-        fuzzy_matches = [(item, item.get_similarity(search_term)) for item in possible_items]
-    else:
-        fuzzy_matches = [(item, get_name_similarity(search_term, item)) for item in possible_items]
-
-    # Sort in order of confidence (with length as a tiebreaker)
-    fuzzy_matches.sort(lambda a, b: cmp(a[1], b[1]) or cmp(len(b[0]), len(a[0])))
-    (best_value, confidence) = fuzzy_matches[-1]
-    if confidence >= minimum_confidence:
-        return best_value
+        get_confidence = lambda item, minimum_score: item.get_similarity(search_term, minimum_score)
     else:
-        return None
+        get_confidence = lambda item, minimum_score: get_name_similarity(search_term, item, minimum_score)
+    for item in possible_items:
+        confidence = get_confidence(item, best_confidence)
+        if confidence > best_confidence or (confidence == best_confidence and (best_value is None or len(item) <= best_length)):
+            (best_value, best_confidence, best_length) = (item, confidence, len(item))
+    return best_value
 
 
 def gmt_to_localtime(date_and_time_string):
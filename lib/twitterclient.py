@@ -11,21 +11,70 @@ import time
 
 # Tweepy is a Twitter API library available from https://github.com/tweepy/tweepy
 import tweepy
-from lib.settings import WMTSettings
+from lib.listutils import values_not_in
+from lib.ratelimiter import WMTRateLimiter, WMTRateLimitExceeded
+from lib.settings import WMTSettings, TWEET_LEASE_TIME
+
+# Twitter's limits, as (number of requests, per number of seconds). Limits on posting are per day but are enforced over shorter
+# periods too, so we only allow a burst of half an hour's worth of those
+TWITTER_READ_LIMIT = (350, 60 * 60)
+TWITTER_UPDATE_LIMIT = (1000, 24 * 60 * 60)
+TWITTER_DIRECT_MESSAGE_LIMIT = (250, 24 * 60 * 60)
+TWITTER_FOLLOW_LIMIT = (1000, 24 * 60 * 60)
+# Longest we wait to post anything. A Tweet's answer can be a few posts, and another process can take over answering it once its
+# lease runs out, so rather than wait longer than this we leave the Tweet for the next run
+TWITTER_MAX_WAIT = TWEET_LEASE_TIME / 10
 
 
 class WMTTwitterClient():
     """
     A Twitter Client that fetches Tweets and manages follows for When's My Transport
     """
-    def __init__(self, instance_name, consumer_key, consumer_secret, access_token, access_token_secret, testing=False):
+    def __init__(self, instance_name, consumer_key, consumer_secret, access_token, access_token_secret, testing=False, api_host=None):
+        """
+        Set up a client for the account with the given OAuth details. api_host is the host of the Twitter API to use, if not
+        Twitter's own (e.g. a fake one for testing)
+        """
         logging.debug("Authenticating with Twitter")
         auth = tweepy.OAuthHandler(consumer_key, consumer_secret)
         auth.set_access_token(access_token, access_token_secret)
-        self.api = tweepy.API(auth)
+        self.api = api_host and tweepy.API(auth, host=api_host, secure=False) or tweepy.API(auth)
         self.settings = WMTSettings(instance_name)
         self.testing = testing
-        self.report_twitter_limit_status()
+        # Every request we make to Twitter is paced so that we never go over its limits, carrying on from where the last run left off
+        self.read_limiter = WMTRateLimiter("read", TWITTER_READ_LIMIT[0], float(TWITTER_READ_LIMIT[0]) / TWITTER_READ_LIMIT[1])
+        (self.update_limiter, self.direct_message_limiter, self.follow_limiter) = \
+            [WMTRateLimiter(name, max(limit / 48, 1), float(limit) / period, TWITTER_MAX_WAIT) for (name, (limit, period))
+             in (("status update", TWITTER_UPDATE_LIMIT), ("direct message", TWITTER_DIRECT_MESSAGE_LIMIT), ("follow", TWITTER_FOLLOW_LIMIT))]
+        for limiter in (self.read_limiter, self.update_limiter, self.direct_message_limiter, self.follow_limiter):
+            state = self.settings.get_setting("%s rate limit" % limiter.name)
+            if state:
+                limiter.set_state(state)
+
+    def call_api(self, limiter, api_method, *args, **kwargs):
+        """
+        Call api_method with args and kwargs once limiter lets us, and update limiter with the limits Twitter tells us in its reply.
+        Raises a WMTRateLimitExceeded if limiter would make us wait too long
+        """
+        limiter.acquire()
+        self.api.last_response = None
+        try:
+            return api_method(*args, **kwargs)
+        finally:
+            # Twitter's headers only tell us about its limit on reading; posts and DMs are paced by our own buckets alone
+            if limiter is self.read_limiter:
+                self.update_rate_limits(limiter)
+            self.settings.update_setting("%s rate limit" % limiter.name, limiter.get_state())
+
+    def update_rate_limits(self, limiter):
+        """
+        Update limiter with the limit, requests remaining and reset time from the headers of Twitter's last reply, if it has them
+        """
+        response = getattr(self.api, 'last_response', None)
+        if response is None:
+            return
+        # Older versions of Tweepy give us an httplib response, newer ones give us a requests one
+        limiter.update_from_headers(hasattr(response, 'getheader') and response.getheader or response.headers.get)
 
     def check_followers(self):
         """
@@ -39,46 +88,61 @@ class WMTTwitterClient():
         self.settings.update_setting("last_follower_check", time.time())
 
         # Get IDs of our friends (people we already follow), and our followers
-        followers_ids = self.api.followers_ids()
-        friends_ids = self.api.friends_ids()
-
-        # Annoyingly, different versions of Tweepy implement the above; older versions return followers_ids() as a tuple and the list of
-        # followers IDs is the first element of that tuple. Newer versions return just the followers' IDs (which is much more sensible)
-        if isinstance(followers_ids, tuple):
-            followers_ids = followers_ids[0]
-            friends_ids = friends_ids[0]
+        followers_ids = self.get_all_ids(self.api.followers_ids)
+        friends_ids = self.get_all_ids(self.api.friends_ids)
 
         # Some users are protected and have been requested but not accepted - we need not continually ping them
-        protected_users_to_ignore = self.settings.get_setting("protected_users_to_ignore") or []
+        protected_users_to_ignore = self.settings.get_protected_users()
 
         # Work out the difference between the two, and also ignore protected users we have already requested
         # Twitter gives us these in reverse order, so we pick the final twenty (i.e the earliest to follow)
         # reverse these to give them in normal order, and follow each one back!
-        twitter_ids_to_follow = [f for f in followers_ids if f not in friends_ids and f not in protected_users_to_ignore][-20:]
+        twitter_ids_to_follow = values_not_in(followers_ids, friends_ids, protected_users_to_ignore)[-20:]
         for twitter_id in twitter_ids_to_follow[::-1]:
             try:
-                person = self.api.create_friendship(twitter_id)
+                person = self.call_api(self.follow_limiter, self.api.create_friendship, twitter_id)
                 logging.info("Following user %s", person.screen_name)
+            except WMTRateLimitExceeded as exc:
+                logging.info("%s, so following any other new followers next time", exc)
+                break
             except tweepy.error.TweepError:
-                protected_users_to_ignore.append(twitter_id)
+                self.settings.add_protected_user(twitter_id)
                 logging.info("Error following user %s, most likely the account is protected", twitter_id)
                 continue
 
-        self.settings.update_setting("protected_users_to_ignore", protected_users_to_ignore)
         self.report_twitter_limit_status()
 
+    def get_all_ids(self, api_method):
+        """
+        Return a list of all the user IDs that api_method (e.g. self.api.followers_ids) gives us, fetching them a page at a time
+        """
+        twitter_ids = []
+        pages = tweepy.Cursor(api_method).pages()
+        while True:
+            try:
+                page = self.call_api(self.read_limiter, pages.next)
+            except StopIteration:
+                break
+            # Annoyingly, different versions of Tweepy differ here; older versions return each page as a tuple and the list of IDs
+            # is the first element of that tuple. Newer versions return just the IDs (which is much more sensible)
+            if isinstance(page, tuple):
+                page = page[0]
+            twitter_ids += page
+        return twitter_ids
+
     def fetch_tweets(self):
         """
         Fetch Tweets that are replies & direct messages to us and return as a list
         """
-        # Get the IDs of the Tweets and Direct Message we last answered
-        last_answered_tweet = self.settings.get_setting('last_answered_tweet') or 1
-        last_answered_direct_message = self.settings.get_setting('last_answered_direct_message') or 1
+        # Get the IDs of the Tweets and Direct Message we last answered. Another process may have answered later ones while one we
+        # leased was left unanswered, so fetch from just before the earliest of those too
+        last_answered_tweet = self.get_fetch_start('tweet', 'last_answered_tweet')
+        last_answered_direct_message = self.get_fetch_start('direct_message', 'last_answered_direct_message')
 
         # Fetch those Tweets and DMs. This is most likely to fail if OAuth is not correctly set up
         try:
-            tweets = self.api.mentions(since_id=last_answered_tweet)
-            direct_messages = self.api.direct_messages(since_id=last_answered_direct_message)
+            tweets = self.call_api(self.read_limiter, self.api.mentions, since_id=last_answered_tweet)
+            direct_messages = self.call_api(self.read_limiter, self.api.direct_messages, since_id=last_answered_direct_message)
             #tweets = tweepy.Cursor(self.api.mentions, since_id=last_answered_tweet).items(10)
             #direct_messages = tweepy.Cursor(self.api.direct_messages, since_id=last_answered_direct_message).items(10)
         except tweepy.error.TweepError, e:
@@ -99,17 +163,45 @@ class WMTTwitterClient():
         self.report_twitter_limit_status()
         return direct_messages + tweets
 
+    def get_fetch_start(self, kind, setting_name):
+        """
+        Return the ID to fetch Tweets of kind since; the high-water mark in setting_name, or just before the earliest Tweet of kind
+        that was leased but never answered, whichever is lower
+        """
+        since_id = self.settings.get_setting(setting_name) or 1
+        lowest_unanswered_id = self.settings.get_lowest_unanswered_id(kind)
+        if lowest_unanswered_id is not None:
+            since_id = max(min(since_id, lowest_unanswered_id - 1), 1)
+        return since_id
+
     def report_twitter_limit_status(self):
         """
         Log what our Twitter API hit count & limit is
         """
-        limit_status = self.api.rate_limit_status()
-        logging.info("I have %s out of %s hits remaining this hour", limit_status['remaining_hits'], limit_status['hourly_limit'])
-        logging.debug("Next reset time is %s", (limit_status['reset_time']))
+        # This comes from the headers of Twitter's replies, so we need not spend a request asking for it
+        if self.read_limiter.api_remaining is None:
+            logging.info("Twitter has not told us our limits yet, I have made %s requests", self.read_limiter.requests)
+            return
+        logging.info("I have %s out of %s hits remaining this hour", self.read_limiter.api_remaining, self.read_limiter.api_limit)
+        logging.debug("Next reset time is %s", time.ctime(self.read_limiter.api_reset_time))
+
+    def check_room_for_replies(self, replies, username, send_direct_message):
+        """
+        Check Twitter's limits will let us send every message of replies to username without waiting too long, so we never
+        send only some of them. Raises a WMTRateLimitExceeded if not
+        """
+        if self.testing:
+            return
+        message_count = sum([len(split_message_for_twitter(reply, username)) for reply in replies])
+        limiter = send_direct_message and self.direct_message_limiter or self.update_limiter
+        limiter.check_room_for(message_count)
 
     def send_reply_back(self, reply, username, send_direct_message, in_reply_to_status_id=None):
         """
         Send back a reply to username; this might be a DM or might be a public reply
+
+        Raises a WMTRateLimitExceeded if Twitter's limits would make us wait too long to send it, in which case the Tweet or DM
+        with in_reply_to_status_id is not counted as answered
         """
         messages = split_message_for_twitter(reply, username)
         # Send the reply/replies we have generated to the user
@@ -117,17 +209,13 @@ class WMTTwitterClient():
             try:
                 if send_direct_message:
                     logging.info("Sending direct message to %s: '%s'", username, message)
-                    if in_reply_to_status_id:
-                        self.settings.update_setting('last_answered_direct_message', in_reply_to_status_id)
                     if not self.testing:
-                        self.api.send_direct_message(user=username, text=message)
+                        self.call_api(self.direct_message_limiter, self.api.send_direct_message, user=username, text=message)
                 else:
                     status = "@%s %s" % (username, message)
-                    if in_reply_to_status_id:
-                        self.settings.update_setting('last_answered_tweet', in_reply_to_status_id)
                     logging.info("Making status update: '%s'", status)
                     if not self.testing:
-                        self.api.update_status(status=status, in_reply_to_status_id=in_reply_to_status_id)
+                        self.call_api(self.update_limiter, self.api.update_status, status=status, in_reply_to_status_id=in_reply_to_status_id)
 
             # This catches any errors, most typically if we send multiple Tweets to the same person with the same content
             # - typically if the use sends the same bad request again and again, we will reply with same error
@@ -135,6 +223,10 @@ class WMTTwitterClient():
             except tweepy.error.TweepError:
                 continue
 
+        if in_reply_to_status_id:
+            self.settings.update_high_water_mark(send_direct_message and 'last_answered_direct_message' or 'last_answered_tweet',
+                                                 in_reply_to_status_id)
+
 
 def split_message_for_twitter(message, username):
     """
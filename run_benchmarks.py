@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Run benchmarks from our library
+"""
+import argparse
+import sys
+
+import tests.benchmarks
+from tests.benchmarks import benchmarks
+
+
+def run_benchmarks():
+    """
+    Run some or all of the benchmarks for When's My Transport
+    """
+    parser = argparse.ArgumentParser(description="Benchmarking for When's My Transport?")
+    parser.add_argument("benchmark_names", action="store", nargs="*", default=benchmarks,
+                        help="Names of benchmarks to run (default is all of them): %s" % ', '.join(benchmarks))
+    benchmark_names = parser.parse_args().benchmark_names
+
+    for benchmark_name in benchmark_names:
+        if benchmark_name not in benchmarks:
+            print "Error - %s is not a valid benchmark name" % benchmark_name
+            sys.exit(1)
+
+    for benchmark_name in benchmark_names:
+        print "Running benchmark %s" % benchmark_name
+        getattr(tests.benchmarks, 'benchmark_%s' % benchmark_name)()
+        print ""
+
+
+if __name__ == "__main__":
+    run_benchmarks()
@@ -12,8 +12,8 @@ import unittest
 
 from whensmytransport import TESTING_TEST_LIVE_DATA, TESTING_TEST_LOCAL_DATA
 from tests.generic_tests import unit_tests, local_tests, remote_tests, format_errors, geotag_errors
-from tests.bus_tests import WhensMyBusTestCase, bus_errors, stop_errors, bus_successes
-from tests.train_tests import WhensMyTubeTestCase, WhensMyDLRTestCase, tube_errors, station_errors, tube_successes
+from tests.bus_tests import WhensMyBusTestCase, bus_errors, stop_errors, bus_successes, geocoder_tests
+from tests.train_tests import WhensMyTubeTestCase, WhensMyDLRTestCase, tube_errors, station_errors, tube_successes, network_tests
 
 
 def run_tests():
@@ -31,10 +31,10 @@ def run_tests():
 
     if test_case_name == "WhensMyBus":
         failures = format_errors + geotag_errors + bus_errors + stop_errors
-        successes = bus_successes
+        successes = bus_successes + geocoder_tests
     elif test_case_name == "WhensMyTube" or test_case_name == "WhensMyDLR":
         failures = format_errors + geotag_errors + tube_errors + station_errors
-        successes = tube_successes
+        successes = tube_successes + network_tests
     else:
         print "Error - %s is not a valid Test Case Name" % test_case_name
         sys.exit(1)
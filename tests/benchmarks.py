@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#pylint: disable=C0103,W0142
+"""
+Benchmarks for When's My Transport - measures the time and memory taken up by the busiest parts of the code
+
+Each benchmark is a function named benchmark_<name>, which prints out its results. See run_benchmarks.py to run them
+"""
+import gc
+import glob
+import multiprocessing
+import os.path
+import random
+import sys
+import tempfile
+import time
+import types
+from xml.etree.ElementTree import Element, SubElement
+
+from lib.browser import WMTBrowser
+from lib.dataparsers import parse_bus_data, parse_tube_data, parse_dlr_data
+from lib.database import WMTDatabase
+from lib.geo import convertWGS84toOSEastingNorthing, convertWGS84toOSEastingNorthingArrays
+from lib.listutils import values_not_in
+from lib.models import RailStation, BusStop, DepartureCollection, DLRTrain, NullDeparture
+from lib.locations import RailStationLocations
+from lib.network import WMTNetwork
+from lib.ratelimiter import WMTRateLimiter
+from lib.stringutils import get_best_fuzzy_match
+from tests.fake_twitter_api import FakeTwitterAPI, post_statuses
+from tests.train_tests import get_shortest_paths
+
+HOME_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+#
+# Helper functions
+#
+
+def time_function(function, repetitions=100):
+    """
+    Run function repetitions times, and return the average time taken per call, in milliseconds
+    """
+    start = time.time()
+    for _i in range(repetitions):
+        function()
+    return (time.time() - start) * 1000.0 / repetitions
+
+
+def get_deep_size(objects):
+    """
+    Return the total size in bytes of the objects in the iterable objects, plus everything they refer to (apart from classes,
+    modules and functions, which are shared by every object anyway)
+    """
+    shared_types = (type, types.ClassType, types.ModuleType, types.FunctionType, types.BuiltinFunctionType)
+    seen = set()
+    total_size = 0
+    objects_to_check = list(objects)
+    while objects_to_check:
+        obj = objects_to_check.pop()
+        if id(obj) in seen or isinstance(obj, shared_types):
+            continue
+        seen.add(id(obj))
+        total_size += sys.getsizeof(obj)
+        objects_to_check += gc.get_referents(obj)
+    return total_size
+
+
+def get_resident_memory(field='VmRSS'):
+    """
+    Return the resident memory size of this process in kilobytes, or None if it can't be found out (it is only available on Linux)
+
+    field can be VmRSS for all resident memory, RssAnon for just this process's own memory, or RssFile for memory shared with
+    files on disk (and so with other processes using the same files)
+    """
+    try:
+        for line in open('/proc/self/status'):
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+def load_fixtures():
+    """
+    Load every fixture in tests/data, and return a list of (description, function) tuples; each function parses one fixture
+    and returns a list of the Departures found in it
+    """
+    browser = WMTBrowser()
+    fixtures = []
+    for filename in sorted(glob.glob(HOME_DIR + '/data/tube/*-*.xml')):
+        (line_code, station_code) = os.path.basename(filename)[:-len('.xml')].split('-')
+        tube_data = browser.fetch_xml_tree("file://" + filename)
+        parser = lambda data=tube_data, code=station_code, line=line_code: parse_tube_data(data, RailStation(code=code), line)
+        fixtures.append(("Tube %s-%s" % (line_code, station_code), parser))
+    for filename in sorted(glob.glob(HOME_DIR + '/data/dlr/*.xml')):
+        station_code = os.path.basename(filename)[:-len('.xml')]
+        dlr_data = browser.fetch_xml_tree("file://" + filename)
+        parser = lambda data=dlr_data, code=station_code: parse_dlr_data(data, RailStation(code=code))
+        fixtures.append(("DLR %s" % station_code, parser))
+    for filename in sorted(glob.glob(HOME_DIR + '/data/bus/*.json')):
+        bus_data = browser.fetch_json("file://" + filename)
+        routes = sorted(set([arrival['routeName'] for arrival in bus_data.get('arrivals', [])]))
+        parser = lambda data=bus_data, routes=routes: [bus for route in routes for bus in parse_bus_data(data, route)]
+        fixtures.append(("Bus %s" % os.path.basename(filename)[:-len('.json')], parser))
+    return fixtures
+
+
+def make_synthetic_tube_data(number_of_trains):
+    """
+    Return an ElementTree like the one the Tube API gives us for a single station on the Central line, with number_of_trains
+    trains split between its two platforms
+    """
+    destinations = ("Epping", "Hainault via Newbury Park", "Woodford via Hainault", "West Ruislip", "Ealing Broadway", "White City")
+    root = Element('ROOT')
+    SubElement(root, 'WhenCreated').text = "1 Apr 2012 20:57:59"
+    platforms = [SubElement(root, 'P', {'N': 'Eastbound - Platform 1', 'Num': '1'}),
+                 SubElement(root, 'P', {'N': 'Westbound - Platform 2', 'Num': '2'})]
+    for i in range(number_of_trains):
+        SubElement(platforms[i % 2], 'T', {'LN': 'C', 'SetNo': '%03d' % i, 'SecondsTo': str(i * 7 % 3600),
+                                           'Destination': destinations[i % len(destinations)], 'DestCode': '1', 'Location': 'At Platform'})
+    return root
+
+
+def get_departures(parsed_data):
+    """
+    Return a flat list of Departures from parsed_data, which is either a list of Departures or a DepartureCollection
+    """
+    if isinstance(parsed_data, list):
+        return parsed_data
+    return [departure for slot in parsed_data for departure in parsed_data[slot]]
+
+
+#
+# Benchmarks
+#
+
+def benchmark_departure_memory():
+    """
+    Parse every fixture in tests/data, and report how much memory the resulting Departures (and their stations) take up
+    """
+    total_size = 0
+    total_departures = 0
+    for (description, parser) in load_fixtures():
+        departures = get_departures(parser())
+        size = get_deep_size(departures)
+        print "%-16s %4d departures %8d bytes" % (description, len(departures), size)
+        total_size += size
+        total_departures += len(departures)
+    print "%-16s %4d departures %8d bytes (%0.1f bytes per departure)" % ("Total", total_departures, total_size,
+                                                                          float(total_size) / max(total_departures, 1))
+
+
+def benchmark_departure_collection():
+    """
+    Parse synthetic Tube responses of up to 500 trains, and report the average time taken to parse them, build a
+    DepartureCollection from the trains, filter and clean it up, and format it for a Tweet
+    """
+    station = RailStation("Mile End", "MLE")
+    for number_of_trains in (50, 500):
+        tube_data = make_synthetic_tube_data(number_of_trains)
+        parse_time = time_function(lambda: parse_tube_data(tube_data, station, 'C'))
+
+        departures = parse_tube_data(tube_data, station, 'C')
+        trains = [(slot, train) for slot in departures for train in departures[slot]]
+
+        def build_collection():
+            """Add all the trains, one at a time, to a new DepartureCollection"""
+            collection = DepartureCollection()
+            for (slot, train) in trains:
+                collection.add_to_slot(slot, train)
+            return collection
+        build_time = time_function(build_collection)
+
+        # Filters are run on the same collection each time, but remove nothing after the first go so the work done is the same
+        def filter_and_cleanup():
+            """Filter & clean up the collection as WhensMyTrain does"""
+            departures.filter(lambda train: train.get_destination_no_via() != "Epping")
+            departures.filter(lambda train: train.get_destination_no_via() != "Mile End", True)
+            departures.cleanup(NullDeparture)
+        filter_time = time_function(filter_and_cleanup)
+
+        format_time = time_function(lambda: str(departures))
+        print "%4d trains: parse %7.3f ms, build %6.3f ms, filter & cleanup %6.3f ms, format %6.3f ms" % (number_of_trains, parse_time,
+                                                                                                       build_time, filter_time, format_time)
+
+
+def benchmark_departure_formatting():
+    """
+    Report the average time taken to format large DepartureCollections, with many slots and trains, for a Tweet
+    """
+    destinations = ("Bank", "Tower Gateway", "Stratford International", "Woolwich Arsenal", "King George V", "Beckton",
+                    "Lewisham", "Canning Town", "Westferry", "Crossharbour", "Royal Victoria", "West India Quay")
+    for (number_of_slots, trains_per_slot) in ((2, 10), (2, 500), (20, 500)):
+        departures = DepartureCollection()
+        for i in range(number_of_slots * trains_per_slot):
+            departures.add_to_slot("p%s" % (i % number_of_slots + 1), DLRTrain(destinations[i % len(destinations)], i // number_of_slots))
+        format_time = time_function(lambda: str(departures))
+        print "%2d slots of %3d trains: format %7.3f ms" % (number_of_slots, trains_per_slot, format_time)
+
+
+def benchmark_fuzzy_matching():
+    """
+    Report the average time taken to fuzzily match names against every bus stop in London, and every station name as a string
+    """
+    bus_stops = [BusStop(**row) for row in WMTDatabase('whensmybus.geodata.db').get_rows("SELECT * FROM locations WHERE run=1")]
+    station_names = [row['name'] for row in WMTDatabase('whensmytrain.geodata.db').get_rows("SELECT DISTINCT name FROM locations")]
+    for (description, candidates, search_terms) in (("bus stops", bus_stops, ("Trafalgar Square", "Limehouse Stn", "Hoxton")),
+                                                    ("station names", station_names, ("Kings Cross", "Earls Court", "Bank"))):
+        for search_term in search_terms:
+            match_time = time_function(lambda: get_best_fuzzy_match(search_term, candidates), 3)
+            print "%5d %-13s %-16s: match %8.3f ms" % (len(candidates), description, search_term, match_time)
+
+
+def benchmark_coordinate_conversion():
+    """
+    Report the time taken to convert the WGS84 position of every station in tube-locations.kml and every bus stop to an easting &
+    northing, one at a time and as a batch
+
+    The bus stop data only has eastings and northings, so the same number of random positions in London is used for the bus stops
+    """
+    kml = WMTBrowser().fetch_xml_tree('file://%s/../sourcedata/tube-locations.kml' % HOME_DIR)
+    station_positions = [tuple(reversed([float(c) for c in coordinates.text.split(',')[0:2]]))
+                         for coordinates in kml.findall('.//Placemark/Point/coordinates')]
+    number_of_bus_stops = WMTDatabase('whensmybus.geodata.db').get_value("SELECT COUNT(*) FROM locations")
+    rand = random.Random(0)
+    bus_stop_positions = [(rand.uniform(51.28, 51.69), rand.uniform(-0.51, 0.33)) for _i in range(number_of_bus_stops)]
+
+    for (description, positions) in (("stations", station_positions), ("bus stops", bus_stop_positions)):
+        (lats, lons) = ([lat for (lat, _lon) in positions], [lon for (_lat, lon) in positions])
+        scalar_time = time_function(lambda: [convertWGS84toOSEastingNorthing(*position) for position in positions], 1)
+        batch_time = time_function(lambda: convertWGS84toOSEastingNorthingArrays(lats, lons), 1)
+        print "%5d %-9s: one at a time %8.1f ms, as a batch %8.1f ms" % (len(positions), description, scalar_time, batch_time)
+
+
+def benchmark_kml_import():
+    """
+    Report the time taken to read the stations out of tube-locations.kml, and to import the whole Tube & DLR station database
+    from the source data into a temporary file
+    """
+    # datatools needs extra libraries the bots themselves don't, and works from the top directory of the project, so we import
+    # it and move there only when we need to
+    import datatools
+    original_directory = os.getcwd()
+    os.chdir(HOME_DIR + '/..')
+    try:
+        kml_time = time_function(datatools.parse_stations_from_kml, 10)
+
+        def import_stations():
+            """Import the Tube & DLR stations into a fresh database, ignoring the warnings printed out along the way"""
+            (standard_output, sys.stdout) = (sys.stdout, open(os.devnull, 'w'))
+            temporary_file = tempfile.NamedTemporaryFile(suffix='.db')
+            try:
+                datatools.import_tube_xml_to_db(temporary_file.name)
+                datatools.import_dlr_xml_to_db(temporary_file.name)
+            finally:
+                sys.stdout = standard_output
+                temporary_file.close()
+        import_time = time_function(import_stations, 10)
+    finally:
+        os.chdir(original_directory)
+    print "Read stations from KML %7.1f ms, import Tube & DLR stations %7.1f ms" % (kml_time, import_time)
+
+
+def benchmark_network_loading():
+    """
+    Report the time taken to load the Tube & DLR network, and how much memory it takes up once loaded
+    """
+    network_file = HOME_DIR + '/../db/whensmytrain.network.bin'
+    # Measure memory first, as memory freed up after loading the network again and again is not handed back to the system
+    memory_before = get_resident_memory()
+    network = WMTNetwork(network_file)
+    memory_after = get_resident_memory()
+    load_time = time_function(lambda: WMTNetwork(network_file), 10)
+    print "Load network %7.2f ms, %7d bytes in objects, resident memory up by %s kB" % (load_time, get_deep_size([network]),
+                                                                                        memory_before and memory_after - memory_before)
+
+
+def benchmark_route_finding():
+    """
+    Report the average time taken to find the quickest route between pairs of stations, by working out the quickest routes to
+    every station and picking the one we want, and by heading straight for the station we want with find_route()
+    """
+    network = RailStationLocations().network
+    journeys = (("Stockwell", "Euston", 'All'), ("Stockwell", "Euston", 'N'), ("West Ruislip", "Hainault", 'C'),
+                ("Bank", "Waterloo", 'W'), ("Limehouse", "Beckton", 'DLR'), ("Upminster", "Ealing Broadway", 'All'))
+    for (origin, destination, line_code) in journeys:
+        (origin_name, destination_name) = (origin + ":entrance", destination + ":exit")
+        tree_time = time_function(lambda: get_shortest_paths(network, origin_name, line_code))
+        route_time = time_function(lambda: network.find_route(origin_name, destination_name, line_code))
+        print "%-12s to %-15s on %-3s: all routes %6.3f ms, find route %6.3f ms" % (origin, destination, line_code, tree_time, route_time)
+
+
+def benchmark_stopping_trains():
+    """
+    Report the time taken to work out which trains on the busiest Tube departure boards in tests/data stop at a given station,
+    one train at a time and all in one go
+    """
+    geodata = RailStationLocations()
+    browser = WMTBrowser()
+    for (line_code, station_code, stop_at_name) in (('H', 'ERD', "Liverpool Street"), ('D', 'ECT', "Victoria"), ('N', 'CTN', "Euston")):
+        origin = geodata.find_exact_match({'code': station_code, 'line': line_code})
+        must_stop_at = geodata.find_fuzzy_match(stop_at_name, {'line': line_code})
+        tube_data = browser.fetch_xml_tree("file://%s/data/tube/%s-%s.xml" % (HOME_DIR, line_code, station_code))
+        departures = parse_tube_data(tube_data, origin, line_code)
+        trains = [train for slot in departures for train in departures[slot]]
+        # As WhensMyTrain does, swap the destinations and vias for canonical stations from the database
+        for train in trains:
+            if train.destination_name:
+                train.destination = geodata.find_fuzzy_match(train.get_destination_no_via(), {'line': line_code})
+            if train.via_name:
+                train.via = geodata.find_fuzzy_match(train.get_via(), {'line': line_code})
+
+        one_at_a_time = time_function(lambda: [train for train in trains if geodata.does_train_stop_at(train, origin, must_stop_at)], 10)
+        all_in_one_go = time_function(lambda: geodata.get_trains_stopping_at(trains, origin, must_stop_at), 10)
+        print "%2d trains from %-14s stopping at %-16s: one at a time %7.2f ms, all in one go %7.2f ms" % (len(trains), origin.name, must_stop_at.name,
+                                                                                                     one_at_a_time, all_in_one_go)
+
+
+def benchmark_lines_serving():
+    """
+    Report the average time taken to find the quickest direct line between pairs of stations, looking it up in the table made by
+    datatools and working it out from scratch
+    """
+    geodata = RailStationLocations()
+    for (origin_name, destination_name) in (("Stockwell", "Euston"), ("Baker Street", "Aldgate"), ("Bank", "Beckton")):
+        origin = geodata.find_fuzzy_match(origin_name, {})
+        destination = geodata.find_fuzzy_match(destination_name, {})
+        lookup_time = time_function(lambda: geodata.get_lines_serving(origin, destination), 1000)
+        work_out_time = time_function(lambda: geodata.find_lines_serving(origin, destination))
+        print "%-12s to %-8s: look up %6.3f ms, work out %6.3f ms" % (origin_name, destination_name, lookup_time, work_out_time)
+
+
+def query_geodata(read_only):
+    """
+    Run some typical queries on the bus stop database, opened read-only or not, and return a tuple of the average time taken
+    per query, and this process's own and shared resident memory once done
+    """
+    database = WMTDatabase('whensmybus.geodata.db', read_only)
+    routes = [row['route'] for row in database.get_rows("SELECT DISTINCT route FROM locations")]
+    closest_sql = ("SELECT *, (location_easting - ?) * (location_easting - ?) + (location_northing - ?) * (location_northing - ?) "
+                   "AS dist_squared FROM locations WHERE route = ? ORDER BY dist_squared LIMIT 1")
+    rand = random.Random(0)
+    queries = [(easting, easting, northing, northing, rand.choice(routes))
+               for (easting, northing) in [(rand.randint(510000, 550000), rand.randint(160000, 200000)) for _i in range(200)]]
+    closest_time = time_function(lambda: [database.get_row(closest_sql, query) for query in queries], 5) / len(queries)
+    scan_time = time_function(lambda: database.get_rows("SELECT * FROM locations WHERE name LIKE '%STATION%'"), 5)
+    return (closest_time, scan_time, get_resident_memory('RssAnon'), get_resident_memory('RssFile'))
+
+
+def benchmark_shared_geodata():
+    """
+    Report the average query time and memory used by several worker processes all querying the bus stop database, opening it
+    as normal and opening it read-only. Read-only databases are memory-mapped, so the workers' copies of it are shared
+    """
+    number_of_workers = 4
+    for read_only in (False, True):
+        pool = multiprocessing.Pool(number_of_workers)
+        results = pool.map(query_geodata, [read_only] * number_of_workers)
+        pool.close()
+        pool.join()
+        (closest_time, scan_time, own_memory, shared_memory) = [sum(result) / len(results) for result in zip(*results)]
+        print "%d workers, %-9s: closest stop %6.3f ms, scan %6.2f ms, own memory %6d kB, shared memory %6d kB per worker" % \
+            (number_of_workers, read_only and "read-only" or "default", closest_time, scan_time, own_memory or 0, shared_memory or 0)
+
+
+def benchmark_follower_reconciliation():
+    """
+    Report the average time taken to work out which followers to follow back, out of synthetic lists of followers and friends
+    (nine in ten of whom follow us), with a thousand protected users to ignore, testing membership of sets and of lists
+    """
+    rand = random.Random(0)
+    for number_of_followers in (5000, 100000):
+        followers_ids = rand.sample(xrange(10 ** 9), number_of_followers)
+        friends_ids = rand.sample(followers_ids, number_of_followers * 9 / 10) + rand.sample(xrange(10 ** 9), number_of_followers / 10)
+        protected_users = rand.sample(followers_ids, 1000)
+        set_time = time_function(lambda: values_not_in(followers_ids, friends_ids, protected_users), 10)
+        if number_of_followers <= 5000:
+            list_time = time_function(lambda: [f for f in followers_ids if f not in friends_ids and f not in protected_users], 1)
+            print "%6d followers: sets %8.2f ms, lists %8.2f ms" % (number_of_followers, set_time, list_time)
+        else:
+            print "%6d followers: sets %8.2f ms, lists too slow to run (about %d times as long as for 5000)" % \
+                (number_of_followers, set_time, (number_of_followers / 5000) ** 2)
+
+
+def benchmark_reply_bursts():
+    """
+    Report how quickly a burst of replies can be posted to a fake Twitter API allowing 10 Tweets a second, and how many times
+    its limit is broken, with no pacing, with a token bucket alone (small enough never to break the limit), and with a token
+    bucket that also follows the API's rate limit headers
+    """
+    (limit, period, number_of_replies) = (10, 1, 50)
+    for (pacing, limiter) in (("none", None),
+                              ("token bucket", WMTRateLimiter("status update", limit / 2, float(limit / 2) / period)),
+                              ("bucket & headers", WMTRateLimiter("status update", limit, float(limit) / period))):
+        fake_api = FakeTwitterAPI({'update': (limit, period)})
+        fake_api.start()
+        time_taken = post_statuses(fake_api.host, number_of_replies, limiter)
+        fake_api.stop()
+        print "Pacing %-16s: %2d of %d replies posted in %5.2f s, %5.1f per second (limit %s), limit broken %2d times" % \
+            (pacing, len(fake_api.statuses), number_of_replies, time_taken, len(fake_api.statuses) / time_taken, limit, fake_api.violations)
+
+
+benchmarks = ('departure_memory', 'departure_collection', 'departure_formatting', 'fuzzy_matching', 'coordinate_conversion',
+              'kml_import', 'network_loading', 'route_finding', 'stopping_trains', 'lines_serving', 'shared_geodata',
+              'follower_reconciliation', 'reply_bursts')
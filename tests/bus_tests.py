@@ -6,11 +6,33 @@ A set of unit tests for When's My Bus?
 
 IMPORTANT: These unit tests require Python 2.7, although When's My Bus will happily run in Python 2.6
 """
+import os
 import time
 from tests.generic_tests import WhensMyTransportTestCase, FakeTweet, FakeDirectMessage
+from lib.database import DB_PATH
+from lib.exceptions import WhensMyTransportException
+from lib.geo import approximateWGS84toOSEastingNorthing
+from lib.locations import LocalGeocoder
 from whensmybus import WhensMyBus
 
 
+class FakeGeocoder:
+    """
+    Fake geocoder for testing, that finds the same points for every placename and counts how many times it has been asked
+    """
+    #pylint: disable=R0903,W0613
+    def __init__(self, points):
+        self.points = points
+        self.calls = 0
+
+    def geocode(self, placename, browser):
+        """
+        Return the points we were set up with
+        """
+        self.calls += 1
+        return self.points
+
+
 class WhensMyBusTestCase(WhensMyTransportTestCase):
     """
     Main Test Case for When's My Bus
@@ -61,6 +83,9 @@ class WhensMyBusTestCase(WhensMyTransportTestCase):
                 ("Hoxton Station",),
                 ('None shown',)),
         )
+        # Our local geocoder has no postcodes, so unless it can fall back on a web geocoder, it cannot find this one
+        if isinstance(self.bot.geocoder, LocalGeocoder) and not self.bot.geocoder.fallback_geocoder:
+            self.nonstandard_test_data = tuple([test_data for test_data in self.nonstandard_test_data if test_data[0] != '55 from EC1M 4PN'])
 
     def _test_correct_successes(self, tweet, routes_specified, expected_origin, destination_to_avoid=''):
         """
@@ -111,6 +136,19 @@ class WhensMyBusTestCase(WhensMyTransportTestCase):
         self.assertTrue(self.bot.geodata.database.check_existence_of('locations', 'bus_stop_code', '47001'))
         self.assertFalse(self.bot.geodata.database.check_existence_of('locations', 'bus_stop_code', '47000'))
         self.assertEqual(self.bot.geodata.database.get_max_value('locations', 'run', {}), 6)
+        self.assertEqual(self.bot.geodata.find_closest((51.5124, -0.0397), {'run': 1, 'route': '15'}).number, "53410")
+        closest_stops = self.bot.geodata.find_closest_for_each([(51.5124, -0.0397)], {'route': '15'}, 'run')
+        self.assertEqual(closest_stops[1].number, "53410")
+        # Finding the closest stop on each run to any of several positions agrees with finding the closest to each position in turn
+        positions = [(51.5124, -0.0397), (51.5074, -0.1278)]
+        closest_stops = self.bot.geodata.find_closest_for_each(positions, {'route': '15'}, 'run')
+        for run in (1, 2):
+            closest_stop = min([self.bot.geodata.find_closest(position, {'run': run, 'route': '15'}) for position in positions])
+            self.assertEqual(closest_stops[run].number, closest_stop.number)
+            self.assertEqual(closest_stops[run].distance_away, closest_stop.distance_away)
+            self.assertIsInstance(closest_stops[run].distance_away, float)
+        self.assertEqual(self.bot.geodata.get_route_details('15')[0], 2)
+        self.assertEqual(self.bot.geodata.get_route_details('Z999'), None)
 
     def test_no_bus_number(self):
         """
@@ -221,7 +259,52 @@ class WhensMyBusTestCase(WhensMyTransportTestCase):
             tweet = FakeTweet(self.at_reply + route, position)
             self._test_correct_successes(tweet, route, expected_origin)
 
+    def test_local_geocoder(self):
+        """
+        Test to see the local geocoder finds stops, stations & places by name, and nothing for made-up names
+        """
+        geocoder = LocalGeocoder()
+        for placename in ('Poplar', 'Limehouse Station', 'Trafalgar Square', 'Hoxton'):
+            points = geocoder.geocode(placename)
+            self.assertTrue(points)
+            for point in points:
+                (easting, northing) = approximateWGS84toOSEastingNorthing(*point)
+                self.assertTrue(495000 <= easting <= 565000 and 145000 <= northing <= 205000)
+        self.assertEqual(geocoder.geocode('Xyzzy Plugh'), [])
+        self.assertEqual(geocoder.geocode('!!!'), [])
+
+        # Postcodes are not in the gazetteer, so are only found if there is a geocoder to fall back on
+        self.assertEqual(geocoder.geocode('EC1M 4PN'), [])
+        geocoder = LocalGeocoder(FakeGeocoder([(51.5224, -0.1024)]))
+        self.assertEqual(geocoder.geocode('ec1m4pn'), [(51.5224, -0.1024)])
+        self.assertTrue(geocoder.geocode('Poplar'))
+        self.assertEqual(geocoder.fallback_geocoder.calls, 1)
+
+        # A missing gazetteer is an error we can tell the user about, and is not made into an empty one
+        geocoder = LocalGeocoder(gazetteer_filename='nonexistent.gazetteer.db')
+        self.assertRaises(WhensMyTransportException, geocoder.geocode, 'Poplar')
+        self.assertFalse(os.path.exists(DB_PATH + '/nonexistent.gazetteer.db'))
+
+    def test_geocoder_fallback(self):
+        """
+        Test to see that when a stop name cannot be matched, the geocoder is only asked once, and we get the closest stop on each run
+        to any of the points it finds
+        """
+        limehouse = (51.5124, -0.0397)
+        self.bot.geocoder = FakeGeocoder([(51.5300, -0.3000), limehouse])
+        self.bot.geocode_cache = None
+        relevant_stops = self.bot.get_stops_by_stop_name('15', 'Xyzzy Plugh')
+        self.assertEqual(self.bot.geocoder.calls, 1)
+        closest_stops = self.bot.get_stops_by_geolocation('15', limehouse)
+        for run in (1, 2):
+            self.assertEqual(relevant_stops[run].number, closest_stops[run].number)
+
+        self.bot.geocoder = FakeGeocoder([])
+        self.assertEqual(self.bot.get_stops_by_stop_name('15', 'Xyzzy Plugh'), {})
+        self.assertEqual(self.bot.geocoder.calls, 1)
+
 
 bus_errors = ('no_bus_number', 'nonexistent_bus',)
 stop_errors = ('bad_stop_id', 'stop_id_mismatch', 'stop_name_nonsense',)
 bus_successes = ('nonstandard_messages', 'standard_messages', 'multiple_routes',)
+geocoder_tests = ('local_geocoder', 'geocoder_fallback',)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+"""
+A stand-in for Twitter's API, run locally so we can test When's My Transport's Twitter client (and how it paces its requests)
+without using Twitter itself. Point a WMTTwitterClient at it with api_host=FakeTwitterAPI.host
+"""
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+import json
+from SocketServer import ThreadingMixIn
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+
+# Limits on each kind of request, as (number of requests, per number of seconds), the same as Twitter's
+FAKE_TWITTER_LIMITS = {'read': (350, 60 * 60),
+                       'update': (1000, 24 * 60 * 60),
+                       'direct_message': (250, 24 * 60 * 60),
+                       'follow': (1000, 24 * 60 * 60)}
+FAKE_TWITTER_PAGE_SIZE = 5000  # Number of user IDs per page of followers or friends
+FAKE_TWITTER_USER = {'id': 1, 'screen_name': 'whensmytransport', 'name': "When's My Transport?"}
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server that answers each request in its own thread
+    """
+    daemon_threads = True
+
+
+class FakeTwitterAPI():
+    """
+    Class representing a fake Twitter API server, listening on a free port on this machine once started
+
+    Each kind of request (read, update, direct_message, follow) is limited as in limits, to a number of requests in each fixed
+    window of time. Every reply has Twitter's rate limit headers, and requests over the limit get an error and are counted as
+    violations. Tweets and direct messages posted are kept in statuses and direct_messages, in the order they arrived
+    """
+    def __init__(self, limits=None, followers_ids=(), friends_ids=()):
+        self.limits = dict(FAKE_TWITTER_LIMITS)
+        self.limits.update(limits or {})
+        self.followers_ids = list(followers_ids)
+        self.friends_ids = list(friends_ids)
+        self.statuses = []
+        self.direct_messages = []
+        self.request_counts = {}
+        self.violations = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeTwitterRequestHandler)
+        self.server.fake_api = self
+        self.host = '127.0.0.1:%s' % self.server.server_address[1]
+        self.thread = None
+
+    def start(self):
+        """
+        Start answering requests, in a background thread
+        """
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop answering requests
+        """
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count_request(self, kind):
+        """
+        Count a request of kind against its limit. Returns a tuple of whether it is allowed, and a dictionary of the rate limit
+        headers to reply with
+        """
+        (limit, period) = self.limits[kind]
+        # Windows start at multiples of period since the epoch, so their reset times are whole numbers of seconds, as Twitter's are
+        window_start = int(time.time() // period * period)
+        with self.lock:
+            count = self.request_counts.get((kind, window_start), 0) + 1
+            self.request_counts[(kind, window_start)] = count
+            is_allowed = count <= limit
+            if not is_allowed:
+                self.violations += 1
+        headers = {'X-RateLimit-Limit': limit,
+                   'X-RateLimit-Remaining': max(limit - count, 0),
+                   'X-RateLimit-Reset': window_start + period}
+        return (is_allowed, headers)
+
+    def get_ids_page(self, twitter_ids, cursor):
+        """
+        Return a page of twitter_ids starting at cursor, as Twitter's followers/ids and friends/ids do
+        """
+        start = max(int(cursor), 0)
+        next_cursor = start + FAKE_TWITTER_PAGE_SIZE < len(twitter_ids) and start + FAKE_TWITTER_PAGE_SIZE or 0
+        return {'ids': twitter_ids[start:start + FAKE_TWITTER_PAGE_SIZE], 'next_cursor': next_cursor, 'previous_cursor': 0}
+
+    def make_status(self, text, in_reply_to_status_id=None):
+        """
+        Return a Tweet, as Twitter represents it
+        """
+        return {'id': len(self.statuses) + 1, 'text': text, 'in_reply_to_status_id': in_reply_to_status_id, 'user': FAKE_TWITTER_USER,
+                'created_at': time.strftime("%a %b %d %H:%M:%S +0000 %Y", time.gmtime()), 'source': 'web'}
+
+
+class FakeTwitterRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handler for requests to a FakeTwitterAPI
+    """
+    def log_message(self, *args):
+        """
+        Keep quiet about each request
+        """
+        pass
+
+    def do_GET(self):
+        """
+        Answer a request to read from the API
+        """
+        fake_api = self.server.fake_api
+        (path, params) = self.parse_request_path()
+        if path.endswith('followers/ids'):
+            self.reply('read', lambda: fake_api.get_ids_page(fake_api.followers_ids, params.get('cursor', -1)))
+        elif path.endswith('friends/ids'):
+            self.reply('read', lambda: fake_api.get_ids_page(fake_api.friends_ids, params.get('cursor', -1)))
+        elif path.endswith('statuses/mentions') or path.endswith('direct_messages'):
+            self.reply('read', lambda: [])
+        elif path.endswith('account/verify_credentials'):
+            self.reply('read', lambda: FAKE_TWITTER_USER)
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        """
+        Answer a request to post to the API
+        """
+        fake_api = self.server.fake_api
+        (path, params) = self.parse_request_path()
+        params.update(dict(urlparse.parse_qsl(self.rfile.read(int(self.headers.getheader('content-length') or 0)))))
+        if path.endswith('statuses/update'):
+            status = fake_api.make_status(params.get('status'), params.get('in_reply_to_status_id'))
+            self.reply('update', lambda: fake_api.statuses.append(status) or status)
+        elif path.endswith('direct_messages/new'):
+            direct_message = {'id': len(fake_api.direct_messages) + 1, 'text': params.get('text'), 'sender': FAKE_TWITTER_USER,
+                              'recipient_screen_name': params.get('user') or params.get('screen_name')}
+            self.reply('direct_message', lambda: fake_api.direct_messages.append(direct_message) or direct_message)
+        elif '/friendships/create' in path:
+            self.reply('follow', lambda: FAKE_TWITTER_USER)
+        else:
+            self.send_error(404)
+
+    def parse_request_path(self):
+        """
+        Return a tuple of the path requested, without its .json extension, and a dictionary of the query string's parameters
+        """
+        url = urlparse.urlparse(self.path)
+        path = url.path.endswith('.json') and url.path[:-len('.json')] or url.path
+        return (path, dict(urlparse.parse_qsl(url.query)))
+
+    def reply(self, kind, make_reply):
+        """
+        Reply with the JSON of the object returned by make_reply, unless we are over the limit for requests of kind
+        """
+        (is_allowed, headers) = self.server.fake_api.count_request(kind)
+        if is_allowed:
+            (status_code, body) = (200, make_reply())
+        else:
+            (status_code, body) = (400, {'error': 'Rate limit exceeded. Clients may not make more than %s requests per %s seconds.' %
+                                                  self.server.fake_api.limits[kind]})
+        body = json.dumps(body)
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', len(body))
+        for (header, value) in headers.items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def post_statuses(host, number_of_statuses, limiter=None):
+    """
+    Post number_of_statuses Tweets to the API at host as fast as limiter (a WMTRateLimiter, updated from the rate limit headers
+    of each reply) lets us, or as fast as we can if there is no limiter. Returns how long it took, in seconds
+    """
+    start = time.time()
+    for i in range(number_of_statuses):
+        if limiter:
+            limiter.acquire()
+        try:
+            response = urllib2.urlopen('http://%s/1/statuses/update.json' % host, urllib.urlencode({'status': 'Reply %s' % i}))
+        except urllib2.HTTPError, response:
+            pass
+        if limiter:
+            limiter.update_from_headers(response.info().getheader)
+        response.close()
+    return time.time() - start
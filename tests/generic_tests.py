@@ -11,6 +11,7 @@ if sys.version_info < (2, 7):
     sys.exit(1)
 
 import logging
+import multiprocessing
 import os.path
 import random
 import re
@@ -21,11 +22,20 @@ import unittest
 try:
     from lib.dataparsers import parse_bus_data, parse_tube_data, parse_dlr_data
     from lib.exceptions import WhensMyTransportException
-    from lib.geo import heading_to_direction, gridrefNumToLet, convertWGS84toOSEastingNorthing, LatLongToOSGrid, convertWGS84toOSGB36
-    from lib.listutils import unique_values
-    from lib.models import Location, RailStation, BusStop, Departure, NullDeparture, Train, TubeTrain, DLRTrain, Bus, DepartureCollection
-    from lib.stringutils import capwords, get_name_similarity, get_best_fuzzy_match, cleanup_name_from_undesirables, gmt_to_localtime
-    from lib.twitterclient import split_message_for_twitter
+    from lib.geo import heading_to_direction, gridrefNumToLet, convertWGS84toOSEastingNorthing, LatLongToOSGrid, convertWGS84toOSGB36, \
+         convertWGS84toOSEastingNorthingArrays, approximateWGS84toOSEastingNorthing, LONDON_GRID_BOUNDS, LONDON_GRID_STEP, \
+         convertOSEastingNorthingtoWGS84
+    from lib.database import DB_PATH, WMTDatabase
+    from lib.geocache import WMTGeocodeCache
+    from lib.settings import WMTSettings
+    from tests.fake_twitter_api import FakeTwitterAPI, post_statuses
+    from lib.listutils import unique_values, values_not_in
+    from lib.ratelimiter import WMTRateLimiter, WMTRateLimitExceeded
+    from lib.models import Location, RailStation, BusStop, Departure, NullDeparture, Train, TubeTrain, DLRTrain, Bus, DepartureCollection, \
+         make_departure_time
+    from lib.stringutils import capwords, get_name_similarity, get_best_fuzzy_match, cleanup_name_from_undesirables, gmt_to_localtime, \
+         normalise_placename
+    from lib.twitterclient import split_message_for_twitter, WMTTwitterClient, TWITTER_UPDATE_LIMIT, TWITTER_DIRECT_MESSAGE_LIMIT
 
     from whensmytrain import LINE_NAMES, get_line_code, get_line_name
     from whensmytransport import TESTING_TEST_LOCAL_DATA, TESTING_TEST_LIVE_DATA
@@ -39,7 +49,6 @@ Sorry, testing failed because a package that WhensMyTransport depends on is not
 Missing packages can be downloaded as follows:
 
  * nltk: http://nltk.github.com/install.html
- * pygraph: http://code.google.com/p/python-graph/
  * tweepy: http://code.google.com/p/tweepy/
 """ % err
     sys.exit(1)
@@ -74,6 +83,23 @@ class FakeDirectMessage:
         self.text = text
 
 
+def answer_tweets_in_process(instance_name, results_queue):
+    """
+    Answer as many of twenty Tweets as we can get the lease on, as a separate process running the bot would, and put a list of
+    the IDs of the Tweets we answered on results_queue
+    """
+    settings = WMTSettings(instance_name)
+    answered_tweet_ids = []
+    for tweet_id in range(1, 21):
+        if settings.lease_tweet("tweet:%s" % tweet_id):
+            answered_tweet_ids.append(tweet_id)
+            time.sleep(0.01)
+            settings.update_high_water_mark("last_answered_tweet", tweet_id)
+            settings.flush()
+            settings.finish_tweet("tweet:%s" % tweet_id)
+    results_queue.put(answered_tweet_ids)
+
+
 class WhensMyTransportTestCase(unittest.TestCase):
     """
     Parent Test case for all When's My * bots
@@ -143,6 +169,25 @@ class WhensMyTransportTestCase(unittest.TestCase):
         self.assertEqual(LatLongToOSGrid(*osgb36), easting_northing)
         self.assertEqual(convertWGS84toOSEastingNorthing(*wgs84), easting_northing)
         self.assertEqual(gridrefNumToLet(*easting_northing), gridref)
+        self.assertEqual(convertOSEastingNorthingtoWGS84(*easting_northing), wgs84)
+
+        # Test batch conversion gives the same results as converting each point in turn
+        positions = [wgs84, (51.5028, -0.0106), (51.4124, -0.3006), (51.6537, 0.0858)]
+        (eastings, northings) = convertWGS84toOSEastingNorthingArrays([lat for (lat, lon) in positions], [lon for (lat, lon) in positions])
+        self.assertEqual(zip(eastings, northings), [convertWGS84toOSEastingNorthing(*position) for position in positions])
+
+        # Test the approximate conversion used for London is within 1m of the exact one, at points in between those on its grid
+        (south, north, west, east) = LONDON_GRID_BOUNDS
+        for i in range(int((north - south) / LONDON_GRID_STEP)):
+            for j in range(int((east - west) / LONDON_GRID_STEP)):
+                position = (south + (i + 0.37) * LONDON_GRID_STEP, west + (j + 0.61) * LONDON_GRID_STEP)
+                (approximate_easting, approximate_northing) = approximateWGS84toOSEastingNorthing(*position)
+                (easting, northing) = convertWGS84toOSEastingNorthing(*position)
+                self.assertLessEqual(abs(approximate_easting - easting), 1)
+                self.assertLessEqual(abs(approximate_northing - northing), 1)
+        # And that anywhere outside it, the conversion is exact
+        for position in ((55.9533, -3.1883), (north, east), (south - 0.01, west)):
+            self.assertEqual(approximateWGS84toOSEastingNorthing(*position), convertWGS84toOSEastingNorthing(*position))
 
         # Test heading_to_direction with a series of preset values
         for (heading, direction) in ((0, "North"), (90, "East"), (135, "SE"), (225, "SW"),):
@@ -160,6 +205,11 @@ class WhensMyTransportTestCase(unittest.TestCase):
         # And that every value in the old list is now exactly once in new list
         for value in test_list:
             self.assertEqual(unique_list.count(value), 1)
+        # And that a limit gives us just the first few of them
+        self.assertEqual(unique_values(test_list, 3), unique_list[:3])
+        # Values not in any of the exclusions, in their original order
+        self.assertEqual(values_not_in([5, 1, 4, 2, 3, 1], [2], set([4, 6])), [5, 1, 3, 1])
+        self.assertEqual(values_not_in(test_list, test_list), [])
 
     def test_stringutils(self):
         """
@@ -183,12 +233,20 @@ class WhensMyTransportTestCase(unittest.TestCase):
             for undesirable in undesirables:
                 self.assertIsNone(re.search(undesirable, cleaned_string, flags=re.I))
 
+        # Check placenames are normalised the same however they are capitalised, spaced or punctuated
+        self.assertEqual(normalise_placename("Oxford Circus"), "oxford circus")
+        self.assertEqual(normalise_placename("  oxford   CIRCUS. "), "oxford circus")
+        self.assertEqual(normalise_placename(u"King's Cross, St. Pancras!"), u"king s cross st pancras")
+        self.assertEqual(normalise_placename("?!"), "")
+
         # Check string similarities - 100 for identical strings, 90 or more for one character change
         # and nothing at all for a totally unidentical string
         similarity_string = random_string(65, 122)
         self.assertEqual(get_name_similarity(similarity_string, similarity_string), 100)
         self.assertGreaterEqual(get_name_similarity(similarity_string, similarity_string[:-1]), 90)
         self.assertEqual(get_name_similarity(similarity_string, random_string(48, 57)), 0)
+        # A minimum score makes no difference to scores above it
+        self.assertEqual(get_name_similarity(similarity_string, similarity_string[:-1], 90), get_name_similarity(similarity_string, similarity_string[:-1]))
 
         # Check to see most similar string gets picked out of an list of similar-looking strings, and that
         # with very dissimilar strings, there is no candidate at all
@@ -197,6 +255,15 @@ class WhensMyTransportTestCase(unittest.TestCase):
         dissimilarity_candidates = [random_string(48, 57) for _i in range(0, 10)]
         self.assertIsNone(get_best_fuzzy_match(similarity_string, dissimilarity_candidates))
 
+        # Check the best match is the same as if we scored every candidate and picked the highest, with the shortest and then the
+        # latest in the list as tiebreakers, for line names and some misspellings of them
+        line_names = [name for (_code, name) in LINE_NAMES.keys()] + ["Centrall", "Metropolitan", "Victoria Line", "Jubilee Lime"]
+        for search_term in ("Central", "Cental", "Hammersmith", "Metropolitain", "Jubilee Line", "Waterloo", "Nothern", "Dlr", "Cty"):
+            scores = [(get_name_similarity(search_term, name), -len(name), i) for (i, name) in enumerate(line_names)]
+            (confidence, _length, best_index) = max(scores)
+            expected_match = confidence >= 70 and line_names[best_index] or None
+            self.assertEqual(get_best_fuzzy_match(search_term, line_names), expected_match)
+
         if time.localtime().tm_isdst:
             self.assertEqual(gmt_to_localtime("2359"), "0059")
             self.assertEqual(gmt_to_localtime("23:59"), "0059")
@@ -223,6 +290,14 @@ class WhensMyTransportTestCase(unittest.TestCase):
         """
         Unit tests for train, bus, station and bus stop objects
         """
+        # Departure times roll over to tomorrow only if the current hour is more than an hour after the hour of departure
+        self.assertEqual(make_departure_time(23 * 60 + 58, 23), 23 * 60 + 58)
+        self.assertEqual(make_departure_time(24 * 60 + 5, 23), 5 + 24 * 60)
+        self.assertEqual(make_departure_time(5, 23), 5 + 24 * 60)
+        self.assertEqual(make_departure_time(12 * 60 + 30, 12), 12 * 60 + 30)
+        self.assertEqual(make_departure_time(12 * 60 + 30, 13), 12 * 60 + 30)
+        self.assertEqual(make_departure_time(12 * 60 + 30, 14), 12 * 60 + 30 + 24 * 60)
+
         # Location fundamentals
         location_name = "Trafalgar Square"
         location = Location(location_name)
@@ -247,6 +322,7 @@ class WhensMyTransportTestCase(unittest.TestCase):
         self.assertEqual(bus_stop2.get_similarity("Charing Cross Station"), 95)
         self.assertEqual(bus_stop.get_similarity("Charing Cross"), 90)
         self.assertEqual(bus_stop2.get_similarity("Charing Cross"), 91)
+        self.assertEqual(BusStop("STRATFORD BUS STATION").get_similarity("Stratford"), 91)
 
         # RailStation complex functions
         station = RailStation("King's Cross St. Pancras", "KXX", 530237, 182944)
@@ -295,6 +371,9 @@ class WhensMyTransportTestCase(unittest.TestCase):
         self.assertEqual(tube_train4.get_destination(), "Heathrow Terminal 5")
         self.assertEqual(tube_train.get_destination_no_via(), "Charing Cross")
         self.assertEqual(tube_train.get_via(), "Bank")
+        self.assertEqual(tube_train.destination, RailStation("Charing Cross"))
+        self.assertEqual(tube_train.via, RailStation("Bank"))
+        self.assertIsNone(tube_train3.destination)
 
         # DLRTrain
         dlr_train = DLRTrain("Beckton", "1200")
@@ -396,6 +475,10 @@ class WhensMyTransportTestCase(unittest.TestCase):
 
         self.bot.geodata.database.write_query("DROP TABLE test_data")
 
+        # Databases opened read-only must already exist, rather than be made anew
+        self.assertRaises(IOError, WMTDatabase, 'nonexistent.db', read_only=True)
+        self.assertFalse(os.path.exists(DB_PATH + '/nonexistent.db'))
+
         for name in self.geodata_table_names:
             row = self.bot.geodata.database.get_row("SELECT name FROM sqlite_master WHERE type='table' AND name='%s'" % name)
             self.assertIsNotNone(row, '%s table does not exist' % name)
@@ -424,9 +507,7 @@ class WhensMyTransportTestCase(unittest.TestCase):
                           "Wembley Stadium": (51.5558, -0.2797),
                           "qwerty": None}
         for (name, value) in test_locations.items():
-            geocode_url = self.bot.geocoder.get_geocode_url(name)
-            geodata = self.bot.browser.fetch_json(geocode_url)
-            points = self.bot.geocoder.parse_geodata(geodata)
+            points = self.bot.geocoder.geocode(name, self.bot.browser)
             if value is None:
                 self.assertFalse(points)
             else:
@@ -449,6 +530,84 @@ class WhensMyTransportTestCase(unittest.TestCase):
         test_time = int(time.time())
         self.bot.twitter_client.settings.update_setting("_test_time", test_time)
         self.assertEqual(test_time, self.bot.twitter_client.settings.get_setting("_test_time"))
+        # Settings are only written to the database when flushed, in one commit, and high-water marks never go backwards
+        self.bot.twitter_client.settings.update_high_water_mark("_test_time", test_time - 1)
+        self.assertEqual(test_time, self.bot.twitter_client.settings.get_setting("_test_time"))
+        self.bot.twitter_client.settings.update_high_water_mark("_test_time", test_time + 1)
+        commits = self.bot.twitter_client.settings.commits
+        self.assertEqual(self.bot.twitter_client.settings.flush(), 1)
+        self.assertEqual(self.bot.twitter_client.settings.flush(), 0)
+        self.assertEqual(self.bot.twitter_client.settings.commits, commits + 1)
+        self.assertEqual(test_time + 1, WMTSettings(self.bot.instance_name).get_setting("_test_time"))
+
+        # Protected users we cannot follow are kept in their own table, including any from when they were kept in a setting
+        settings = WMTSettings('%s_test' % self.bot.instance_name)
+        try:
+            settings.update_setting("protected_users_to_ignore", [1, 2])
+            settings.flush()
+            settings.add_protected_user(3)
+            self.assertEqual(settings.get_protected_users(), set([1, 2, 3]))
+            self.assertIsNone(WMTSettings('%s_test' % self.bot.instance_name).get_setting("protected_users_to_ignore"))
+        finally:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists('%s/%s_test.settings.db%s' % (DB_PATH, self.bot.instance_name, suffix)):
+                    os.unlink('%s/%s_test.settings.db%s' % (DB_PATH, self.bot.instance_name, suffix))
+
+    def test_settings_concurrency(self):
+        """
+        Test to see if several processes sharing the same settings answer each Tweet only once, and never set the last Tweet
+        answered backwards
+        """
+        instance_name = '%s_test' % self.bot.instance_name
+        results_queue = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=answer_tweets_in_process, args=(instance_name, results_queue)) for _i in range(4)]
+        try:
+            for process in processes:
+                process.start()
+            answered_tweet_ids = sum([results_queue.get() for process in processes], [])
+            for process in processes:
+                process.join()
+            self.assertEqual(sorted(answered_tweet_ids), range(1, 21))
+
+            (settings, other_settings) = (WMTSettings(instance_name), WMTSettings(instance_name))
+            self.assertEqual(settings.get_setting("last_answered_tweet"), 20)
+            other_settings.update_high_water_mark("last_answered_tweet", 30)
+            other_settings.flush()
+            settings.update_high_water_mark("last_answered_tweet", 25)
+            settings.flush()
+            self.assertEqual(settings.get_setting("last_answered_tweet"), 30)
+            self.assertFalse(settings.lease_tweet("tweet:20"))
+            # A Tweet whose lease is given up without answering it can be taken straight away by another process
+            other_settings.worker = "another worker"
+            self.assertTrue(settings.lease_tweet("tweet:21"))
+            self.assertFalse(other_settings.lease_tweet("tweet:21"))
+            settings.release_tweet("tweet:21")
+            self.assertTrue(other_settings.lease_tweet("tweet:21"))
+        finally:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists('%s/%s.settings.db%s' % (DB_PATH, instance_name, suffix)):
+                    os.unlink('%s/%s.settings.db%s' % (DB_PATH, instance_name, suffix))
+
+    def test_geocode_cache(self):
+        """
+        Test to see if the geocode cache remembers places, forgets the oldest when full, ignores expired ones and counts its hits
+        """
+        cache = WMTGeocodeCache('%s_test' % self.bot.instance_name, maximum_size=2)
+        try:
+            self.assertIsNone(cache.get_points("Oxford Circus"))
+            cache.add_points("Oxford Circus", [(51.5152, -0.1418)])
+            self.assertEqual(cache.get_points("oxford circus."), [(51.5152, -0.1418)])
+            self.assertEqual(cache.get_hit_rate(), 50)
+
+            cache.add_points("Clapham Junction", [(51.4643, -0.1704)])
+            cache.add_points("Bank", [(51.5133, -0.0886), (51.5134, -0.0890)])
+            self.assertIsNone(cache.get_points("Oxford Circus"))
+            self.assertEqual(cache.get_points("Bank"), [(51.5133, -0.0886), (51.5134, -0.0890)])
+
+            cache.maximum_age = -1
+            self.assertIsNone(cache.get_points("Bank"))
+        finally:
+            os.unlink('%s/%s_test.geocodecache.db' % (DB_PATH, self.bot.instance_name))
 
     def test_twitter_tools(self):
         """
@@ -460,6 +619,91 @@ class WhensMyTransportTestCase(unittest.TestCase):
         split_messages = [u"%s…" % message1, u"…%s" % message2]
         self.assertEqual(split_message_for_twitter(message, '@test_username'), split_messages)
 
+    def test_rate_limiter(self):
+        """
+        Test to see if the rate limiter allows a burst and then paces requests, waits for the API's limit to reset if it says
+        we have none left, and never goes over a fake Twitter API's limits
+        """
+        fake_time = [0]
+        limiter = WMTRateLimiter("test", 5, 1.0, clock=lambda: fake_time[0],
+                                 sleep=lambda seconds: fake_time.__setitem__(0, fake_time[0] + seconds))
+        self.assertEqual(sum([limiter.acquire() for _i in range(5)]), 0)
+        for _i in range(10):
+            limiter.acquire()
+        self.assertAlmostEqual(fake_time[0], 10)
+        fake_time[0] += 100
+        limiter.update(10, 0, fake_time[0] + 30)
+        self.assertAlmostEqual(limiter.acquire(), 30)
+        self.assertEqual(limiter.requests, 16)
+
+        # A limiter that will not wait long refuses rather than waits, and one made from another's state carries on where it left off
+        impatient_limiter = WMTRateLimiter("test", 5, 1.0, max_wait=2, clock=lambda: fake_time[0])
+        impatient_limiter.set_state(limiter.get_state())
+        self.assertEqual(impatient_limiter.get_state(), limiter.get_state())
+        impatient_limiter.update(10, 0, fake_time[0] + 30)
+        self.assertRaises(WMTRateLimitExceeded, impatient_limiter.acquire)
+        fake_time[0] += 30
+        self.assertEqual(impatient_limiter.acquire(), 0)
+
+        fake_api = FakeTwitterAPI({'update': (5, 1)})
+        fake_api.start()
+        post_statuses(fake_api.host, 12, WMTRateLimiter("status update", 5, 5.0))
+        fake_api.stop()
+        self.assertEqual(len(fake_api.statuses), 12)
+        self.assertEqual(fake_api.violations, 0)
+
+    def test_twitter_client_limits(self):
+        """
+        Test to see if our Twitter client keeps to a fake Twitter API's limits and its own, from one run to the next, and refuses
+        to wait a long time to post rather than hold on to the Tweet it is answering
+        """
+        instance_name = '%s_test' % self.bot.instance_name
+        fake_api = FakeTwitterAPI(followers_ids=range(1, 6), friends_ids=(2,))
+        fake_api.start()
+        try:
+            twitter_client = WMTTwitterClient(instance_name, 'key', 'secret', 'key', 'secret', api_host=fake_api.host)
+            self.assertEqual(twitter_client.fetch_tweets(), [])
+            # Our own limit on status updates allows a burst of a few, and then we would have to wait minutes for each one. Twitter's
+            # headers only tell us about its limit on reading, so they leave this alone
+            update_burst = TWITTER_UPDATE_LIMIT[0] / 48
+            for tweet_id in range(1, update_burst + 1):
+                twitter_client.send_reply_back("Reply %s" % tweet_id, 'test_username', False, tweet_id)
+            self.assertRaises(WMTRateLimitExceeded, twitter_client.send_reply_back, "Reply", 'test_username', False, update_burst + 1)
+            self.assertIsNone(twitter_client.update_limiter.api_remaining)
+            self.assertEqual(twitter_client.settings.get_setting('last_answered_tweet'), update_burst)
+            # An earlier Tweet leased but left unanswered is fetched again, until it is answered
+            self.assertTrue(twitter_client.settings.lease_tweet("tweet:5"))
+            self.assertEqual(twitter_client.get_fetch_start('tweet', 'last_answered_tweet'), 4)
+            self.assertEqual(twitter_client.get_fetch_start('direct_message', 'last_answered_direct_message'), 1)
+            twitter_client.settings.finish_tweet("tweet:5")
+            self.assertEqual(twitter_client.get_fetch_start('tweet', 'last_answered_tweet'), update_burst)
+            # The same goes for direct messages. A reply that needs two of them when we have room for one is refused before either is sent
+            burst = TWITTER_DIRECT_MESSAGE_LIMIT[0] / 48
+            for direct_message_id in range(1, burst):
+                twitter_client.send_reply_back("Reply %s" % direct_message_id, 'test_username', True, direct_message_id)
+            long_reply = "486 Charlton Stn / Charlton Church Lane to Bexleyheath Ctr 1935; Charlton Stn / Charlton Church Lane to North Greenwich 1934"
+            self.assertRaises(WMTRateLimitExceeded, twitter_client.check_room_for_replies, (long_reply,), 'test_username', True)
+            twitter_client.send_reply_back("Reply %s" % burst, 'test_username', True, burst)
+            self.assertRaises(WMTRateLimitExceeded, twitter_client.send_reply_back, "Reply", 'test_username', True, burst + 1)
+            self.assertEqual(twitter_client.settings.get_setting('last_answered_direct_message'), burst)
+            twitter_client.settings.flush()
+
+            # The next run carries on from where the last left off, rather than starting with a full bucket
+            twitter_client = WMTTwitterClient(instance_name, 'key', 'secret', 'key', 'secret', api_host=fake_api.host)
+            self.assertRaises(WMTRateLimitExceeded, twitter_client.send_reply_back, "Reply", 'test_username', True, burst + 1)
+            twitter_client.check_followers()
+            twitter_client.settings.flush()
+        finally:
+            fake_api.stop()
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists('%s/%s.settings.db%s' % (DB_PATH, instance_name, suffix)):
+                    os.unlink('%s/%s.settings.db%s' % (DB_PATH, instance_name, suffix))
+
+        self.assertEqual(len(fake_api.statuses), update_burst)
+        self.assertEqual(len(fake_api.direct_messages), burst)
+        self.assertEqual(sum([count for ((kind, _window), count) in fake_api.request_counts.items() if kind == 'follow']), 4)
+        self.assertEqual(fake_api.violations, 0)
+
     def test_twitter_client(self):
         """
         Test to see if our OAuth login details are correct
@@ -584,7 +828,8 @@ class WhensMyTransportTestCase(unittest.TestCase):
 #
 # Init tests (same for all)
 unit_tests = ('exceptions', 'geo', 'listutils', 'models', 'stringutils', 'tubeutils')
-local_tests = ('init', 'browser', 'database', 'dataparsers', 'location', 'logger', 'settings', 'textparser', 'twitter_tools')
+local_tests = ('init', 'browser', 'database', 'dataparsers', 'location', 'logger', 'settings', 'settings_concurrency', 'geocode_cache',
+               'textparser', 'twitter_tools', 'rate_limiter', 'twitter_client_limits')
 remote_tests = ('geocoder', 'twitter_client',)
 
 # Common errors for all
@@ -7,11 +7,101 @@ A set of unit tests for When's My Train?
 IMPORTANT: These unit tests require Python 2.7, although When's My Train will happily run in Python 2.6
 """
 from tests.generic_tests import FakeTweet, WhensMyTransportTestCase
+from heapq import heappush, heappop
+import os
 import sys
+import tempfile
 import time
 import unittest
 from whensmytrain import WhensMyTrain
 from lib.exceptions import WhensMyTransportException
+from lib.models import TubeTrain
+from lib.network import NETWORK_FILE_HEADER, NETWORK_FILE_MAGIC, NETWORK_FILE_VERSION, WMTNetwork, save_network
+
+
+class FakeGraph:
+    """
+    Fake directed graph for testing, with the same methods as a pygraph digraph that save_network() uses
+    """
+    def __init__(self, edge_weights, extra_nodes=()):
+        self.edge_weights = edge_weights
+        self.node_names = set(extra_nodes)
+        for (node_name, neighbour) in edge_weights.keys():
+            self.node_names.update((node_name, neighbour))
+
+    def nodes(self):
+        """
+        Return a list of the names of all the nodes
+        """
+        return list(self.node_names)
+
+    def edges(self):
+        """
+        Return a list of all the edges, each a (node name, neighbour name) tuple
+        """
+        return self.edge_weights.keys()
+
+    def edge_weight(self, edge):
+        """
+        Return the weight of edge
+        """
+        return self.edge_weights[edge]
+
+    def neighbors(self, node_name):
+        """
+        Return a list of the names of the nodes that the node named node_name has edges to
+        """
+        return [neighbour for (node, neighbour) in self.edge_weights.keys() if node == node_name]
+
+
+def get_shortest_paths(network, source, line_code='All'):
+    """
+    Find the shortest paths from the node named source to every other node on the line with line_code of the WMTNetwork network,
+    using Dijkstra's algorithm. Works the same as pygraph's shortest_path, returning a tuple of two dictionaries, keyed by node
+    name:
+
+        1. The node before each node on the shortest path to it (None for source)
+        2. The time taken to get to each node
+
+    Nodes that cannot be reached are not in either dictionary. Raises a KeyError if source is not on the line. This is slower
+    than WMTNetwork.find_route(), but much simpler, so we check that against it
+    """
+    line_bit = network.line_bits[line_code]
+    source_index = network.node_indices[source]
+    if not network.node_lines[source_index] & line_bit:
+        raise KeyError(source)
+
+    distances = {source_index: 0}
+    previous = {source_index: None}
+    queue = [(0, source_index)]
+    finished = set()
+    while queue:
+        (distance, node) = heappop(queue)
+        if node in finished:
+            continue
+        finished.add(node)
+        for edge in xrange(network.edge_offsets[node], network.edge_offsets[node + 1]):
+            neighbour = network.edge_targets[edge]
+            if network.edge_lines[edge] & line_bit and neighbour not in finished:
+                new_distance = distance + network.edge_weights[edge]
+                if neighbour not in distances or new_distance < distances[neighbour]:
+                    distances[neighbour] = new_distance
+                    previous[neighbour] = node
+                    heappush(queue, (new_distance, neighbour))
+
+    node_names = network.node_names
+    return (dict([(node_names[node], before is not None and node_names[before] or None) for (node, before) in previous.items()]),
+            dict([(node_names[node], distance) for (node, distance) in distances.items()]))
+
+
+def get_edges(network, node_name):
+    """
+    Return a dictionary of the edges from the node named node_name in the WMTNetwork network, keyed by the name of the node each
+    goes to, with values of (weight, line bits) tuples
+    """
+    node = network.node_indices[node_name]
+    return dict([(network.node_names[network.edge_targets[edge]], (network.edge_weights[edge], network.edge_lines[edge]))
+                 for edge in xrange(network.edge_offsets[node], network.edge_offsets[node + 1])])
 
 
 class WhensMyTubeTestCase(WhensMyTransportTestCase):
@@ -107,6 +197,8 @@ class WhensMyTubeTestCase(WhensMyTransportTestCase):
         euston = self.bot.geodata.find_fuzzy_match("Euston", {})
         self.assertEqual(sorted(self.bot.geodata.get_lines_serving(stockwell)), ['N', 'V'])
         self.assertEqual(sorted(self.bot.geodata.get_lines_serving(bank)), ['C', 'N', 'W'])
+        self.assertEqual(self.bot.geodata.get_lines_serving(stockwell, euston), ['V'])
+        self.assertEqual(self.bot.geodata.get_lines_serving(stockwell, euston), self.bot.geodata.find_lines_serving(stockwell, euston))
         self.assertEqual(self.bot.geodata.length_of_route(stockwell, euston), 18)
         self.assertEqual(self.bot.geodata.length_of_route(stockwell, euston, 'N'), 20)
         self.assertIn(('Oxford Circus', '', 'Victoria'), self.bot.geodata.describe_route(stockwell, euston))
@@ -140,6 +232,14 @@ class WhensMyTubeTestCase(WhensMyTransportTestCase):
         self.assertFalse(self.bot.geodata.is_correct_direction("Southbound", snaresbrook, wanstead, 'C'))
         self.assertFalse(self.bot.geodata.is_correct_direction("Southbound", morden, high_barnet, 'N'))
 
+        # Test trains taking the same route are filtered the same way when working out which stop at a station
+        charing_cross = self.bot.geodata.find_fuzzy_match("Charing Cross", {})
+        trains = [TubeTrain("High Barnet", "Northbound", "%02d00" % hour, "N", "%03d" % hour) for hour in range(4)]
+        for (train, via) in zip(trains, (bank, charing_cross, bank, charing_cross)):
+            (train.destination, train.via) = (high_barnet, via)
+        self.assertEqual(self.bot.geodata.get_trains_stopping_at(trains, stockwell, bank), [trains[0], trains[2]])
+        self.assertEqual(self.bot.geodata.get_trains_stopping_at(trains, stockwell, charing_cross), [trains[1], trains[3]])
+
         # DLR Location tests
         self.assertEqual(self.bot.geodata.find_closest((51.5124, -0.0397), {}).code, "lim")
         self.assertEqual(self.bot.geodata.find_closest((51.5124, -0.0397), {'line': 'DLR'}).code, "lim")
@@ -161,6 +261,76 @@ class WhensMyTubeTestCase(WhensMyTransportTestCase):
         self.assertTrue(self.bot.geodata.is_correct_direction("Eastbound", limehouse, beckton, "DLR"))
         self.assertFalse(self.bot.geodata.is_correct_direction("Eastbound", beckton, limehouse, "DLR"))
 
+    def test_network(self):
+        """
+        Test to see a network saved to file is loaded back the same, and that a file that is not a network is rejected
+        """
+        # Two lines, A and B, meeting at Y. The change at Y is only part of the whole network, and nothing goes to W
+        graphs = {'A': FakeGraph({('X:entrance', 'X:East:A'): 1.0, ('X:East:A', 'Y:East:A'): 4.0, ('Y:East:A', 'Y:exit'): 1.0,
+                                  ('W:East:A', 'X:East:A'): 2.0}),
+                  'B': FakeGraph({('X:entrance', 'X:North:B'): 1.0, ('X:North:B', 'Z:North:B'): 10.0, ('Y:North:B', 'Z:North:B'): 3.0,
+                                  ('Z:North:B', 'Z:exit'): 1.0}, ('Y:exit',))}
+        all_edges = {('Y:East:A', 'Y:North:B'): 2.0}
+        for graph in graphs.values():
+            all_edges.update(graph.edge_weights)
+        graphs['All'] = FakeGraph(all_edges)
+
+        network_file = tempfile.NamedTemporaryFile()
+        save_network(graphs, network_file.name)
+        network = WMTNetwork(network_file.name)
+        self.assertEqual(network.line_bits, {'All': 1, 'A': 2, 'B': 4})
+        self.assertEqual(network.node_names, sorted(graphs['All'].nodes()))
+        for node_name in network.node_names:
+            line_bits = sum([network.line_bits[line_code] for line_code in graphs if node_name in graphs[line_code].nodes()])
+            self.assertEqual(network.node_lines[network.node_indices[node_name]], line_bits)
+            expected_edges = {}
+            for (line_code, graph) in graphs.items():
+                for neighbour in graph.neighbors(node_name):
+                    (weight, line_bits) = expected_edges.get(neighbour, (graph.edge_weight((node_name, neighbour)), 0))
+                    expected_edges[neighbour] = (weight, line_bits | network.line_bits[line_code])
+            self.assertEqual(get_edges(network, node_name), expected_edges)
+
+        # Edges on a line must be the same as on the whole network
+        graphs['A'].edge_weights[('X:East:A', 'Y:East:A')] = 5.0
+        self.assertRaises(ValueError, save_network, graphs, network_file.name)
+
+        for (magic, version) in (('WMTX', NETWORK_FILE_VERSION), (NETWORK_FILE_MAGIC, NETWORK_FILE_VERSION + 1)):
+            bad_file = open(network_file.name, 'wb')
+            bad_file.write(NETWORK_FILE_HEADER.pack(magic, version, 0, 0, 0, 0))
+            bad_file.close()
+            self.assertRaises(ValueError, WMTNetwork, network_file.name)
+        network_file.close()
+
+    def test_route_finding(self):
+        """
+        Test to see the quickest routes found between nodes of the network are as quick as Dijkstra's algorithm finds, on the whole
+        network and on single lines, and that nodes that cannot be reached are not
+        """
+        network = self.bot.geodata.network
+        journeys = (('Stockwell:entrance', 'All'), ('Stockwell:entrance', 'N'), ('Snaresbrook:entrance', 'C'),
+                    ('Heathrow Terminal 4:entrance', 'P'), ('Limehouse:entrance', 'DLR'))
+        for (source, line_code) in journeys:
+            distances = get_shortest_paths(network, source, line_code)[1]
+            for target in network.node_names:
+                (route, time_taken) = network.find_route(source, target, line_code)
+                if target not in distances:
+                    self.assertEqual((route, time_taken), ([], None))
+                    continue
+                self.assertAlmostEqual(time_taken, distances[target])
+                self.assertEqual((route[0], route[-1]), (source, target))
+                route_time = 0
+                for (node_name, neighbour) in zip(route[:-1], route[1:]):
+                    (weight, line_bits) = get_edges(network, node_name)[neighbour]
+                    self.assertTrue(line_bits & network.line_bits[line_code])
+                    route_time += weight
+                self.assertAlmostEqual(route_time, time_taken)
+            # Some nodes are always off the line or out of reach, so make sure we have checked them
+            self.assertLess(len(distances), len(network.node_names))
+
+        self.assertRaises(KeyError, network.find_route, 'Limehouse:entrance', 'Stockwell:exit', 'N')
+        self.assertEqual(network.find_route('Stockwell:entrance', 'Limehouse:exit', 'N'), ([], None))
+        self.assertEqual(network.find_route('Stockwell:entrance', 'Nowhere:exit', 'N'), ([], None))
+
     def test_textparser(self):
         """
         Tests for the natural language parser
@@ -377,3 +547,4 @@ class WhensMyDLRTestCase(WhensMyTubeTestCase):
 tube_errors = ('bad_line_name',)
 station_errors = ('bad_routing', 'missing_station_data', 'station_line_mismatch', 'no_trains', 'no_line_specified', 'known_problems')
 tube_successes = ('nonstandard_messages', 'standard_messages',)
+network_tests = ('network', 'route_finding',)
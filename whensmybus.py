@@ -51,7 +51,7 @@ class WhensMyBus(WhensMyTransport):
         """
         # Not all valid-looking bus numbers are real bus numbers (e.g. 214, RV11) so we check database to make sure
         route_number = route_number.upper()
-        if not self.geodata.database.check_existence_of('locations', 'route', route_number):
+        if not self.geodata.get_route_details(route_number):
             raise WhensMyTransportException('nonexistent_bus', route_number)
 
         # Dig out relevant bus stop for this route from the geotag, if provided, or else the stop name
@@ -100,7 +100,7 @@ class WhensMyBus(WhensMyTransport):
         """
         # A route typically has two "runs" (e.g. one eastbound, one west) but some have more than that, so work out how many we have to check
         logging.debug("Attempting to get a geomatch on location %s", position)
-        max_runs = self.geodata.database.get_max_value('locations', 'run', {'route': route_number})
+        max_runs = self.geodata.get_route_details(route_number)[0]
         logging.debug("Have found total of %s runs", max_runs)
         relevant_stops = {}
         for run in range(1, max_runs + 1):
@@ -146,38 +146,35 @@ class WhensMyBus(WhensMyTransport):
         relevant_stops = {}
 
         # A route typically has two "runs" (e.g. one eastbound, one west) but some have more than that, so work out how many we have to check
-        max_runs = self.geodata.database.get_max_value('locations', 'run', {'route': route_number})
+        max_runs = self.geodata.get_route_details(route_number)[0]
         for run in range(1, max_runs + 1):
             best_match = self.geodata.find_fuzzy_match(stop_name, {'route': route_number, 'run': run})
             if best_match:
                 logging.info("Found stop name %s for Run %s by fuzzy matching", best_match.name, best_match.run)
                 relevant_stops[run] = best_match
 
-        # If we can't find a location for either Run 1 or 2, use the geocoder to find a location on that Run matching our name
-        for run in (1, 2):
-            if run not in relevant_stops and self.geocoder:
-                logging.debug("No match found for run %s, attempting to get geocode placename %s", run, stop_name)
-                geocode_url = self.geocoder.get_geocode_url(stop_name)
-                try:
-                    geodata = self.browser.fetch_json(geocode_url)
-                except WhensMyTransportException:
-                    logging.debug("Error connecting to geocoder, skipping")
-                    continue
-
-                points = self.geocoder.parse_geodata(geodata)
-                if not points:
-                    logging.debug("Could not find any matching location for %s", stop_name)
-                    continue
+        # If we can't find a location for either Run 1 or 2, use the geocoder to find places matching our name, and then the stop
+        # on each of those runs that is nearest to any of those places
+        missing_runs = [run for run in (1, 2) if run not in relevant_stops]
+        if missing_runs and self.geocoder:
+            logging.debug("No match found for runs %s, attempting to get geocode placename %s", missing_runs, stop_name)
+            try:
+                points = self.geocode(stop_name)
+            except WhensMyTransportException:
+                logging.debug("Error connecting to geocoder, skipping")
+                points = []
 
+            if points:
                 logging.debug("Have found %s matching points", len(points))
-                # For each of the places found, get the nearest stop that serves this run
-                possible_stops = [self.get_stops_by_geolocation(route_number, point).get(run, None) for point in points]
-                possible_stops = [stop for stop in possible_stops if stop]
-                if possible_stops:
-                    relevant_stops[run] = sorted(possible_stops)[0]
-                    logging.debug("Have found stop named: %s", relevant_stops[run].name)
-                else:
-                    logging.debug("Found a location, but could not find a nearby stop for %s", stop_name)
+                closest_stops = self.geodata.find_closest_for_each(points, {'route': route_number}, 'run')
+                for run in missing_runs:
+                    if run in closest_stops:
+                        relevant_stops[run] = closest_stops[run]
+                        logging.debug("Have found stop named: %s", relevant_stops[run].name)
+                    else:
+                        logging.debug("Found a location, but could not find a nearby stop for %s", stop_name)
+            else:
+                logging.debug("Could not find any matching location for %s", stop_name)
 
         return relevant_stops
 
@@ -200,9 +200,9 @@ class WhensMyTrain(WhensMyTransport):
         # Turn parsed destination & via station names into canonical versions for this train so we can do lookups & checks
         for slot in departures:
             for train in departures[slot]:
-                if train.destination:
+                if train.destination_name:
                     train.destination = self.get_station_by_station_name(train.get_destination_no_via(), line_code)
-                if train.via:
+                if train.via_name:
                     train.via = self.get_station_by_station_name(train.get_via(), line_code)
 
         # Deal with any departures filed under "Unknown", slotting them into Eastbound/Westbound if their direction is not known
@@ -224,7 +224,10 @@ class WhensMyTrain(WhensMyTransport):
         # If we've specified a station to stop at, filter out any that do not stop at that station or are not in its direction
         # Note that unlike the above, this will turn all existing empty lists into Nones (and thus deletable) as well
         if must_stop_at:
-            filter_by_stop_at = lambda train: self.geodata.does_train_stop_at(train, origin, must_stop_at)
+            # Work out which trains stop there all in one go, so trains taking the same route are only checked once
+            trains = [train for slot in departures for train in departures[slot]]
+            stopping_trains = set([id(train) for train in self.geodata.get_trains_stopping_at(trains, origin, must_stop_at)])
+            filter_by_stop_at = lambda train: id(train) in stopping_trains
             departures.filter(filter_by_stop_at, delete_existing_empty_slots=True)
         # Else filter by direction - Tubs is already classified by direction, DLR is not direction-aware so must calculate manually
         elif direction:
@@ -29,8 +29,11 @@ from pprint import pprint # For debugging
 # From library modules in this package
 from lib.browser import WMTBrowser, WMTURLProvider
 from lib.exceptions import WhensMyTransportException
-from lib.geo import convertWGS84toOSEastingNorthing, gridrefNumToLet, YahooGeocoder
+from lib.geo import approximateWGS84toOSEastingNorthing, gridrefNumToLet, YahooGeocoder
+from lib.geocache import WMTGeocodeCache
+from lib.locations import LocalGeocoder
 from lib.logger import setup_logging
+from lib.ratelimiter import WMTRateLimitExceeded
 from lib.twitterclient import WMTTwitterClient, is_direct_message
 
 # Some constants we use
@@ -60,6 +63,7 @@ class WhensMyTransport:
             config_file = 'config.cfg'
             open(HOME_DIR + '/' + config_file)
             config = ConfigParser.SafeConfigParser({'debug_level': 'INFO',
+                                                    'geocoder': 'yahoo',
                                                     'yahoo_app_id': None})
             config.read(HOME_DIR + '/' + config_file)
             config.get(self.instance_name, 'debug_level')
@@ -87,9 +91,17 @@ class WhensMyTransport:
         self.geodata = None
         self.parser = None
 
-        # Setup geocoder for looking up place names
+        # Setup geocoder for looking up place names - either our own local one, or Yahoo's (if we have an app ID for it). Our
+        # local one has no postcodes, so uses Yahoo's for those if it can. Web geocoders are slow, so what they find is kept in a cache
+        self.geocode_cache = None
         yahoo_app_id = config.get(self.instance_name, 'yahoo_app_id')
-        self.geocoder = yahoo_app_id and YahooGeocoder(yahoo_app_id)
+        web_geocoder = yahoo_app_id and YahooGeocoder(yahoo_app_id) or None
+        if config.get(self.instance_name, 'geocoder') == 'local':
+            self.geocoder = LocalGeocoder(web_geocoder)
+        else:
+            self.geocoder = web_geocoder
+            if self.geocoder:
+                self.geocode_cache = WMTGeocodeCache(self.instance_name)
 
         # Setup Twitter client
         self.username = config.get(self.instance_name, 'username')
@@ -110,36 +122,62 @@ class WhensMyTransport:
         """
         tweets = self.twitter_client.fetch_tweets()
         logging.debug("%s Tweets to process", len(tweets))
-        for tweet in tweets:
-            # If the Tweet is not valid (e.g. not directly addressed, from ourselves) then skip it
-            if not self.validate_tweet(tweet):
-                continue
-
-            # Try processing the Tweet. This may fail with a WhensMyTransportException for a number of reasons, in which
-            # case we catch the exception and process an apology accordingly. Other Python Exceptions may occur too - we handle
-            # these by DMing the admin with an alert
-            try:
-                replies = self.process_tweet(tweet)
-            except WhensMyTransportException as exc:
-                replies = (exc.get_user_message(),)
-            except Exception as exc:
-                logging.error("Exception encountered: %s", exc.__class__.__name__)
-                logging.error("Traceback:\r\n%s" % traceback.format_exc())
-                self.alert_admin_about_exception(tweet, exc.__class__.__name__)
-                replies = (WhensMyTransportException('unknown_error').get_user_message(),)
-
-            # If the reply is blank, probably didn't contain a bus number or Tube line, so check to see if there was a thank-you
-            if not replies:
-                replies = self.check_politeness(tweet)
-
-            # Send a reply back, if we have one. DMs and @ replies have different structures and different handlers
-            for reply in replies:
+        settings = self.twitter_client.settings
+        commits_before = settings.commits
+        # Settings (such as the last Tweet answered) are saved after each Tweet, and whatever happens at the end
+        try:
+            for tweet in tweets:
+                # If the Tweet is not valid (e.g. not directly addressed, from ourselves) then skip it
+                if not self.validate_tweet(tweet):
+                    continue
+                # Another process may be running at the same time, so make sure only one of us answers each Tweet
+                tweet_key = "%s:%s" % (is_direct_message(tweet) and "direct_message" or "tweet", tweet.id)
+                if not settings.lease_tweet(tweet_key):
+                    continue
+
+                # Try processing the Tweet. This may fail with a WhensMyTransportException for a number of reasons, in which
+                # case we catch the exception and process an apology accordingly. Other Python Exceptions may occur too - we handle
+                # these by DMing the admin with an alert
+                try:
+                    replies = self.process_tweet(tweet)
+                except WhensMyTransportException as exc:
+                    replies = (exc.get_user_message(),)
+                except Exception as exc:
+                    logging.error("Exception encountered: %s", exc.__class__.__name__)
+                    logging.error("Traceback:\r\n%s" % traceback.format_exc())
+                    self.alert_admin_about_exception(tweet, exc.__class__.__name__)
+                    replies = (WhensMyTransportException('unknown_error').get_user_message(),)
+
+                # If the reply is blank, probably didn't contain a bus number or Tube line, so check to see if there was a thank-you
+                if not replies:
+                    replies = self.check_politeness(tweet)
+
+                # Send a reply back, if we have one. DMs and @ replies have different structures and different handlers. Our lease
+                # is renewed before each, as Twitter's limits can hold us up. If they would hold us up too long to send every part of
+                # every reply, none are sent, and this Tweet and any after it are left for the next run to answer in full
                 if is_direct_message(tweet):
-                    self.twitter_client.send_reply_back(reply, tweet.sender.screen_name, True, tweet.id)
+                    (username, send_direct_message) = (tweet.sender.screen_name, True)
                 else:
-                    self.twitter_client.send_reply_back(reply, tweet.user.screen_name, False, tweet.id)
-
-        self.twitter_client.check_followers()
+                    (username, send_direct_message) = (tweet.user.screen_name, False)
+                try:
+                    self.twitter_client.check_room_for_replies(replies, username, send_direct_message)
+                    for reply in replies:
+                        if not settings.lease_tweet(tweet_key):
+                            break
+                        self.twitter_client.send_reply_back(reply, username, send_direct_message, tweet.id)
+                except WMTRateLimitExceeded as exc:
+                    logging.warning("%s, so leaving the rest of the Tweets for the next run", exc)
+                    settings.release_tweet(tweet_key)
+                    break
+                settings.flush()
+                settings.finish_tweet(tweet_key)
+
+            self.twitter_client.check_followers()
+        finally:
+            settings.flush()
+            logging.debug("Made %s commits to the settings database for this batch", settings.commits - commits_before)
+            if self.geocode_cache:
+                self.geocode_cache.report_hit_rate()
 
     def validate_tweet(self, tweet):
         """
@@ -259,15 +297,16 @@ class WhensMyTransport:
         if self.tweet_has_geolocation(tweet):
             logging.debug("Detecting geolocation on Tweet")
             position = tweet.geo['coordinates']
-            easting, northing = convertWGS84toOSEastingNorthing(*position)
+            # We only need to know whether we are in London, so a conversion accurate to a metre or so is fine
+            easting, northing = approximateWGS84toOSEastingNorthing(*position)
+            # Check minimums & maximum numeric grid references - corresponding to Chesham (W), Shenfield (E), Dorking (S) and Potters Bar (N)
+            if 495000 <= easting <= 565000 and 145000 <= northing <= 205000:
+                return position
             # Grid reference provides us an easy way with checking to see if in the UK - it returns blank string if not in UK bounds
-            if not gridrefNumToLet(easting, northing):
+            elif not gridrefNumToLet(easting, northing):
                 raise WhensMyTransportException('not_in_uk')
-            # Check minimums & maximum numeric grid references - corresponding to Chesham (W), Shenfield (E), Dorking (S) and Potters Bar (N)
-            elif not (495000 <= easting <= 565000 and 145000 <= northing <= 205000):
-                raise WhensMyTransportException('not_in_london')
             else:
-                return position
+                raise WhensMyTransportException('not_in_london')
 
         # Some people (especially Tweetdeck users) add a Place on the Tweet, but not an accurate enough lat & long
         elif hasattr(tweet, 'place') and tweet.place:
@@ -279,6 +318,20 @@ class WhensMyTransport:
             else:
                 raise WhensMyTransportException('dms_not_taggable', user_request)
 
+    def geocode(self, placename):
+        """
+        Look up placename with our geocoder, and return list of matching place(s), each represented by a (latitude, longitude) tuple
+
+        If the places are in our geocode cache, we use those instead. Raises a WhensMyTransportException if the geocoder cannot be reached
+        """
+        points = self.geocode_cache and self.geocode_cache.get_points(placename)
+        if points is None:
+            points = self.geocoder.geocode(placename, self.browser)
+            # Only places actually found get cached, so a geocoder having a bad day does not stop us finding them later
+            if points and self.geocode_cache:
+                self.geocode_cache.add_points(placename, points)
+        return points
+
     @abstractmethod
     def process_individual_request(self, code, origin, destination, direction, position):
         """